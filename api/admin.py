@@ -1,3 +1,5 @@
+import time
+
 from django.contrib import admin
 from django.contrib.admin import AdminSite
 from django.contrib.auth.admin import GroupAdmin, UserAdmin
@@ -9,6 +11,7 @@ from django.shortcuts import redirect
 from django.urls import path
 from django.utils.html import format_html
 
+from api.importer import RecipeImporter
 from api.models import Category, Comment, Favorite, Ingredient, Rating, Recipe, RecipeIngredient, Step, Unit, User
 from api.serializers.ingredient import IngredientDisplaySerializer
 from recipes.settings import APP_URL
@@ -24,7 +27,8 @@ class CustomAdminSite(AdminSite):
     def get_urls(self):
         urls = super().get_urls()
         my_urls = [
-            path('ingredients/<int:id>/', self.get_ingredient)
+            path('ingredients/<int:id>/', self.get_ingredient),
+            path('recipes/import/', self.import_recipes),
         ]
 
         urls = my_urls + urls
@@ -44,6 +48,23 @@ class CustomAdminSite(AdminSite):
             response = redirect('/admin/login/')
             return response
 
+    # NDJSON body, see RecipeImporter
+    def import_recipes(self, request, *args, **kwargs):
+        if request.user.is_anonymous or not request.user.is_superuser:
+            return redirect('/admin/login/')
+        if request.method != 'POST':
+            return JsonResponse({'error': 'Method {} not allowed!'.format(request.method)}, status=405)
+
+        importer = RecipeImporter(user=request.user)
+        started = time.monotonic()
+        importer.run(request)
+        return JsonResponse({
+            'imported': importer.imported,
+            'failed': len(importer.errors),
+            'errors': [{'line': line, 'errors': errors} for line, errors in importer.errors[:100]],
+            'seconds': round(time.monotonic() - started, 3),
+        }, status=200)
+
 
 class RecipeIngredientAdminForm(ModelForm):
 
@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        import api.signals  # noqa: F401
+        from api.search import create_index
+        post_migrate.connect(create_index, sender=self)
+        from api.db import apply_sqlite_pragmas
+        connection_created.connect(apply_sqlite_pragmas)
@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from api.models import User
+
+# What the permissions look at, everything else of the user is loaded on first access
+IDENTITY_FIELDS = ('id', 'is_staff', 'is_active')
+
+
+class IdentityCache(object):
+    """Least recently used identities of this process, each one kept for at most timeout seconds."""
+
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return values
+
+    def set(self, key, values):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.timeout, values)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+identities = IdentityCache(settings.AUTH_USER_CACHE_SIZE, settings.AUTH_USER_CACHE_TIMEOUT)
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication answering from the identity cache, so a request with a known token runs no user query.
+    The user is built with only IDENTITY_FIELDS loaded.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        values = identities.get(user_id)
+        if values is None:
+            values = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}) \
+                .values_list(*IDENTITY_FIELDS).first()
+            if values is None:
+                raise AuthenticationFailed(_('User not found'), code='user_not_found')
+            identities.set(user_id, values)
+
+        user = User.from_db(DEFAULT_DB_ALIAS, IDENTITY_FIELDS, values)
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
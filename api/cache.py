@@ -0,0 +1,93 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Modification stamps (time of the last change) shared by the response cache and the conditional GET
+# validators. Changing a stamp retires every cache key built from it.
+
+# Any change that can alter every recipe document (e.g. a category rename)
+GLOBAL_STAMP_KEY = 'recipes:modified'
+# Any change to any recipe, since every list page may contain it
+LIST_STAMP_KEY = 'recipes:list:modified'
+RECIPE_STAMP_KEY = 'recipes:{}:modified'
+# Favourites and ratings of a user, i.e. the per-user overlay
+USER_STAMP_KEY = 'recipes:user:{}:modified'
+# Reference data (categories, units, ingredients), keyed by model label
+MODEL_STAMP_KEY = '{}:modified'
+
+
+def get_stamps(*keys):
+    stamps = cache.get_many(keys)
+    missing = [key for key in keys if key not in stamps]
+    if missing:
+        # Unknown (e.g. evicted) stamps restart at the current time, which only costs clients a revalidation
+        now = time.time()
+        for key in missing:
+            cache.add(key, now, None)
+        stamps.update(cache.get_many(missing))
+    return [stamps.get(key, time.time()) for key in keys]
+
+
+def touch(*keys):
+    cache.set_many(dict.fromkeys(keys, time.time()), None)
+
+
+def recipes_changed(recipe_ids):
+    touch(LIST_STAMP_KEY, *[RECIPE_STAMP_KEY.format(recipe_id) for recipe_id in set(recipe_ids)])
+
+
+def catalogue_changed():
+    touch(GLOBAL_STAMP_KEY, LIST_STAMP_KEY)
+
+
+def user_changed(user_id):
+    touch(USER_STAMP_KEY.format(user_id))
+
+
+def model_changed(model):
+    touch(MODEL_STAMP_KEY.format(model._meta.label_lower))
+
+
+def _request_hash(request):
+    return hashlib.md5(request.build_absolute_uri().encode('utf-8')).hexdigest()
+
+
+def list_key(request):
+    stamp, = get_stamps(LIST_STAMP_KEY)
+    return 'recipes:list:{!r}:{}'.format(stamp, _request_hash(request))
+
+
+def recipe_key(request, pk):
+    stamps = get_stamps(GLOBAL_STAMP_KEY, RECIPE_STAMP_KEY.format(pk))
+    return 'recipes:detail:{}:{!r}:{!r}:{}'.format(pk, stamps[0], stamps[1], _request_hash(request))
+
+
+def load(key):
+    return cache.get(key)
+
+
+def store(key, data):
+    cache.set(key, data, settings.RECIPE_CACHE_TIMEOUT)
+
+
+def fetch(key, compute, alias=None):
+    """
+    The cached data of key, else compute() stored under it. Data read from the replica alias may predate the
+    write that bumped the stamps in key, so it is only stored under a key of that replica for
+    REPLICA_CACHE_TIMEOUT.
+    """
+    data = load(key)
+    if data is not None:
+        return data
+    if alias is None:
+        data = compute()
+        store(key, data)
+        return data
+    replica_key = '{}:{}'.format(key, alias)
+    data = load(replica_key)
+    if data is None:
+        data = compute()
+        cache.set(replica_key, data, settings.REPLICA_CACHE_TIMEOUT)
+    return data
@@ -0,0 +1,52 @@
+import hashlib
+import math
+import time
+
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from api import cache as response_cache
+
+
+class ConditionalGetMixin(object):
+    """
+    Answers list/retrieve with 304 Not Modified while the client's ETag / Last-Modified still match.
+    The validators come from modification stamps (get_validator), never from serializing the body.
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_get(super(ConditionalGetMixin, self).list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_get(super(ConditionalGetMixin, self).retrieve, request, *args, **kwargs)
+
+    def get_validator(self):
+        # (last modification time, parts the representation depends on) or None to skip validation
+        model = self.queryset.model
+        stamp, = response_cache.get_stamps(response_cache.MODEL_STAMP_KEY.format(model._meta.label_lower))
+        return stamp, ()
+
+    def conditional_get(self, handler, request, *args, **kwargs):
+        validator = self.get_validator()
+        if validator is None:
+            return handler(request, *args, **kwargs)
+
+        last_modified, parts = validator
+        digest = hashlib.sha1(repr((last_modified, parts, request.get_full_path(),
+                                    request.META.get('HTTP_ACCEPT'))).encode('utf-8')).hexdigest()
+        etag = quote_etag(digest)
+        # Last-Modified has whole seconds. The stamp is rounded up, and only used once its second is over, since
+        # a later edit in the same second would round to the same value.
+        timestamp = math.ceil(last_modified)
+        if time.time() < timestamp:
+            timestamp = None
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+        response['ETag'] = etag
+        if timestamp is not None:
+            response['Last-Modified'] = http_date(timestamp)
+        patch_vary_headers(response, ('Accept', 'Authorization'))
+        return response
@@ -0,0 +1,42 @@
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+LOCK_ERRORS = ('database is locked', 'database table is locked')
+
+
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    # connection_created receiver. Runs on the raw connection so the pragmas do not count as queries.
+    if connection.vendor != 'sqlite':
+        return
+    for name, value in settings.SQLITE_PRAGMAS.items():
+        connection.connection.execute('PRAGMA {} = {}'.format(name, value))
+
+
+def is_lock_error(error):
+    return isinstance(error, OperationalError) and any(message in str(error) for message in LOCK_ERRORS)
+
+
+def retry_atomic(func, using=DEFAULT_DB_ALIAS, attempts=None):
+    """
+    Returns func() run in transaction.atomic. When SQLite reports the database as locked the transaction is
+    rolled back and func runs again after a jittered pause doubling from WRITE_RETRY_DELAY, at most attempts
+    times (WRITE_RETRY_ATTEMPTS). func is the write unit only: validation and building the response stay
+    outside, and it must not depend on Python state it changed in a failed attempt.
+    Inside an outer transaction only the outer unit could be retried, func runs once.
+    """
+    attempts = attempts or settings.WRITE_RETRY_ATTEMPTS
+    if connections[using].in_atomic_block:
+        with transaction.atomic(using=using):
+            return func()
+    for attempt in range(1, attempts + 1):
+        try:
+            with transaction.atomic(using=using):
+                return func()
+        except OperationalError as e:
+            if attempt == attempts or not is_lock_error(e):
+                raise
+        delay = min(settings.WRITE_RETRY_DELAY * 2 ** (attempt - 1), settings.WRITE_RETRY_MAX_DELAY)
+        time.sleep(delay * random.uniform(0.5, 1.5))
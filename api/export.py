@@ -0,0 +1,81 @@
+import csv
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from api.models import Recipe
+from api.serializers.recipe import RecipeDisplaySerializer
+
+EXPORT_TYPES = ('ndjson', 'csv')
+EXPORT_FIELDS = [field for field in RecipeDisplaySerializer.Meta.fields
+                 if field not in ('comments', 'user_favourite', 'user_rating')]
+# Nested fields are written as JSON in their CSV column
+CSV_COLUMNS = EXPORT_FIELDS + ['updated_at']
+CHUNK_SIZE = 500
+
+
+def parse_updated_since(value):
+    """ISO date or datetime to an aware datetime, ValueError when it is neither."""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        moment = datetime.datetime.combine(day, datetime.time())
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def iter_documents(queryset=None, updated_since=None, chunk_size=None):
+    """
+    Yields recipe documents ordered by id. Recipes are read in keyset chunks of chunk_size, each with its own
+    prefetches, so memory stays bounded by one chunk (QuerySet.iterator() skips prefetch_related).
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    queryset = Recipe.objects.all() if queryset is None else queryset
+    if updated_since is not None:
+        queryset = queryset.filter(updated_at__gte=updated_since)
+    queryset = queryset.for_display(EXPORT_FIELDS).order_by('id')
+    last_id = 0
+    while True:
+        recipes = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        if not recipes:
+            return
+        for recipe, document in zip(recipes, RecipeDisplaySerializer(recipes, many=True, fields=EXPORT_FIELDS).data):
+            document['updated_at'] = recipe.updated_at
+            yield document
+        last_id = recipes[-1].id
+
+
+def ndjson_lines(documents):
+    for document in documents:
+        yield json.dumps(document, cls=DjangoJSONEncoder) + '\n'
+
+
+class _Echo(object):
+    # File-like object handing each CSV row back to the caller instead of buffering it
+    def write(self, value):
+        return value
+
+
+def _csv_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, cls=DjangoJSONEncoder)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def csv_lines(documents):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for document in documents:
+        yield writer.writerow([_csv_value(document[column]) for column in CSV_COLUMNS])
+
+
+def export_lines(export_type, documents):
+    return ndjson_lines(documents) if export_type == 'ndjson' else csv_lines(documents)
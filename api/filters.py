@@ -0,0 +1,107 @@
+from django.db.models import Count, Q
+from rest_framework import serializers
+from rest_framework.filters import BaseFilterBackend
+
+from api import search
+from api.models import Recipe, RecipeIngredient
+
+
+class RecipeSearchFilter(BaseFilterBackend):
+    """?q= full-text search over recipe titles, descriptions, steps, ingredients and categories."""
+    search_param = 'q'
+
+    def filter_queryset(self, request, queryset, view):
+        return search.search(queryset, request.query_params.get(self.search_param))
+
+    @classmethod
+    def is_searching(cls, request):
+        return bool(search.match_expression(request.query_params.get(cls.search_param)))
+
+
+def _id_list(request, param):
+    value = request.query_params.get(param)
+    if not value:
+        return []
+    try:
+        return [int(i) for i in value.split(',') if i]
+    except ValueError:
+        raise serializers.ValidationError({param: ['Expected a comma separated list of ids.']})
+
+
+class RecipeFilter(BaseFilterBackend):
+    """
+    ?category=1,2   in any of the categories
+    ?level=novice   (or 0) any of the comma separated levels
+    ?max_time=30    prepared in at most that many minutes
+    ?include=1,2    contains all of the ingredients
+    ?exclude=3      contains none of the ingredients
+    ?author=5       added by the user
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        categories = _id_list(request, 'category')
+        if categories:
+            queryset = queryset.filter(id__in=Recipe.categories.through.objects
+                                       .filter(category_id__in=categories).values('recipe_id'))
+
+        levels = self.get_levels(request)
+        if levels:
+            queryset = queryset.filter(level__in=levels)
+
+        max_time = request.query_params.get('max_time')
+        if max_time:
+            try:
+                queryset = queryset.filter(preparation_seconds__lte=float(max_time) * 60)
+            except ValueError:
+                raise serializers.ValidationError({'max_time': ['Expected a number of minutes.']})
+
+        for ingredient_id in _id_list(request, 'include'):
+            queryset = queryset.filter(id__in=RecipeIngredient.objects
+                                       .filter(ingredient_id=ingredient_id).values('recipe_id'))
+        excluded = _id_list(request, 'exclude')
+        if excluded:
+            queryset = queryset.exclude(id__in=RecipeIngredient.objects
+                                        .filter(ingredient_id__in=excluded).values('recipe_id'))
+
+        authors = _id_list(request, 'author')
+        if authors:
+            queryset = queryset.filter(user_id__in=authors)
+        return queryset
+
+    @staticmethod
+    def get_levels(request):
+        value = request.query_params.get('level')
+        if not value:
+            return []
+        levels = []
+        for level in value.split(','):
+            for key, name in Recipe.LEVEL_CHOICES:
+                if level == name or level == str(key):
+                    levels.append(key)
+                    break
+            else:
+                raise serializers.ValidationError({'level': ['"{}" is not a valid choice.'.format(level)]})
+        return levels
+
+
+# Upper bounds, in minutes, of the preparation time facet
+PREPARATION_TIME_FACETS = (15, 30, 60, 120)
+
+
+def facet_counts(queryset):
+    """Counts of the filtered recipes per level, category and preparation time, from grouped queries."""
+    queryset = queryset.order_by()
+    levels = dict(Recipe.LEVEL_CHOICES)
+    level_counts = queryset.values('level').annotate(count=Count('id')).order_by('level')
+    category_counts = Recipe.categories.through.objects.filter(recipe_id__in=queryset.values('id')) \
+        .values('category_id', 'category__name').annotate(count=Count('recipe_id')).order_by('-count', 'category_id')
+    time_counts = queryset.aggregate(**{
+        str(minutes): Count('id', filter=Q(preparation_seconds__lte=minutes * 60))
+        for minutes in PREPARATION_TIME_FACETS
+    })
+    return {
+        'level': [{'value': levels[row['level']], 'count': row['count']} for row in level_counts],
+        'categories': [{'id': row['category_id'], 'name': row['category__name'], 'count': row['count']}
+                       for row in category_counts],
+        'max_time': [{'minutes': minutes, 'count': time_counts[str(minutes)]} for minutes in PREPARATION_TIME_FACETS],
+    }
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+# Images are stored once per content: originals/<2 hex>/<sha256>.<ext>, with resized copies in
+# variants/<sha256>/<variant>.<format>, both under settings.IMAGES_ROOT.
+ORIGINALS_DIR = 'originals'
+VARIANTS_DIR = 'variants'
+# Longest edge in pixels
+VARIANTS = {
+    'thumbnail': 160,
+    'card': 640,
+    'full': 1920,
+}
+VARIANT_FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'GIF': 'gif'}
+CHUNK_SIZE = 64 * 1024
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class InvalidImage(Exception):
+    pass
+
+
+def original_path(digest, extension):
+    return os.path.join(ORIGINALS_DIR, digest[:2], '{}.{}'.format(digest, extension))
+
+
+def variant_path(digest, variant, image_format):
+    return os.path.join(VARIANTS_DIR, digest, '{}.{}'.format(variant, image_format))
+
+
+def url(path):
+    return settings.IMAGES_URL + path.replace(os.sep, '/')
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def image_extension(path):
+    """Extension of the stored original of an image file, InvalidImage when it is not a supported image."""
+    try:
+        with Image.open(path) as image:
+            image_format = image.format
+            image.verify()
+    except Exception:
+        raise InvalidImage('The file is not a valid image!')
+    if image_format not in EXTENSIONS:
+        raise InvalidImage('Only {} images are supported!'.format(', '.join(EXTENSIONS)))
+    return EXTENSIONS[image_format]
+
+
+def store(chunks):
+    """
+    Writes an uploaded image (an iterable of byte chunks) under its sha256 unless the same content is
+    already stored, schedules its variants and returns (digest, path relative to IMAGES_ROOT).
+    """
+    root = settings.IMAGES_ROOT
+    os.makedirs(os.path.join(root, ORIGINALS_DIR), exist_ok=True)
+    sha256 = hashlib.sha256()
+    size = 0
+    fd, temporary = tempfile.mkstemp(dir=os.path.join(root, ORIGINALS_DIR), suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > settings.IMAGE_MAX_UPLOAD_SIZE:
+                    raise InvalidImage('Images can have at most {} bytes!'.format(settings.IMAGE_MAX_UPLOAD_SIZE))
+                sha256.update(chunk)
+                f.write(chunk)
+        extension = image_extension(temporary)
+        digest = sha256.hexdigest()
+        path = original_path(digest, extension)
+        if os.path.exists(os.path.join(root, path)):
+            os.remove(temporary)
+        else:
+            os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+            os.replace(temporary, os.path.join(root, path))
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+    schedule_variants(digest, path)
+    return digest, path
+
+
+def generate_variants(digest, path):
+    """Writes the missing variants of an original, each one atomically."""
+    root = settings.IMAGES_ROOT
+    missing = [(variant, edge, image_format) for variant, edge in VARIANTS.items() for image_format in VARIANT_FORMATS
+               if not os.path.exists(os.path.join(root, variant_path(digest, variant, image_format)))]
+    if not missing:
+        return
+    os.makedirs(os.path.join(root, VARIANTS_DIR, digest), exist_ok=True)
+    with Image.open(os.path.join(root, path)) as original:
+        # Lets the JPEG decoder downscale while decoding, nothing here needs more than the largest variant
+        original.draft('RGB', (max(VARIANTS.values()),) * 2)
+        source = ImageOps.exif_transpose(original).convert('RGB')
+    for variant, edge, image_format in sorted(missing, key=lambda m: -m[1]):
+        image = source.copy()
+        image.thumbnail((edge, edge), Image.LANCZOS)
+        pillow_format, options = VARIANT_FORMATS[image_format]
+        target = os.path.join(root, variant_path(digest, variant, image_format))
+        # Unique per worker, two uploads of the same content may race
+        temporary = '{}.{}-{}.tmp'.format(target, os.getpid(), threading.get_ident())
+        image.save(temporary, pillow_format, **options)
+        os.replace(temporary, target)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS, thread_name_prefix='image-variants')
+        return _executor
+
+
+def schedule_variants(digest, path):
+    # Pillow releases the GIL while resizing and encoding, so threads keep the variants off the request.
+    # IMAGE_WORKERS = 0 generates them inline.
+    if settings.IMAGE_WORKERS:
+        return _get_executor().submit(generate_variants, digest, path)
+    generate_variants(digest, path)
+
+
+def variant_urls(image_url):
+    """{variant: {format: url}} of a content-addressed image URL, None for any other URL."""
+    if not image_url or settings.IMAGES_URL + ORIGINALS_DIR + '/' not in image_url:
+        return None
+    digest = os.path.splitext(image_url.rsplit('/', 1)[-1])[0]
+    return {variant: {image_format: url(variant_path(digest, variant, image_format))
+                      for image_format in VARIANT_FORMATS}
+            for variant in VARIANTS}
@@ -0,0 +1,129 @@
+import json
+
+from django.db import IntegrityError, transaction
+
+from api.models import Category, Ingredient, Recipe, RecipeIngredient, Step, Unit
+from api.serializers.recipe import RecipeImportSerializer
+from api.signals import bulk_recipes_changed
+
+
+class ImportCatalogue(object):
+    """Ingredients, units, allowed units and categories of an import, loaded once in a few queries."""
+
+    def __init__(self):
+        self.categories = self._lookup(Category.objects.values_list('id', 'name'))
+        self.ingredients = self._lookup(Ingredient.objects.values_list('id', 'name'))
+        units = list(Unit.objects.values_list('id', 'short', 'full'))
+        self.units = self._lookup([(unit_id, short) for unit_id, short, _ in units] +
+                                  [(unit_id, full) for unit_id, _, full in units])
+        self.unit_names = {unit_id: {'short': short, 'full': full} for unit_id, short, full in units}
+        self.allowed_units = {}
+        for ingredient_id, unit_id in Ingredient.allowedUnits.through.objects.values_list('ingredient_id',
+                                                                                          'unit_id'):
+            self.allowed_units.setdefault(ingredient_id, []).append(unit_id)
+
+    @staticmethod
+    def _lookup(rows):
+        # Both the id and the name of an object resolve to its id, ids win over names
+        lookup = {}
+        for object_id, name in rows:
+            lookup.setdefault(name, object_id)
+        for object_id, _ in rows:
+            lookup[str(object_id)] = object_id
+        return lookup
+
+
+class RecipeImporter(object):
+    """
+    Imports NDJSON recipes (one RecipeImportSerializer object per line) in chunks, each validated against an
+    ImportCatalogue and written with bulk_create in its own transaction. Rows that fail are collected in
+    `errors` as (line number, errors) and skipped.
+    """
+
+    def __init__(self, user=None, chunk_size=500):
+        self.user = user
+        self.chunk_size = chunk_size
+        self.catalogue = ImportCatalogue()
+        self.imported = 0
+        self.errors = []
+
+    def run(self, lines, first_line=1, on_chunk=None):
+        """Imports lines (str or bytes); on_chunk(line number) is called after every committed chunk."""
+        chunk = []
+        number = first_line - 1
+        for number, line in enumerate(lines, first_line):
+            data = self.parse(number, line)
+            if data is not None:
+                chunk.append((number, data))
+            if len(chunk) >= self.chunk_size:
+                self.write(chunk)
+                chunk = []
+                if on_chunk is not None:
+                    on_chunk(number)
+        if chunk:
+            self.write(chunk)
+        if on_chunk is not None:
+            on_chunk(number)
+
+    def parse(self, number, line):
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            return None
+        try:
+            data = json.loads(line)
+        except ValueError as e:
+            self.errors.append((number, {'non_field_errors': ['Invalid JSON: {}'.format(e)]}))
+            return None
+        serializer = RecipeImportSerializer(data=data, context={'catalogue': self.catalogue})
+        if not serializer.is_valid():
+            self.errors.append((number, serializer.errors))
+            return None
+        return serializer.validated_data
+
+    def write(self, chunk):
+        existing = set(Recipe.objects.filter(title__in=[data['title'] for _, data in chunk])
+                       .values_list('title', flat=True))
+        rows = []
+        for number, data in chunk:
+            if data['title'] in existing:
+                self.errors.append((number, {'title': ['recipe with this title already exists.']}))
+            else:
+                existing.add(data['title'])
+                rows.append((number, data))
+        if not rows:
+            return
+
+        try:
+            with transaction.atomic():
+                recipes = [self.build(data) for _, data in rows]
+                Recipe.objects.bulk_create(recipes)
+                if any(recipe.pk is None for recipe in recipes):
+                    # Backends that cannot return the ids of a bulk insert (SQLite on this Django)
+                    ids = dict(Recipe.objects.filter(title__in=[recipe.title for recipe in recipes])
+                               .values_list('title', 'id'))
+                    for recipe in recipes:
+                        recipe.pk = ids[recipe.title]
+
+                Through = Recipe.categories.through
+                Through.objects.bulk_create([Through(recipe_id=recipe.pk, category_id=category_id)
+                                             for recipe, (_, data) in zip(recipes, rows)
+                                             for category_id in data['categories']])
+                Step.objects.bulk_create([Step(recipe_id=recipe.pk, **step)
+                                          for recipe, (_, data) in zip(recipes, rows) for step in data['steps']])
+                RecipeIngredient.objects.bulk_create([RecipeIngredient(recipe_id=recipe.pk, **ingredient)
+                                                      for recipe, (_, data) in zip(recipes, rows)
+                                                      for ingredient in data['ingredients']])
+                bulk_recipes_changed([recipe.pk for recipe in recipes])
+        except IntegrityError as e:
+            # e.g. a title taken concurrently, the whole chunk was rolled back
+            self.errors.extend((number, {'non_field_errors': [str(e)]}) for number, _ in rows)
+            return
+        self.imported += len(recipes)
+
+    def build(self, data):
+        recipe = Recipe(user=self.user, **{name: value for name, value in data.items()
+                                           if name not in ('categories', 'steps', 'ingredients')})
+        # bulk_create skips Recipe.save
+        recipe.set_preparation_seconds()
+        return recipe
@@ -0,0 +1,77 @@
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from api.db import retry_atomic
+from api.models import Favorite, Rating, Recipe, RecipeScore
+
+BATCH_SIZE = 1000
+
+
+def top_rated_scores():
+    """
+    {recipe id: Bayesian average} of the rated recipes: their ratings plus LEADERBOARD_PRIOR_RATINGS ratings
+    of the overall mean, so a single 5 star rating does not beat many good ones.
+    """
+    rows = list(Recipe.objects.filter(rating_count__gt=0).order_by().values_list('id', 'rating_count', 'rating_sum'))
+    if not rows:
+        return {}
+    ids, counts, sums = (np.array(column, dtype=np.float64) for column in zip(*rows))
+    prior = settings.LEADERBOARD_PRIOR_RATINGS
+    mean = sums.sum() / counts.sum()
+    scores = (sums + prior * mean) / (counts + prior)
+    return dict(zip(ids.astype(np.int64).tolist(), scores.round(6).tolist()))
+
+
+def trending_scores(now):
+    """
+    {recipe id: recent activity}, every rating (stars / 5) and favourite (LEADERBOARD_FAVOURITE_WEIGHT) of the
+    last LEADERBOARD_TRENDING_WINDOW halving in weight every LEADERBOARD_TRENDING_HALF_LIFE. Ratings and
+    favourites without a created_at are older than the field and left out.
+    """
+    since = now - settings.LEADERBOARD_TRENDING_WINDOW
+    ratings = list(Rating.objects.filter(created_at__gte=since).order_by().values_list('recipe_id', 'created_at',
+                                                                                       'stars'))
+    favourites = list(Favorite.objects.filter(created_at__gte=since).order_by().values_list('recipe_id',
+                                                                                            'created_at'))
+    rows = [(recipe_id, created_at, stars / 5) for recipe_id, created_at, stars in ratings] + \
+        [(recipe_id, created_at, settings.LEADERBOARD_FAVOURITE_WEIGHT) for recipe_id, created_at in favourites]
+    if not rows:
+        return {}
+    recipe, created_at, weight = zip(*rows)
+    age = np.array([(now - moment).total_seconds() for moment in created_at], dtype=np.float64)
+    half_lives = age / settings.LEADERBOARD_TRENDING_HALF_LIFE.total_seconds()
+    decayed = np.array(weight, dtype=np.float64) * 0.5 ** half_lives
+    slots, inverse = np.unique(np.array(recipe, dtype=np.int64), return_inverse=True)
+    return dict(zip(slots.tolist(), np.bincount(inverse, weights=decayed).round(6).tolist()))
+
+
+def ranked(board, category_id, scores, recipe_ids, now):
+    best = sorted(recipe_ids, key=lambda recipe_id: (-scores[recipe_id], recipe_id))[:settings.LEADERBOARD_SIZE]
+    return [RecipeScore(board=board, category_id=category_id, rank=rank, recipe_id=recipe_id,
+                        score=scores[recipe_id], refreshed_at=now) for rank, recipe_id in enumerate(best, 1)]
+
+
+def refresh(now=None):
+    """
+    Recomputes the boards over all recipes and per category and replaces the stored ones in one transaction,
+    so readers see either the old or the new boards. Returns {board: entries written}.
+    """
+    now = now or timezone.now()
+    boards = {RecipeScore.TOP: top_rated_scores(), RecipeScore.TRENDING: trending_scores(now)}
+    members = {}
+    for recipe_id, category_id in Recipe.categories.through.objects.order_by().values_list('recipe_id',
+                                                                                           'category_id'):
+        members.setdefault(category_id, []).append(recipe_id)
+
+    entries = []
+    for board, scores in boards.items():
+        entries += ranked(board, None, scores, scores, now)
+        for category_id, recipe_ids in members.items():
+            entries += ranked(board, category_id, scores, [i for i in recipe_ids if i in scores], now)
+
+    def replace():
+        RecipeScore.objects.all().delete()
+        RecipeScore.objects.bulk_create(entries, batch_size=BATCH_SIZE)
+    retry_atomic(replace)
+    return {board: sum(entry.board == board for entry in entries) for board in boards}
@@ -0,0 +1,172 @@
+import json
+import random
+import re
+import time
+
+import numpy as np
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.management.commands.seed_bench import PREFIX, zipf
+from api.models import Category, Ingredient, Recipe, User
+
+SERVER_TIMING_QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def scenarios(rng, requests_count, exponent):
+    """{name: (method, paths, authenticated)}, the recipes and ingredients asked for follow a Zipf popularity."""
+    recipe_ids = list(Recipe.objects.order_by('id').values_list('id', flat=True))
+    ingredient_ids = list(Ingredient.objects.order_by('id').values_list('id', flat=True))
+    category_ids = list(Category.objects.order_by('id').values_list('id', flat=True))
+    if not recipe_ids or not ingredient_ids:
+        raise CommandError('There are no recipes to benchmark, run seed_bench first.')
+
+    def pantry_path(_):
+        ids = sorted(set(zipf(rng, ingredient_ids, 6, exponent)))
+        return '/api/recipes/pantry/?ingredients={}'.format(','.join(map(str, ids)))
+
+    def filter_path(_):
+        return '/api/recipes/?category={}&max_time={}'.format(rng.choice(category_ids), rng.choice((15, 30, 60)))
+
+    words = ('apple', 'chicken', 'tomato', 'garlic', 'lemon', 'rice', 'soup', 'cake')
+    popular = zipf(rng, recipe_ids, requests_count, exponent)
+    return {
+        'recipes.list': ('get', lambda _: '/api/recipes/', False),
+        'recipes.list.authenticated': ('get', lambda _: '/api/recipes/', True),
+        'recipes.retrieve': ('get', lambda i: '/api/recipes/{}/'.format(popular[i]), False),
+        'recipes.retrieve.authenticated': ('get', lambda i: '/api/recipes/{}/'.format(popular[i]), True),
+        'recipes.search': ('get', lambda _: '/api/recipes/?q={}'.format(rng.choice(words)), True),
+        'recipes.filter': ('get', filter_path, True),
+        'recipes.pantry': ('get', pantry_path, True),
+        'recipes.top': ('get', lambda _: '/api/recipes/top/?category={}'.format(rng.choice(category_ids)), False),
+        'ingredients.list': ('get', lambda _: '/api/ingredients/', False),
+        'categories.list': ('get', lambda _: '/api/categories/', False),
+        'users.me.favourites': ('get', lambda _: '/api/users/me/favourites/', True),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Drives the API routes through the Django test client (or a running server with --base-url) and ' \
+           'writes p50/p95/p99 latency, throughput and query counts per endpoint to a JSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint.')
+        parser.add_argument('--warmup', type=int, default=20, help='Unmeasured requests per endpoint.')
+        parser.add_argument('--endpoint', action='append', help='Only these endpoints, can be repeated.')
+        parser.add_argument('--base-url', help='A running server, e.g. http://localhost:8000. Query counts come '
+                                               'from its Server-Timing headers.')
+        parser.add_argument('--exponent', type=float, default=1.1)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default='bench.json')
+        parser.add_argument('--compare', help='An earlier output to compare with.')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('--requests has to be at least 1.')
+        rng = random.Random(options['seed'])
+        total = options['warmup'] + options['requests']
+        selected = scenarios(rng, total, options['exponent'])
+        if options['endpoint']:
+            unknown = set(options['endpoint']) - set(selected)
+            if unknown:
+                raise CommandError('Unknown endpoint(s) {}, choose from {}.'.format(
+                    ', '.join(sorted(unknown)), ', '.join(selected)))
+            selected = {name: selected[name] for name in options['endpoint']}
+
+        # A bench user, or any staff user so a server sends Server-Timing headers
+        user = User.objects.filter(is_staff=True).order_by('id').first() if options['base_url'] else None
+        user = user or User.objects.filter(username__startswith=PREFIX + '-').order_by('id').first() or \
+            User.objects.order_by('id').first()
+        if user is None:
+            raise CommandError('There are no users to authenticate as, run seed_bench first.')
+        authorization = 'Bearer {}'.format(AccessToken.for_user(user))
+        send = self.http_sender(options['base_url']) if options['base_url'] else self.client_sender()
+
+        endpoints = {}
+        for name, (method, path, authenticated) in selected.items():
+            headers = {'HTTP_AUTHORIZATION': authorization} if authenticated else {}
+            durations, queries, errors = [], [], 0
+            started = time.perf_counter()
+            for i in range(total):
+                if i == options['warmup']:
+                    started = time.perf_counter()
+                start = time.perf_counter()
+                status, count = send(method, path(i), headers)
+                if i < options['warmup']:
+                    continue
+                durations.append(time.perf_counter() - start)
+                errors += status >= 400
+                if count is not None:
+                    queries.append(count)
+            endpoints[name] = self.summary(durations, queries, errors, time.perf_counter() - started)
+            self.stdout.write('{:32} p50 {p50_ms:8.2f} ms  p95 {p95_ms:8.2f} ms  p99 {p99_ms:8.2f} ms  '
+                              '{throughput_rps:8.1f} req/s  {queries_p50} queries'.format(name, **endpoints[name]))
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'target': options['base_url'] or 'test client',
+            'requests': options['requests'],
+            'warmup': options['warmup'],
+            'seed': options['seed'],
+            'recipes': Recipe.objects.count(),
+            'endpoints': endpoints,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        self.stdout.write(self.style.SUCCESS('Wrote {}.'.format(options['output'])))
+        if options['compare']:
+            self.compare(options['compare'], report)
+
+    def client_sender(self):
+        # Query counts come from MetricsMiddleware. localhost is allowed by DEBUG with empty ALLOWED_HOSTS.
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        client = Client(SERVER_NAME=host)
+
+        def send(method, path, headers):
+            response = getattr(client, method)(path, **headers)
+            metrics = getattr(response, 'metrics', None)
+            return response.status_code, metrics.queries if metrics is not None else None
+        return send
+
+    def http_sender(self, base_url):
+        session = requests.Session()
+
+        def send(method, path, headers):
+            response = session.request(method, base_url.rstrip('/') + path,
+                                       headers={'Authorization': headers['HTTP_AUTHORIZATION']} if headers else {})
+            match = SERVER_TIMING_QUERIES.search(response.headers.get('Server-Timing', ''))
+            return response.status_code, int(match.group(1)) if match else None
+        return send
+
+    @staticmethod
+    def summary(durations, queries, errors, elapsed):
+        milliseconds = np.array(durations) * 1000
+        p50, p95, p99 = np.percentile(milliseconds, [50, 95, 99])
+        return {
+            'requests': len(durations),
+            'errors': errors,
+            'p50_ms': round(float(p50), 3),
+            'p95_ms': round(float(p95), 3),
+            'p99_ms': round(float(p99), 3),
+            'mean_ms': round(float(milliseconds.mean()), 3),
+            'throughput_rps': round(len(durations) / elapsed, 1),
+            'queries_p50': int(np.median(queries)) if queries else None,
+            'queries_max': max(queries) if queries else None,
+        }
+
+    def compare(self, path, report):
+        with open(path) as f:
+            previous = json.load(f)['endpoints']
+        self.stdout.write('\n{:32} {:>20} {:>10} {:>12}'.format('endpoint', 'p95 ms', 'change', 'queries'))
+        for name, current in report['endpoints'].items():
+            if name not in previous:
+                continue
+            before = previous[name]
+            change = (current['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100 if before['p95_ms'] else 0
+            self.stdout.write('{:32} {:>9.2f} -> {:>7.2f} {:>+9.1f}% {:>5} -> {:<5}'.format(
+                name, before['p95_ms'], current['p95_ms'], change, str(before['queries_p50']),
+                str(current['queries_p50'])))
@@ -0,0 +1,121 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.http.request import split_domain_port, validate_host
+
+from api import cache as response_cache, images
+from api.models import Ingredient, Recipe, Step
+from api.signals import bulk_recipes_changed
+
+
+class Command(BaseCommand):
+    help = 'Moves the images in IMAGES_ROOT into the content-addressed store, keeping one copy of identical ' \
+           'files, points the imageUrl fields at the stored copies and generates the missing variants.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would change.')
+
+    def handle(self, *args, **options):
+        root = settings.IMAGES_ROOT
+        dry_run = options['dry_run']
+
+        # content hash -> file names
+        groups = {}
+        extensions = {}
+        for name in sorted(os.listdir(root)):
+            path = os.path.join(root, name)
+            if not os.path.isfile(path):
+                continue
+            try:
+                extension = images.image_extension(path)
+            except images.InvalidImage:
+                self.stderr.write('Skipping {}, not a supported image.'.format(name))
+                continue
+            digest = images.file_digest(path)
+            groups.setdefault(digest, []).append(name)
+            extensions[digest] = extension
+
+        duplicates = sum(len(names) - 1 for names in groups.values())
+        reclaimed = sum(os.path.getsize(os.path.join(root, name)) for names in groups.values() for name in names[1:])
+        self.stdout.write('{} file(s), {} distinct, {} duplicate(s) taking {:.1f} MB.'.format(
+            sum(len(names) for names in groups.values()), len(groups), duplicates, reclaimed / 1024 / 1024))
+
+        # The stored copies are written first and the old names removed only after the imageUrl fields point
+        # at the copies, so an interrupted run leaves every url working and can be run again
+        renamed = {}
+        for digest, names in groups.items():
+            path = images.original_path(digest, extensions[digest])
+            for name in names:
+                renamed[name] = images.url(path)
+            if dry_run:
+                continue
+            target = os.path.join(root, path)
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                self.copy(os.path.join(root, names[0]), target)
+        rewritten = self.rewrite_urls(renamed, dry_run)
+        self.stdout.write('{} imageUrl field(s) {}.'.format(rewritten, 'to rewrite' if dry_run else 'rewritten'))
+        if dry_run:
+            return
+        for name in renamed:
+            os.remove(os.path.join(root, name))
+
+        with ThreadPoolExecutor(max_workers=settings.IMAGE_WORKERS or 1) as executor:
+            list(executor.map(lambda digest: images.generate_variants(digest, images.original_path(
+                digest, extensions[digest])), groups))
+        self.stdout.write(self.style.SUCCESS('Stored {} image(s), removed {} duplicate(s).'.format(
+            len(groups), duplicates)))
+
+    @staticmethod
+    def copy(source, target):
+        # A hard link where the file system allows it, written under a temporary name so the target is complete
+        temporary = target + '.tmp'
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        try:
+            os.link(source, temporary)
+        except OSError:
+            shutil.copyfile(source, temporary)
+        os.replace(temporary, target)
+
+    @staticmethod
+    def file_name(image_url):
+        """The name of a file directly in IMAGES_ROOT the url points at, None for other urls."""
+        if '/' not in image_url:
+            return image_url
+        url = urlsplit(image_url)
+        if url.netloc:
+            host, _ = split_domain_port(url.netloc)
+            # This site's hosts, the local ones of development included
+            if not validate_host(host, list(settings.ALLOWED_HOSTS) + ['.localhost', '127.0.0.1', '[::1]']):
+                return None
+        if not url.path.startswith(settings.IMAGES_URL):
+            return None
+        name = url.path[len(settings.IMAGES_URL):]
+        return name if name and '/' not in name else None
+
+    def rewrite_urls(self, renamed, dry_run):
+        # imageUrl values naming an old file, bare or as a url of IMAGES_URL on this site
+        changed = {}
+        for model in (Recipe, Step, Ingredient):
+            for instance in model.objects.exclude(imageUrl__isnull=True).exclude(imageUrl='').only('id', 'imageUrl'):
+                name = self.file_name(instance.imageUrl)
+                if name in renamed:
+                    instance.imageUrl = renamed[name]
+                    changed.setdefault(model, []).append(instance)
+        if not dry_run and changed:
+            with transaction.atomic():
+                for model, instances in changed.items():
+                    model.objects.bulk_update(instances, ['imageUrl'], batch_size=500)
+                recipe_ids = [recipe.id for recipe in changed.get(Recipe, [])] + \
+                    [step.recipe_id for step in Step.objects.filter(pk__in=[s.id for s in changed.get(Step, [])])]
+                if recipe_ids:
+                    bulk_recipes_changed(recipe_ids)
+                if Ingredient in changed:
+                    response_cache.model_changed(Ingredient)
+        return sum(len(instances) for instances in changed.values())
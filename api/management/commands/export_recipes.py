@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import export
+
+
+class Command(BaseCommand):
+    help = 'Streams the recipe catalogue as NDJSON or CSV to a file or stdout.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', choices=export.EXPORT_TYPES, default='ndjson')
+        parser.add_argument('--updated-since', help='Only recipes modified since this ISO date or datetime.')
+        parser.add_argument('--output', help='File to write to, stdout by default.')
+        parser.add_argument('--chunk-size', type=int)
+
+    def handle(self, *args, **options):
+        updated_since = None
+        if options['updated_since']:
+            try:
+                updated_since = export.parse_updated_since(options['updated_since'])
+            except ValueError:
+                raise CommandError('--updated-since has to be an ISO date or datetime!')
+
+        documents = export.iter_documents(updated_since=updated_since, chunk_size=options['chunk_size'])
+        lines = export.export_lines(options['type'], documents)
+        if options['output']:
+            with open(options['output'], 'w', newline='') as f:
+                f.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
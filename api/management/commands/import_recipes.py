@@ -0,0 +1,59 @@
+import itertools
+import json
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.importer import RecipeImporter
+from api.models import User
+
+
+class Command(BaseCommand):
+    help = 'Imports recipes from an NDJSON file (one recipe per line, "-" for stdin). With --checkpoint an ' \
+           'interrupted import resumes after the last committed chunk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--user', help='Email of the user the recipes belong to.')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--checkpoint', help='File keeping the number of the last imported line.')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            try:
+                user = User.objects.get(email=options['user'])
+            except User.DoesNotExist:
+                raise CommandError('User with email={} does not exist!'.format(options['user']))
+
+        checkpoint = options['checkpoint']
+        done = 0
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                done = json.load(f)['line']
+            self.stdout.write('Resuming after line {}.'.format(done))
+
+        def save_checkpoint(line):
+            self.stdout.write('Committed up to line {}, {} recipe(s) imported.'.format(line, importer.imported))
+            if checkpoint:
+                with open(checkpoint + '.tmp', 'w') as f:
+                    json.dump({'line': line}, f)
+                os.replace(checkpoint + '.tmp', checkpoint)
+
+        importer = RecipeImporter(user=user, chunk_size=options['chunk_size'])
+        f = sys.stdin.buffer if options['path'] == '-' else open(options['path'], 'rb')
+        started = time.monotonic()
+        try:
+            importer.run(itertools.islice(f, done, None), first_line=done + 1, on_chunk=save_checkpoint)
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+        elapsed = time.monotonic() - started
+
+        for line, errors in importer.errors:
+            self.stderr.write('Line {}: {}'.format(line, json.dumps(errors)))
+        self.stdout.write(self.style.SUCCESS('Imported {} recipe(s) in {:.1f}s ({:.0f} recipes/s), {} row(s) failed.'
+                                             .format(importer.imported, elapsed, importer.imported / max(elapsed, 1e-6),
+                                                     len(importer.errors))))
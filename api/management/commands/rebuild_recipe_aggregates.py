@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from api import cache as response_cache, nutrition
+from api.models import Comment, Rating, Recipe
+from api.signals import invalidate_recipes
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the rating aggregates, active comment counts, calories and normalized preparation time ' \
+           'stored on recipes and reports the ones that drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report drift, do not fix it.')
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            Recipe.objects.normalize_preparation_time()
+
+        totals = {}
+        for row in Rating.objects.values('recipe').annotate(count=Count('id'), total=Sum('stars')).order_by():
+            totals[row['recipe']] = (row['count'], row['total'])
+        comments = dict(Comment.objects.filter(isActive=True).values('recipe').annotate(count=Count('id'))
+                        .values_list('recipe', 'count').order_by())
+
+        drifted = []
+        for recipe in Recipe.objects.only('id', 'title', 'rating_count', 'rating_sum', 'comment_count').iterator():
+            count, total = totals.get(recipe.id, (0, 0))
+            comment_count = comments.get(recipe.id, 0)
+            if (recipe.rating_count, recipe.rating_sum, recipe.comment_count) != (count, total, comment_count):
+                self.stdout.write('Recipe id = {} ({}): stored {}/{} and {} comments, actual {}/{} and {}'.format(
+                    recipe.id, recipe.title, recipe.rating_count, recipe.rating_sum, recipe.comment_count,
+                    count, total, comment_count))
+                recipe.rating_count = count
+                recipe.rating_sum = total
+                recipe.comment_count = comment_count
+                drifted.append(recipe)
+
+        stale_kcal = nutrition.update_kcal(save=not options['check'])
+        if stale_kcal:
+            self.stdout.write('Calories of {} recipe(s) were stale.'.format(len(stale_kcal)))
+            if not options['check']:
+                response_cache.recipes_changed(stale_kcal)
+
+        if not drifted:
+            self.stdout.write(self.style.SUCCESS('Rating aggregates and comment counts are in sync.'))
+        elif not options['check']:
+            # updated_at and the stamps move too, so cached documents and validators stop serving the drift
+            now = timezone.now()
+            for recipe in drifted:
+                recipe.updated_at = now
+            with transaction.atomic():
+                Recipe.objects.bulk_update(drifted, ['rating_count', 'rating_sum', 'comment_count', 'updated_at'],
+                                           batch_size=options['batch_size'])
+                invalidate_recipes([recipe.id for recipe in drifted])
+            self.stdout.write(self.style.SUCCESS('Rebuilt aggregates of {} recipe(s).'.format(len(drifted))))
+
+        if options['check'] and (drifted or stale_kcal):
+            raise CommandError('{} recipe(s) have drifted aggregates and {} stale calories.'.format(
+                len(drifted), len(stale_kcal)))
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of recipes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if not search.is_supported(options['database']):
+            raise CommandError('Full-text search needs an SQLite database with FTS5.')
+        started = time.monotonic()
+        count = search.rebuild_index(options['database'])
+        self.stdout.write(self.style.SUCCESS('Indexed {} recipe(s) in {:.1f}s.'.format(count,
+                                                                                   time.monotonic() - started)))
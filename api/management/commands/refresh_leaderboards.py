@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from api import leaderboards
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the top rated and trending leaderboards served by /api/recipes/top/, once or every ' \
+           '--every seconds.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--every', type=float, help='Keep running, refreshing at this interval in seconds.')
+
+    def handle(self, *args, **options):
+        if options['every'] is not None and options['every'] <= 0:
+            raise CommandError('--every has to be a positive number of seconds.')
+        while True:
+            started = time.monotonic()
+            written = leaderboards.refresh()
+            self.stdout.write(self.style.SUCCESS('Refreshed leaderboards in {:.2f} s: {}.'.format(
+                time.monotonic() - started,
+                ', '.join('{} {} entries'.format(count, board) for board, count in written.items()))))
+            if options['every'] is None:
+                return
+            # Do not hold a connection while sleeping
+            connections.close_all()
+            time.sleep(max(0.0, options['every'] - (time.monotonic() - started)))
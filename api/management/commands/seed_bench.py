@@ -0,0 +1,181 @@
+import itertools
+import random
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import Category, Comment, Favorite, Ingredient, Rating, Recipe, RecipeIngredient, Step, Unit, User
+from api.signals import bulk_recipe_changes, bulk_recipes_changed
+
+PREFIX = 'bench'
+PASSWORD = 'Bench123!'
+WORDS = ('apple', 'basil', 'butter', 'carrot', 'cheese', 'chicken', 'chili', 'cinnamon', 'garlic', 'ginger',
+         'honey', 'lemon', 'lentil', 'mushroom', 'noodle', 'onion', 'pepper', 'potato', 'rice', 'salmon',
+         'spinach', 'tomato', 'vanilla', 'walnut', 'yogurt')
+DISHES = ('soup', 'salad', 'stew', 'pie', 'curry', 'risotto', 'bake', 'tart', 'bowl', 'cake')
+# Ratings and favourites are spread over this period, for the trending leaderboard
+HISTORY = timedelta(days=60)
+
+
+def zipf(rng, population, count, exponent):
+    """count picks from population, the i-th most popular with a weight of 1 / i ** exponent."""
+    if not population:
+        return []
+    ranked = list(population)
+    rng.shuffle(ranked)
+    weights = list(itertools.accumulate(1 / rank ** exponent for rank in range(1, len(ranked) + 1)))
+    return rng.choices(ranked, cum_weights=weights, k=count)
+
+
+def text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+class Command(BaseCommand):
+    help = 'Generates a deterministic, skewed data set for benchmarks: users, ingredients, recipes with ' \
+           'steps, ingredients and categories, and Zipf distributed ratings, favourites and comments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--ingredients', type=int, default=300)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--recipes', type=int, default=5000)
+        parser.add_argument('--ratings', type=int, default=50000)
+        parser.add_argument('--favourites', type=int, default=20000)
+        parser.add_argument('--comments', type=int, default=10000)
+        parser.add_argument('--exponent', type=float, default=1.1, help='Zipf exponent of the popularity.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--flush', action='store_true', help='Remove an earlier data set first.')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        batch_size = options['batch_size']
+        if options['flush']:
+            self.flush()
+        elif User.objects.filter(username__startswith=PREFIX + '-').exists() or \
+                Category.objects.filter(name__startswith=PREFIX + ' ').exists():
+            raise CommandError('There is a benchmark data set already, use --flush to replace it.')
+        if not Unit.objects.exists():
+            call_command('loaddata', 'units', verbosity=0)
+        units = list(Unit.objects.order_by('id'))
+
+        with transaction.atomic():
+            users = self.create_users(options['users'], batch_size)
+            categories = self.create_categories(options['categories'], batch_size)
+            ingredients = self.create_ingredients(rng, options['ingredients'], units, batch_size)
+            recipes = self.create_recipes(rng, options, users, categories, ingredients, batch_size)
+            self.create_interactions(rng, options, users, recipes, batch_size)
+            bulk_recipes_changed([recipe.id for recipe in recipes])
+
+        self.stdout.write(self.style.SUCCESS(
+            'Seeded {} users, {} ingredients, {} recipes. The users log in as {}-user-<n>@example.com with '
+            'password {}.'.format(len(users), len(ingredients), len(recipes), PREFIX, PASSWORD)))
+
+    def flush(self):
+        with transaction.atomic(), bulk_recipe_changes():
+            Recipe.objects.filter(title__startswith=PREFIX + ' ').delete()
+            Ingredient.objects.filter(name__startswith=PREFIX + ' ').delete()
+            Category.objects.filter(name__startswith=PREFIX + ' ').delete()
+            User.objects.filter(username__startswith=PREFIX + '-').delete()
+
+    def create_users(self, count, batch_size):
+        # One hash for all of them, hashing is most of the cost of creating a user
+        password = make_password(PASSWORD)
+        names = ['{}-user-{}'.format(PREFIX, i) for i in range(count)]
+        User.objects.bulk_create([User(username=name, email='{}@example.com'.format(name), password=password)
+                                  for name in names], batch_size=batch_size)
+        by_name = User.objects.in_bulk(names, field_name='username')
+        return [by_name[name] for name in names]
+
+    def create_categories(self, count, batch_size):
+        names = ['{} {} {}'.format(PREFIX, DISHES[i % len(DISHES)], i) for i in range(count)]
+        Category.objects.bulk_create([Category(name=name) for name in names], batch_size=batch_size)
+        return list(Category.objects.filter(name__in=names).order_by('id'))
+
+    def create_ingredients(self, rng, count, units, batch_size):
+        names = ['{} {} {}'.format(PREFIX, WORDS[i % len(WORDS)], i) for i in range(count)]
+        Ingredient.objects.bulk_create([
+            Ingredient(name=name, quantity=100, unit=rng.choice(units[:2]), kcal=rng.randint(5, 900))
+            for name in names], batch_size=batch_size)
+        by_name = Ingredient.objects.in_bulk(names, field_name='name')
+        ingredients = [by_name[name] for name in names]
+        Ingredient.allowedUnits.through.objects.bulk_create([
+            Ingredient.allowedUnits.through(ingredient_id=ingredient.id, unit_id=unit.id)
+            for ingredient in ingredients for unit in rng.sample(units, rng.randint(1, len(units)))
+        ], batch_size=batch_size)
+        return ingredients
+
+    def create_recipes(self, rng, options, users, categories, ingredients, batch_size):
+        allowed = {}
+        for ingredient_id, unit_id in Ingredient.allowedUnits.through.objects.filter(
+                ingredient__in=ingredients).order_by('id').values_list('ingredient_id', 'unit_id'):
+            allowed.setdefault(ingredient_id, []).append(unit_id)
+
+        # A few prolific authors write most recipes
+        authors = zipf(rng, users, options['recipes'], options['exponent'])
+        recipes = []
+        for i, author in enumerate(authors):
+            recipe = Recipe(user=author, title='{} {} {} {}'.format(PREFIX, rng.choice(WORDS), rng.choice(DISHES), i),
+                            description=text(rng, rng.randint(10, 60)), imageUrl='',
+                            preparationTime=rng.choice((5, 10, 15, 20, 30, 45, 60, 90)),
+                            preparationTimeUnit=Recipe.MINUTES, level=rng.choice(Recipe.LEVEL_CHOICES)[0])
+            recipe.set_preparation_seconds()
+            recipes.append(recipe)
+        Recipe.objects.bulk_create(recipes, batch_size=batch_size)
+        by_title = Recipe.objects.in_bulk([recipe.title for recipe in recipes], field_name='title')
+        recipes = [by_title[recipe.title] for recipe in recipes]
+
+        popular = zipf(rng, ingredients, options['recipes'] * 12, options['exponent'])
+        through, steps, recipe_ingredients = [], [], []
+        for recipe in recipes:
+            for category in rng.sample(categories, min(len(categories), rng.randint(1, 3))):
+                through.append(Recipe.categories.through(recipe_id=recipe.id, category_id=category.id))
+            for order in range(1, rng.randint(2, 8) + 1):
+                steps.append(Step(recipe_id=recipe.id, order=order, description=text(rng, rng.randint(5, 30))))
+            chosen = set()
+            for _ in range(rng.randint(3, 10)):
+                ingredient = popular.pop()
+                if ingredient.id in chosen:
+                    continue
+                chosen.add(ingredient.id)
+                recipe_ingredients.append(RecipeIngredient(
+                    recipe_id=recipe.id, ingredient_id=ingredient.id, quantity=rng.randint(1, 500),
+                    unit_id=rng.choice(allowed[ingredient.id])))
+        Recipe.categories.through.objects.bulk_create(through, batch_size=batch_size)
+        Step.objects.bulk_create(steps, batch_size=batch_size)
+        RecipeIngredient.objects.bulk_create(recipe_ingredients, batch_size=batch_size)
+        return recipes
+
+    def create_interactions(self, rng, options, users, recipes, batch_size):
+        # Popular recipes collect most of the ratings, favourites and comments, from any user
+        ratings = {}
+        for recipe in zipf(rng, recipes, options['ratings'], options['exponent']):
+            ratings.setdefault((rng.choice(users).id, recipe.id), rng.choices((1, 2, 3, 4, 5), (1, 1, 3, 6, 5))[0])
+        now = timezone.now()
+
+        def created_at():
+            return now - HISTORY * rng.random()
+        Rating.objects.bulk_create([Rating(user_id=user_id, recipe_id=recipe_id, stars=stars, created_at=created_at())
+                                    for (user_id, recipe_id), stars in ratings.items()], batch_size=batch_size)
+        by_id = {recipe.id: recipe for recipe in recipes}
+        for (_, recipe_id), stars in ratings.items():
+            recipe = by_id[recipe_id]
+            recipe.rating_count += 1
+            recipe.rating_sum += stars
+        Recipe.objects.bulk_update(recipes, ['rating_count', 'rating_sum'], batch_size=batch_size)
+
+        favourites = {(rng.choice(users).id, recipe.id)
+                      for recipe in zipf(rng, recipes, options['favourites'], options['exponent'])}
+        Favorite.objects.bulk_create([Favorite(user_id=user_id, recipe_id=recipe_id, created_at=created_at())
+                                      for user_id, recipe_id in sorted(favourites)], batch_size=batch_size)
+
+        Comment.objects.bulk_create([
+            Comment(user=rng.choice(users), recipe=recipe, content=text(rng, rng.randint(3, 40)),
+                    isActive=rng.random() > 0.05)
+            for recipe in zipf(rng, recipes, options['comments'], options['exponent'])], batch_size=batch_size)
+        Recipe.objects.count_comments([recipe.id for recipe in recipes])
@@ -0,0 +1,104 @@
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api.db import is_lock_error
+from api.management.commands.seed_bench import PREFIX, zipf
+from api.models import Recipe, User
+
+# Django's own SQLite setup: rollback journal, no busy timeout beyond the driver's, no retries
+BASELINE = {
+    'SQLITE_PRAGMAS': {'journal_mode': 'DELETE', 'synchronous': 'FULL'},
+    'WRITE_RETRY_ATTEMPTS': 1,
+}
+
+
+class Command(BaseCommand):
+    help = 'Sends concurrent rate, favourite and comment requests from several threads to the benchmark data ' \
+           'set (see seed_bench) and reports lock errors and throughput. Writes to the configured database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--operations', type=int, default=100, help='Requests per thread.')
+        parser.add_argument('--baseline', action='store_true',
+                            help='Only run with the rollback journal and without retries.')
+        parser.add_argument('--compare', action='store_true', help='Run the baseline first, then the settings.')
+        parser.add_argument('--exponent', type=float, default=1.1, help='Zipf exponent of the recipe popularity.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('The stress test is for SQLite databases.')
+        users = list(User.objects.filter(username__startswith=PREFIX + '-').order_by('id')[:options['threads']])
+        recipe_ids = list(Recipe.objects.filter(title__startswith=PREFIX + ' ').values_list('id', flat=True))
+        if len(users) < options['threads'] or not recipe_ids:
+            raise CommandError('Run seed_bench with at least {} users first.'.format(options['threads']))
+
+        runs = []
+        if options['baseline'] or options['compare']:
+            runs.append(('baseline', BASELINE))
+        if not options['baseline']:
+            runs.append(('configured', {}))
+        # Every rejected duplicate favourite and failed request would be logged, they are counted instead
+        logging.getLogger('django.request').setLevel(logging.CRITICAL)
+        for name, overrides in runs:
+            with override_settings(**overrides):
+                # New connections pick up the pragmas
+                connections.close_all()
+                result = self.run(users, recipe_ids, options)
+            connections.close_all()
+            self.stdout.write('{:12} {requests} requests in {elapsed:.2f} s, {throughput:.1f} req/s, {ok} ok, '
+                              '{rejected} rejected, {locked} lock errors, {failed} other errors'.format(name, **result))
+
+    def run(self, users, recipe_ids, options):
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if host != '*'), 'localhost')
+        counts = {'ok': 0, 'rejected': 0, 'locked': 0, 'failed': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(len(users))
+
+        def worker(number, user):
+            rng = random.Random(options['seed'] * 1000 + number)
+            client = Client(SERVER_NAME=host, HTTP_AUTHORIZATION='Bearer {}'.format(AccessToken.for_user(user)))
+            recipes = zipf(rng, recipe_ids, options['operations'], options['exponent'])
+            local = dict.fromkeys(counts, 0)
+            start.wait()
+            try:
+                for recipe_id in recipes:
+                    operation = rng.choice(('rate', 'favourite', 'comment'))
+                    try:
+                        if operation == 'rate':
+                            response = client.post('/api/recipes/{}/rate/'.format(recipe_id),
+                                                   {'stars': rng.randint(1, 5)})
+                        elif operation == 'favourite':
+                            response = client.post('/api/recipes/{}/favourite/'.format(recipe_id))
+                        else:
+                            response = client.post('/api/recipes/{}/comments/'.format(recipe_id),
+                                                   {'content': 'Stress test comment'})
+                    except Exception as e:
+                        local['locked' if is_lock_error(e) else 'failed'] += 1
+                        continue
+                    local['ok' if response.status_code < 400 else
+                          'rejected' if response.status_code < 500 else 'failed'] += 1
+            finally:
+                connections.close_all()
+                with lock:
+                    for key, value in local.items():
+                        counts[key] += value
+
+        threads = [threading.Thread(target=worker, args=(number, user)) for number, user in enumerate(users)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        requests = sum(counts.values())
+        return dict(counts, requests=requests, elapsed=elapsed, throughput=requests / elapsed)
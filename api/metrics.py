@@ -0,0 +1,202 @@
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+# Upper bounds of the histogram buckets, +Inf is added when rendering
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+HISTOGRAMS = (
+    ('api_request_duration_seconds', 'Time spent in the request.', 'total', SECONDS_BUCKETS),
+    ('api_request_db_duration_seconds', 'Time spent running queries.', 'db', SECONDS_BUCKETS),
+    ('api_request_serializer_duration_seconds', 'Time spent building serializer data.', 'serializer',
+     SECONDS_BUCKETS),
+    ('api_request_render_duration_seconds', 'Time spent rendering the response.', 'render', SECONDS_BUCKETS),
+    ('api_request_queries', 'Queries run by the request.', 'queries', QUERIES_BUCKETS),
+)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_local = threading.local()
+
+
+class RequestMetrics(object):
+    """What one request spent, times in seconds. Queries run while a response streams are not counted."""
+
+    def __init__(self):
+        self.view = None
+        self.queries = 0
+        self.db = 0.0
+        self.serializer = 0.0
+        self.render = 0.0
+        self.total = 0.0
+        self._serializing = False
+        self._render_started = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # Database execute wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db += time.perf_counter() - start
+
+    def server_timing(self):
+        return 'db;dur={:.1f};desc="{} queries", serializer;dur={:.1f}, render;dur={:.1f}, total;dur={:.1f}'.format(
+            self.db * 1000, self.queries, self.serializer * 1000, self.render * 1000, self.total * 1000)
+
+
+def current():
+    return getattr(_local, 'metrics', None)
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry(object):
+    """Histograms per view of this process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def observe(self, metrics):
+        with self.lock:
+            histograms = self.views.get(metrics.view)
+            if histograms is None:
+                histograms = self.views[metrics.view] = {name: Histogram(buckets)
+                                                         for name, _, _, buckets in HISTOGRAMS}
+            for name, _, attribute, _ in HISTOGRAMS:
+                histograms[name].observe(getattr(metrics, attribute))
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, description, _, buckets in HISTOGRAMS:
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} histogram'.format(name))
+                for view in sorted(self.views):
+                    histogram = self.views[view][name]
+                    label = 'view="{}"'.format(view.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for bound, count in zip(buckets, histogram.counts):
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, bound, count))
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, label, histogram.count))
+                    lines.append('{}_sum{{{}}} {}'.format(name, label, histogram.sum))
+                    lines.append('{}_count{{{}}} {}'.format(name, label, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+def view_name(request):
+    """ViewSet.action (or APIView.method) of the resolved view, the URL name or path of other views."""
+    match = request.resolver_match
+    if match is None:
+        return None
+    view = getattr(match.func, 'cls', None)
+    if view is None:
+        return match.view_name or match._func_path
+    method = request.method.lower()
+    actions = getattr(match.func, 'actions', None) or {}
+    return '{}.{}'.format(view.__name__, actions.get(method, method))
+
+
+class MetricsMiddleware(object):
+    """
+    Records the queries, DB time, serializer time, render time and total time of each resolved request in
+    the registry. Staff (everyone with METRICS_SERVER_TIMING) get them in a Server-Timing header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = _local.metrics = RequestMetrics()
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                response = self.get_response(request)
+        finally:
+            _local.metrics = None
+        metrics.total = time.perf_counter() - start
+
+        metrics.view = view_name(request)
+        if metrics.view is None:
+            return response
+        registry.observe(metrics)
+        user = getattr(request, 'user', None)
+        if settings.METRICS_SERVER_TIMING or (user is not None and user.is_staff):
+            response['Server-Timing'] = metrics.server_timing()
+        response.metrics = metrics
+        return response
+
+    def process_template_response(self, request, response):
+        # Called right before a DRF Response is rendered
+        metrics = current()
+        if metrics is not None:
+            metrics._render_started = time.perf_counter()
+            response.add_post_render_callback(self._rendered)
+        return response
+
+    @staticmethod
+    def _rendered(response):
+        metrics = current()
+        if metrics is not None and metrics._render_started is not None:
+            metrics.render += time.perf_counter() - metrics._render_started
+
+
+class TimedDataMixin(object):
+    # serializer.data timed as serializer time of the current request, nested serializers counted once
+
+    @property
+    def data(self):
+        metrics = current()
+        if metrics is None or metrics._serializing:
+            return super(TimedDataMixin, self).data
+        metrics._serializing = True
+        start = time.perf_counter()
+        try:
+            return super(TimedDataMixin, self).data
+        finally:
+            metrics._serializing = False
+            metrics.serializer += time.perf_counter() - start
+
+
+_timed_classes = {}
+
+
+def timed(serializer):
+    """The serializer, switched to a subclass whose data is timed (see TimedDataMixin)."""
+    serializer_class = type(serializer)
+    if not issubclass(serializer_class, TimedDataMixin):
+        timed_class = _timed_classes.get(serializer_class)
+        if timed_class is None:
+            timed_class = _timed_classes[serializer_class] = type(serializer_class.__name__,
+                                                                  (TimedDataMixin, serializer_class), {})
+        serializer.__class__ = timed_class
+    return serializer
+
+
+class SerializerMetricsMixin(object):
+    """Times the data of the serializers the view gets from get_serializer."""
+
+    def get_serializer(self, *args, **kwargs):
+        return timed(super(SerializerMetricsMixin, self).get_serializer(*args, **kwargs))
@@ -1,6 +1,13 @@
+import uuid
+
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.conf import settings
+from django.db.models import Case, Count, F, OuterRef, Prefetch, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.query import ModelIterable
+from django.utils import timezone
 
 
 class User(AbstractUser):
@@ -12,6 +19,12 @@ class User(AbstractUser):
     def __str__(self):
         return "{}".format(self.email)
 
+    def refresh_from_db(self, using=None, fields=None):
+        # Users from CachedJWTAuthentication defer all but a few fields, the first access loads all of them
+        if fields is not None:
+            fields = set(fields) | self.get_deferred_fields()
+        super(User, self).refresh_from_db(using, fields)
+
 
 class Category(models.Model):
     name = models.CharField(max_length=150, unique=True)
@@ -20,6 +33,67 @@ class Category(models.Model):
         return self.name
 
 
+class RecipeQuerySet(models.QuerySet):
+
+    # Relations RecipeDisplaySerializer touches, loaded in a fixed number of queries.
+    # Only the ones named in `fields` are prefetched when it is given.
+    def for_display(self, fields=None):
+        prefetches = {
+            'categories': 'categories',
+            'ingredients': 'ingredients',
+            'steps': Prefetch('steps', queryset=Step.objects.order_by('order')),
+        }
+        queryset = self.prefetch_related(*[prefetch for name, prefetch in prefetches.items()
+                                           if fields is None or name in fields])
+        if fields is None or 'comments' in fields:
+            queryset = queryset.with_comment_previews()
+        return queryset
+
+    # The first page of active comments of every fetched recipe goes to its comment_preview, a range scan
+    # of the (recipe, isActive, id) index each instead of all comments of the recipes
+    _comment_previews = False
+
+    def with_comment_previews(self):
+        clone = self._chain()
+        clone._comment_previews = True
+        return clone
+
+    def _clone(self):
+        clone = super(RecipeQuerySet, self)._clone()
+        clone._comment_previews = self._comment_previews
+        return clone
+
+    def _fetch_all(self):
+        attach = self._result_cache is None and self._comment_previews and self._iterable_class is ModelIterable
+        super(RecipeQuerySet, self)._fetch_all()
+        if attach:
+            previews = Comment.objects.previews([recipe.id for recipe in self._result_cache])
+            for recipe in self._result_cache:
+                recipe.comment_preview = previews.get(recipe.id, [])
+
+    def count_comments(self, recipe_ids):
+        active = Comment.objects.filter(recipe=OuterRef('pk'), isActive=True).order_by()
+        return self.filter(pk__in=recipe_ids).update(comment_count=Coalesce(Subquery(
+            active.values('recipe').annotate(count=Count('id')).values('count')), 0))
+
+    def adjust_comment_count(self, recipe_id, delta):
+        return self.filter(pk=recipe_id).update(comment_count=F('comment_count') + delta)
+
+    # Marks recipes whose steps, ingredients, comments, ratings or categories changed as modified
+    def touch(self, recipe_ids):
+        return self.filter(pk__in=recipe_ids).update(updated_at=timezone.now())
+
+    def normalize_preparation_time(self):
+        return self.update(preparation_seconds=Case(
+            *[When(preparationTimeUnit=unit, then=F('preparationTime') * seconds)
+              for unit, seconds in Recipe.PREPARATION_TIME_UNIT_SECONDS.items()],
+            default=F('preparationTime'), output_field=models.FloatField()))
+
+    def adjust_rating(self, recipe_id, count_delta, sum_delta):
+        return self.filter(pk=recipe_id).update(rating_count=F('rating_count') + count_delta,
+                                                rating_sum=F('rating_sum') + sum_delta)
+
+
 class Recipe(models.Model):
     NOVICE = 0
     BEGINNER = 1
@@ -44,27 +118,57 @@ class Recipe(models.Model):
         (HOURS, 'hours'),
         (DAYS, 'days')
     ]
+    PREPARATION_TIME_UNIT_SECONDS = {
+        SECONDS: 1,
+        MINUTES: 60,
+        HOURS: 60 * 60,
+        DAYS: 24 * 60 * 60,
+    }
     user = models.ForeignKey(User, related_name='recipes', on_delete=models.SET_NULL, null=True)
     title = models.CharField(max_length=150, unique=True)
     description = models.TextField(max_length=1500)
     imageUrl = models.CharField(max_length=400)
     preparationTime = models.FloatField(validators=[MinValueValidator(0)])
     preparationTimeUnit = models.CharField(max_length=1, choices=PREPARATION_TIME_UNIT_CHOICES)
+    # preparationTime converted to seconds, so it can be filtered through an index
+    preparation_seconds = models.FloatField(default=0, db_index=True)
     level = models.IntegerField(choices=LEVEL_CHOICES, default=COMPETENT)
     dateAdded = models.DateField(auto_now=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     categories = models.ManyToManyField(Category)
+    # Kept in sync with Rating rows by api.signals, see also rebuild_recipe_aggregates
+    rating_count = models.PositiveIntegerField(default=0)
+    rating_sum = models.PositiveIntegerField(default=0)
+    # Calories of all ingredients, kept in sync by api.nutrition
+    kcal = models.FloatField(default=0, editable=False)
+    # Active comments, kept in sync by api.signals and rebuild_recipe_aggregates
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['level', 'preparation_seconds']),
+            models.Index(fields=['user', 'level']),
+        ]
+
+    def set_preparation_seconds(self):
+        self.preparation_seconds = self.preparationTime * \
+            self.PREPARATION_TIME_UNIT_SECONDS.get(self.preparationTimeUnit, 1)
+
+    def save(self, *args, **kwargs):
+        self.set_preparation_seconds()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'preparation_seconds' not in update_fields:
+            kwargs['update_fields'] = list(update_fields) + ['preparation_seconds']
+        super(Recipe, self).save(*args, **kwargs)
 
     def no_of_rating(self):
-        ratings = Rating.objects.filter(recipe=self)
-        return len(ratings)
+        return self.rating_count
 
     def avg_rating(self):
-        m_sum = 0
-        ratings = Rating.objects.filter(recipe=self)
-        for rating in ratings:
-            m_sum += rating.stars
-        if len(ratings) > 0:
-            return m_sum / len(ratings)
+        if self.rating_count > 0:
+            return self.rating_sum / self.rating_count
         else:
             return 0
 
@@ -88,6 +192,31 @@ UNIT_CHOICES = [
 ]
 
 
+class FullTextField(models.TextField):
+    """The hidden FTS5 column named after its table, the left side of MATCH and the first argument of bm25."""
+
+
+@FullTextField.register_lookup
+class Match(models.Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return '{} MATCH {}'.format(lhs, rhs), lhs_params + rhs_params
+
+
+class RecipeSearchDocument(models.Model):
+    """A row of the SQLite FTS5 index kept by api.search, only there to be joined to recipes in searches."""
+    recipe = models.OneToOneField(Recipe, db_column='rowid', primary_key=True, related_name='search_document',
+                                  on_delete=models.DO_NOTHING)
+    document = FullTextField(db_column='api_recipe_fts')
+
+    class Meta:
+        managed = False
+        db_table = 'api_recipe_fts'
+
+
 class Unit(models.Model):
     full = models.CharField(max_length=50, unique=True)
     short = models.CharField(max_length=25, unique=True)
@@ -122,17 +251,36 @@ class RecipeIngredient(models.Model):
 
     class Meta:
         unique_together = (('recipe', 'ingredient'),)
+        indexes = [
+            # ingredient -> recipes lookups of the include/exclude filters
+            models.Index(fields=['ingredient', 'recipe']),
+        ]
 
     def __str__(self):
         return self.ingredient.name + ' ' + str(self.quantity)
 
 
+class StepQuerySet(models.QuerySet):
+
+    def reorder(self, recipe_id, step_ids):
+        # Two passes so no statement breaks unique_together(recipe, order): the steps first move to their
+        # negated new positions, which cannot collide with the current positive ones, then back to positive
+        if not step_ids:
+            return
+        steps = self.filter(recipe_id=recipe_id)
+        steps.update(order=Case(*[When(pk=step_id, then=Value(-position))
+                                  for position, step_id in enumerate(step_ids, 1)], default=F('order')))
+        steps.filter(order__lt=0).update(order=-F('order'))
+
+
 class Step(models.Model):
     recipe = models.ForeignKey(Recipe, related_name='steps', on_delete=models.CASCADE)
     description = models.TextField(max_length=1500)
     order = models.IntegerField(validators=[MinValueValidator(1)])
     imageUrl = models.CharField(max_length=400, blank=True, null=True)
 
+    objects = StepQuerySet.as_manager()
+
     class Meta:
         unique_together = (('recipe', 'order'),)
 
@@ -140,6 +288,31 @@ class Step(models.Model):
         return self.description[0: 20]
 
 
+class CommentQuerySet(models.QuerySet):
+
+    def previews(self, recipe_ids, size=None):
+        """{recipe_id: [its first size active comments by id]}, size defaults to COMMENTS_PAGE_SIZE."""
+        recipe_ids = sorted(set(recipe_ids))
+        if not recipe_ids:
+            return {}
+        if len(recipe_ids) == 1:
+            comments = list(self.filter(recipe_id=recipe_ids[0], isActive=True)
+                            .order_by('id')[:size or settings.COMMENTS_PAGE_SIZE])
+        else:
+            # A LIMIT per recipe, which the ORM cannot express without a window function over all comments
+            comments = self.raw(
+                'SELECT c.* FROM {recipe} r JOIN {comment} c ON c.id IN ('
+                'SELECT p.id FROM {comment} p WHERE p.recipe_id = r.id AND p."isActive" = %s '
+                'ORDER BY p.id LIMIT %s) WHERE r.id IN ({ids}) ORDER BY c.recipe_id, c.id'.format(
+                    recipe=Recipe._meta.db_table, comment=Comment._meta.db_table,
+                    ids=', '.join(['%s'] * len(recipe_ids))),
+                [True, size or settings.COMMENTS_PAGE_SIZE] + recipe_ids)
+        previews = {}
+        for comment in comments:
+            previews.setdefault(comment.recipe_id, []).append(comment)
+        return previews
+
+
 class Comment(models.Model):
     user = models.ForeignKey(User, related_name='comments', on_delete=models.CASCADE)
     recipe = models.ForeignKey(Recipe, related_name='comments', on_delete=models.CASCADE)
@@ -148,24 +321,94 @@ class Comment(models.Model):
     dateModified = models.DateField(auto_now=True)
     isActive = models.BooleanField(default=True)
 
+    objects = CommentQuerySet.as_manager()
+
     class Meta:
         index_together = (('user', 'recipe'),)
+        indexes = [
+            # Keyset pagination of the active comments of a recipe
+            models.Index(fields=['recipe', 'isActive', 'id']),
+        ]
 
 
 class Rating(models.Model):
     user = models.ForeignKey(User, related_name='rates', on_delete=models.CASCADE)
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
     stars = models.IntegerField(validators=[MinValueValidator(1), MaxValueValidator(5)])
+    # When the recipe was first rated, for the trending leaderboard. None for the ratings given before it was
+    # recorded, which would otherwise all count as given at the migration.
+    created_at = models.DateTimeField(null=True, editable=False, db_index=True)
 
     class Meta:
         unique_together = (('user', 'recipe'),)
         index_together = (('user', 'recipe'),)
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.created_at is None:
+            self.created_at = timezone.now()
+        super(Rating, self).save(*args, **kwargs)
+
 
 class Favorite(models.Model):
     user = models.ForeignKey(User, related_name='favourites', on_delete=models.CASCADE)
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
+    # As Rating.created_at
+    created_at = models.DateTimeField(null=True, editable=False, db_index=True)
 
     class Meta:
         unique_together = (('user', 'recipe'),)
         index_together = (('user', 'recipe'),)
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.created_at is None:
+            self.created_at = timezone.now()
+        super(Favorite, self).save(*args, **kwargs)
+
+
+class RecipeScore(models.Model):
+    """A ranked recipe of a precomputed leaderboard, rebuilt as a whole by api.leaderboards.refresh."""
+    TOP = 'top'
+    TRENDING = 'trending'
+    BOARD_CHOICES = [
+        (TOP, 'top rated'),
+        (TRENDING, 'trending'),
+    ]
+    board = models.CharField(max_length=8, choices=BOARD_CHOICES)
+    # None for the board over all recipes
+    category = models.ForeignKey(Category, related_name='+', on_delete=models.CASCADE, null=True)
+    rank = models.PositiveIntegerField()
+    recipe = models.ForeignKey(Recipe, related_name='+', on_delete=models.CASCADE)
+    score = models.FloatField()
+    refreshed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # A page of a board is a range scan
+            models.Index(fields=['board', 'category', 'rank']),
+        ]
+
+
+class UploadSession(models.Model):
+    """A resumable image upload, the bytes received so far are in IMAGES_ROOT/uploads/<id>.part."""
+    RECIPE = 'recipe'
+    STEP = 'step'
+    INGREDIENT = 'ingredient'
+    TARGET_CHOICES = [
+        (RECIPE, 'recipe'),
+        (STEP, 'step'),
+        (INGREDIENT, 'ingredient'),
+    ]
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, related_name='upload_sessions', on_delete=models.CASCADE)
+    target = models.CharField(max_length=10, choices=TARGET_CHOICES)
+    target_id = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+    offset = models.PositiveIntegerField(default=0)
+    imageUrl = models.CharField(max_length=400, blank=True, null=True)
+    # Set by the one request completing the upload, see api.uploads.complete
+    completing = models.BooleanField(default=False, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{} {}/{}'.format(self.id, self.offset, self.size)
@@ -0,0 +1,80 @@
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from api.models import Recipe, RecipeIngredient, Unit
+
+# Mass of one unit, by Unit.short (see api/fixtures/units.json). Pieces have no fixed mass, so they only
+# convert to themselves.
+GRAMS_PER_UNIT = {
+    'g': 1.0,
+    'kg': 1000.0,
+    'tbsp': 15.0,
+    'tsp': 5.0,
+    'pi': 0.36,
+}
+CHUNK_SIZE = 500
+
+
+def conversion_matrix():
+    """
+    (unit id -> row/column, matrix) where matrix[a, b] is the number of units b in one unit a,
+    NaN when the two units cannot be converted.
+    """
+    units = list(Unit.objects.values_list('id', 'short').order_by('id'))
+    grams = np.array([GRAMS_PER_UNIT.get(short, np.nan) for _, short in units], dtype=np.float64)
+    with np.errstate(invalid='ignore'):
+        matrix = grams[:, np.newaxis] / grams[np.newaxis, :]
+    np.fill_diagonal(matrix, 1.0)
+    return {unit_id: position for position, (unit_id, _) in enumerate(units)}, matrix
+
+
+def compute_kcal(recipe_ids, units=None):
+    """
+    Calories of the given recipes as {recipe id: kcal}. Ingredients whose unit does not convert to the
+    one their kcal is given in count as 0.
+    """
+    unit_index, matrix = units or conversion_matrix()
+    recipe_ids = list(recipe_ids)
+    totals = dict.fromkeys(recipe_ids, 0.0)
+    rows = list(RecipeIngredient.objects.filter(recipe_id__in=recipe_ids).order_by().values_list(
+        'recipe_id', 'quantity', 'unit_id', 'ingredient__quantity', 'ingredient__unit_id', 'ingredient__kcal'))
+    if not rows:
+        return totals
+
+    recipe, quantity, unit, base_quantity, base_unit, kcal = zip(*rows)
+    factor = matrix[[unit_index[u] for u in unit], [unit_index[u] for u in base_unit]]
+    base_quantity = np.array(base_quantity, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        energy = np.array(quantity, dtype=np.float64) * factor / base_quantity * np.array(kcal, dtype=np.float64)
+    energy[~np.isfinite(energy)] = 0.0
+
+    slots, inverse = np.unique(np.array(recipe, dtype=np.int64), return_inverse=True)
+    for recipe_id, total in zip(slots.tolist(), np.bincount(inverse, weights=energy).tolist()):
+        totals[recipe_id] = round(total, 1)
+    return totals
+
+
+def update_kcal(recipe_ids=None, save=True):
+    """
+    Recomputes Recipe.kcal of the given recipes (all when None) and returns the ids of the ones that
+    changed. Only those are written, with updated_at bumped so cached documents and validators move, and
+    nothing is with save=False.
+    """
+    if recipe_ids is None:
+        recipe_ids = Recipe.objects.order_by('id').values_list('id', flat=True)
+    recipe_ids = sorted(set(recipe_ids))
+    units = conversion_matrix()
+    changed = []
+    for start in range(0, len(recipe_ids), CHUNK_SIZE):
+        ids = recipe_ids[start:start + CHUNK_SIZE]
+        totals = compute_kcal(ids, units)
+        now = timezone.now()
+        recipes = [Recipe(id=recipe_id, kcal=totals[recipe_id], updated_at=now)
+                   for recipe_id, kcal in Recipe.objects.filter(pk__in=ids).values_list('id', 'kcal')
+                   if kcal != totals[recipe_id]]
+        if save and recipes:
+            with transaction.atomic():
+                Recipe.objects.bulk_update(recipes, ['kcal', 'updated_at'])
+        changed.extend(recipe.id for recipe in recipes)
+    return changed
@@ -0,0 +1,22 @@
+from api.models import Favorite, Rating
+
+
+def load_user_overlay(user, recipe_ids):
+    """Returns ({recipe_id: stars}, {favourite recipe_id}) of the user restricted to recipe_ids."""
+    if user is None or user.is_anonymous or not recipe_ids:
+        return {}, set()
+    ratings = dict(Rating.objects.filter(user=user, recipe_id__in=recipe_ids).values_list('recipe_id', 'stars'))
+    favourites = set(Favorite.objects.filter(user=user, recipe_id__in=recipe_ids)
+                     .values_list('recipe_id', flat=True))
+    return ratings, favourites
+
+
+def apply_user_overlay(user, representations, fields=('user_favourite', 'user_rating')):
+    """Adds user_favourite/user_rating to serialized recipes, e.g. the cached anonymous ones."""
+    ratings, favourites = load_user_overlay(user, [recipe['id'] for recipe in representations])
+    for recipe in representations:
+        if 'user_favourite' in fields and recipe['id'] in favourites:
+            recipe['user_favourite'] = True
+        if 'user_rating' in fields and recipe['id'] in ratings:
+            recipe['user_rating'] = ratings[recipe['id']]
+    return representations
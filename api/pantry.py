@@ -0,0 +1,173 @@
+import threading
+import uuid
+
+import numpy as np
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from api import cache as response_cache
+from api.models import RecipeIngredient
+
+# Touched whenever a process changes its index, other processes rebuild theirs when they see it moved
+PANTRY_STAMP_KEY = 'pantry:modified'
+WORD = np.dtype('<u8')
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words):
+    """Number of set bits of every row of a 2d uint64 array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def _words(bits):
+    return max(1, (bits + 63) // 64)
+
+
+def _bits(words, count):
+    # Indexes of the set bits of a 1d uint64 bitset, limited to the first `count` positions
+    return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder='little')[:count])
+
+
+def _grow(array, rows, columns):
+    if rows <= array.shape[0] and columns <= array.shape[1]:
+        return array
+    grown = np.zeros((max(rows, 2 * array.shape[0]), max(columns, 2 * array.shape[1])), dtype=WORD)
+    grown[:array.shape[0], :array.shape[1]] = array
+    return grown
+
+
+class PantryIndex(object):
+    """
+    In-memory bitset index of recipe ingredients.
+
+    `postings` is the inverted index: one bitset of recipe slots per ingredient, used to find the recipes
+    sharing at least one ingredient with a pantry. `recipes` holds one bitset of ingredient columns per recipe,
+    so the ingredients a recipe shares with a pantry are a popcount of (recipe & pantry).
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built = False
+
+    def build(self):
+        # Kept for the life of the process, so never read from a replica
+        rows = RecipeIngredient.objects.using(DEFAULT_DB_ALIAS).values_list('recipe_id', 'ingredient_id').order_by()
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        recipe_ids, slots = np.unique(rows[:, 0], return_inverse=True)
+        ingredient_ids, columns = np.unique(rows[:, 1], return_inverse=True)
+
+        self.recipe_ids = recipe_ids.copy()
+        self.recipe_slot = {recipe_id: slot for slot, recipe_id in enumerate(recipe_ids.tolist())}
+        self.ingredient_ids = ingredient_ids.copy()
+        self.ingredient_column = {ingredient_id: column
+                                  for column, ingredient_id in enumerate(ingredient_ids.tolist())}
+
+        self.recipes = np.zeros((max(1, len(recipe_ids)), _words(len(ingredient_ids))), dtype=WORD)
+        self.postings = np.zeros((max(1, len(ingredient_ids)), _words(len(recipe_ids))), dtype=WORD)
+        one = np.uint64(1)
+        np.bitwise_or.at(self.recipes, (slots, columns // 64), one << (columns % 64).astype(np.uint64))
+        np.bitwise_or.at(self.postings, (columns, slots // 64), one << (slots % 64).astype(np.uint64))
+        self.totals = np.bincount(slots, minlength=self.recipes.shape[0]).astype(np.int64)
+        self.built = True
+
+    def _slot(self, recipe_id):
+        slot = self.recipe_slot.get(recipe_id)
+        if slot is None:
+            slot = len(self.recipe_slot)
+            self.recipe_slot[recipe_id] = slot
+            self.recipe_ids = np.append(self.recipe_ids, recipe_id)
+            self.recipes = _grow(self.recipes, slot + 1, self.recipes.shape[1])
+            self.postings = _grow(self.postings, self.postings.shape[0], _words(slot + 1))
+            if self.totals.shape[0] <= slot:
+                self.totals = np.concatenate([self.totals, np.zeros(self.recipes.shape[0] - self.totals.shape[0],
+                                                                    dtype=np.int64)])
+        return slot
+
+    def _column(self, ingredient_id):
+        column = self.ingredient_column.get(ingredient_id)
+        if column is None:
+            column = len(self.ingredient_column)
+            self.ingredient_column[ingredient_id] = column
+            self.ingredient_ids = np.append(self.ingredient_ids, ingredient_id)
+            self.postings = _grow(self.postings, column + 1, self.postings.shape[1])
+            self.recipes = _grow(self.recipes, self.recipes.shape[0], _words(column + 1))
+        return column
+
+    def _current_stamp(self):
+        stamp, = response_cache.get_stamps(PANTRY_STAMP_KEY)
+        return stamp
+
+    def ensure_built(self):
+        # Also rebuilds the index when another process changed its own copy
+        stamp = self._current_stamp()
+        if not self.built or stamp != self.stamp:
+            self.build()
+            self.stamp = stamp
+
+    def recipes_changed(self, recipe_ids):
+        """Re-reads the ingredients of the given recipes, deleted recipes end up with none."""
+        with self.lock:
+            up_to_date = self.built and self._current_stamp() == self.stamp
+            # A value only this change writes: re-reading the key afterwards could pick up another process's
+            # stamp without its change
+            stamp = uuid.uuid4().hex
+            cache.set(PANTRY_STAMP_KEY, stamp, None)
+            if not up_to_date:
+                # Built from scratch by the next match()
+                self.built = False
+                return
+
+            current = {}
+            for recipe_id, ingredient_id in RecipeIngredient.objects.using(DEFAULT_DB_ALIAS) \
+                    .filter(recipe_id__in=recipe_ids).values_list('recipe_id', 'ingredient_id'):
+                current.setdefault(recipe_id, []).append(ingredient_id)
+
+            for recipe_id in set(recipe_ids):
+                slot = self._slot(recipe_id)
+                word, bit = slot // 64, np.uint64(1) << np.uint64(slot % 64)
+                for column in _bits(self.recipes[slot], len(self.ingredient_column)):
+                    self.postings[column, word] &= ~bit
+                self.recipes[slot] = 0
+                ingredients = current.get(recipe_id, [])
+                for ingredient_id in ingredients:
+                    column = self._column(ingredient_id)
+                    self.recipes[slot, column // 64] |= np.uint64(1) << np.uint64(column % 64)
+                    self.postings[column, word] |= bit
+                self.totals[slot] = len(ingredients)
+            self.stamp = stamp
+
+    def match(self, ingredient_ids, limit=20, min_coverage=0.0):
+        """
+        Recipes ranked by the fraction of their ingredients found in ingredient_ids, as a list of
+        (recipe_id, coverage, have, total, missing ingredient ids).
+        """
+        with self.lock:
+            self.ensure_built()
+            columns = [self.ingredient_column[i] for i in set(ingredient_ids) if i in self.ingredient_column]
+            if not columns:
+                return []
+            columns = np.array(columns, dtype=np.int64)
+
+            pantry = np.zeros(self.recipes.shape[1], dtype=WORD)
+            np.bitwise_or.at(pantry, columns // 64, np.uint64(1) << (columns % 64).astype(np.uint64))
+            candidates = _bits(np.bitwise_or.reduce(self.postings[columns], axis=0), len(self.recipe_slot))
+
+            have = popcount(self.recipes[candidates] & pantry)
+            total = self.totals[candidates]
+            coverage = have / np.maximum(total, 1)
+            keep = coverage >= min_coverage
+            candidates, have, total, coverage = candidates[keep], have[keep], total[keep], coverage[keep]
+
+            order = np.lexsort((self.recipe_ids[candidates], -have, -coverage))[:limit]
+            results = []
+            for position in order:
+                slot = candidates[position]
+                missing = _bits(self.recipes[slot] & ~pantry, len(self.ingredient_column))
+                results.append((int(self.recipe_ids[slot]), float(coverage[position]), int(have[position]),
+                                int(total[position]), self.ingredient_ids[missing].tolist()))
+            return results
+
+
+index = PantryIndex()
@@ -0,0 +1,126 @@
+import functools
+import hashlib
+import threading
+import time
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+
+VERIFY_URL = 'https://www.google.com/recaptcha/api/siteverify'
+UNAVAILABLE = 'recaptcha-unavailable'
+
+
+class Verdict(object):
+    def __init__(self, success, error_codes=None, available=True):
+        self.success = success
+        self.error_codes = list(error_codes or [])
+        # False when the verifier could not be asked, such verdicts are not cached
+        self.available = available
+
+
+class CircuitBreaker(object):
+    """
+    Opens after threshold consecutive failures and lets one request through again after cooldown seconds,
+    so a slow or unreachable upstream costs the workers of this process nothing while it is open.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            # Half open, the next failure opens it for another cooldown
+            self.opened_at = time.monotonic()
+            return True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class BaseBackend(object):
+    def verify(self, token, remote_ip=None):
+        """Verdict of a reCAPTCHA response token."""
+        raise NotImplementedError
+
+
+class GoogleBackend(BaseBackend):
+    """Verifies with Google through a pooled keep-alive session, with (connect, read) timeouts and a breaker."""
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.RECAPTCHA_POOL_SIZE, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.breaker = CircuitBreaker(settings.RECAPTCHA_BREAKER_THRESHOLD, settings.RECAPTCHA_BREAKER_COOLDOWN)
+
+    def verify(self, token, remote_ip=None):
+        if not self.breaker.allow():
+            return Verdict(False, [UNAVAILABLE], available=False)
+        data = {'secret': settings.RECAPTCHA_SECRET, 'response': token}
+        if remote_ip:
+            data['remoteip'] = remote_ip
+        try:
+            response = self.session.post(VERIFY_URL, data=data, timeout=settings.RECAPTCHA_TIMEOUT)
+            response.raise_for_status()
+            body = response.json()
+        except (requests.RequestException, ValueError):
+            self.breaker.failed()
+            return Verdict(False, [UNAVAILABLE], available=False)
+        self.breaker.succeeded()
+        return Verdict(bool(body.get('success', False)), body.get('error-codes'))
+
+
+class StubBackend(BaseBackend):
+    """
+    Answers offline for development and load tests: every token passes except RECAPTCHA_STUB_FAILING_TOKENS,
+    after RECAPTCHA_STUB_LATENCY seconds standing in for the round trip.
+    """
+
+    def verify(self, token, remote_ip=None):
+        if settings.RECAPTCHA_STUB_LATENCY:
+            time.sleep(settings.RECAPTCHA_STUB_LATENCY)
+        if token in settings.RECAPTCHA_STUB_FAILING_TOKENS:
+            return Verdict(False, ['invalid-input-response'])
+        return Verdict(True)
+
+
+@functools.lru_cache(maxsize=None)
+def _backend(path):
+    return import_string(path)()
+
+
+def get_backend():
+    return _backend(settings.RECAPTCHA_BACKEND)
+
+
+def verify(token, remote_ip=None):
+    """
+    Verdict of a token from the configured backend. Tokens are single use upstream, so the verdict is kept
+    for RECAPTCHA_CACHE_TIMEOUT seconds and a retried or double submitted form gets the same answer.
+    """
+    key = 'recaptcha:{}'.format(hashlib.sha256(token.encode()).hexdigest())
+    cached = cache.get(key)
+    if cached is not None:
+        return Verdict(*cached)
+    verdict = get_backend().verify(token, remote_ip)
+    if verdict.available:
+        cache.set(key, (verdict.success, verdict.error_codes), settings.RECAPTCHA_CACHE_TIMEOUT)
+    return verdict
@@ -0,0 +1,158 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from api.authentication import CachedJWTAuthentication
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+PIN_KEY = 'primary-pin:{}'
+DEFAULT_HEALTH_CHECK_QUERY = 'SELECT 1 FROM django_migrations LIMIT 1'
+
+# Read alias of the request being handled by this thread, None reads from the primary
+_state = threading.local()
+
+
+class ReplicaHealth(object):
+    """
+    Health of the settings.READ_REPLICAS aliases, each one checked at most every HEALTH_CHECK_INTERVAL seconds.
+    An alias with a LAG_QUERY (SQL returning the replication lag in seconds) is healthy while the lag is at
+    most MAX_LAG.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checked = {}
+        self.healthy = {}
+
+    def check(self, alias):
+        options = settings.READ_REPLICAS[alias]
+        try:
+            with connections[alias].cursor() as cursor:
+                if options.get('LAG_QUERY'):
+                    cursor.execute(options['LAG_QUERY'])
+                    lag = cursor.fetchone()[0]
+                    return float(lag or 0) <= options.get('MAX_LAG', 5)
+                cursor.execute(options.get('HEALTH_CHECK_QUERY', DEFAULT_HEALTH_CHECK_QUERY))
+                return True
+        except DatabaseError:
+            return False
+
+    def choose(self):
+        """A healthy replica alias, None when there is none."""
+        healthy = []
+        for alias, options in settings.READ_REPLICAS.items():
+            now = time.monotonic()
+            with self.lock:
+                due = alias not in self.checked or now - self.checked[alias] >= options.get('HEALTH_CHECK_INTERVAL', 10)
+                if due:
+                    self.checked[alias] = now
+            if due:
+                self.healthy[alias] = self.check(alias)
+            if self.healthy.get(alias):
+                healthy.append(alias)
+        return random.choice(healthy) if healthy else None
+
+
+replicas = ReplicaHealth()
+
+
+def read_alias():
+    """The replica alias reads of this thread go to, None for the primary."""
+    return getattr(_state, 'alias', None)
+
+
+@contextmanager
+def use_primary():
+    # For reads whose results outlive the request, e.g. validators: a lagging replica would return
+    # pre-write data under the stamps bumped by that write
+    alias = getattr(_state, 'alias', None)
+    _state.alias = None
+    try:
+        yield
+    finally:
+        _state.alias = alias
+
+
+class ReadReplicaRouter(object):
+    """
+    Reads of the requests ReadReplicaMiddleware picked a replica for go to it, everything else, all writes and
+    the reads inside a transaction of the primary included, goes to the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        alias = getattr(_state, 'alias', None)
+        if alias is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def _token_user_id(request):
+    authentication = CachedJWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header is not None else None
+    if raw_token is None:
+        return None
+    try:
+        return authentication.get_validated_token(raw_token).get(api_settings.USER_ID_CLAIM)
+    except (AuthenticationFailed, InvalidToken):
+        return None
+
+
+class ReadReplicaMiddleware(object):
+    """
+    Sends the reads of safe-method requests to a healthy replica. A successful write pins the client to the
+    primary for PRIMARY_PIN_SECONDS, through a cookie and, for token authenticated users, a shared cache key,
+    so it reads its own writes while the replicas catch up.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.READ_REPLICAS:
+            return self.get_response(request)
+        safe = request.method in SAFE_METHODS
+        _state.alias = replicas.choose() if safe and not self.is_pinned(request) else None
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.alias = None
+        if not safe and response.status_code < 400:
+            self.pin(request, response)
+        return response
+
+    @staticmethod
+    def is_pinned(request):
+        try:
+            if float(request.COOKIES.get(settings.PRIMARY_PIN_COOKIE, 0)) > time.time():
+                return True
+        except ValueError:
+            pass
+        user_id = _token_user_id(request)
+        return user_id is not None and cache.get(PIN_KEY.format(user_id)) is not None
+
+    @staticmethod
+    def pin(request, response):
+        response.set_cookie(settings.PRIMARY_PIN_COOKIE, str(time.time() + settings.PRIMARY_PIN_SECONDS),
+                            max_age=settings.PRIMARY_PIN_SECONDS, httponly=True, samesite='Lax')
+        user = getattr(request, 'user', None)
+        user_id = user.pk if user is not None and user.is_authenticated else _token_user_id(request)
+        if user_id is not None:
+            cache.set(PIN_KEY.format(user_id), True, settings.PRIMARY_PIN_SECONDS)
@@ -0,0 +1,102 @@
+import re
+
+from django.db import connections
+from django.db.models import F, FloatField, Func, Q, Value
+
+from api.models import Recipe, RecipeIngredient, RecipeSearchDocument, Step
+
+# SQLite FTS5 index of recipes, one row per recipe with rowid = recipe id
+FTS_TABLE = RecipeSearchDocument._meta.db_table
+FTS_COLUMNS = ('title', 'description', 'steps', 'ingredients', 'categories')
+# bm25 weights of FTS_COLUMNS, a hit in the title counts the most
+FTS_WEIGHTS = (10.0, 2.0, 1.0, 4.0, 4.0)
+CHUNK_SIZE = 500
+
+
+def is_supported(using='default'):
+    return connections[using].vendor == 'sqlite'
+
+
+def create_index(using='default', **kwargs):
+    if not is_supported(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS {} USING fts5({}, tokenize="unicode61 remove_diacritics 2")'
+                       .format(FTS_TABLE, ', '.join(FTS_COLUMNS)))
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        yield ids[start:start + CHUNK_SIZE]
+
+
+def index_recipes(recipe_ids, using='default'):
+    if not is_supported(using):
+        return
+    for ids in _chunks(set(recipe_ids)):
+        documents = {recipe_id: [title, description, [], [], []] for recipe_id, title, description in
+                     Recipe.objects.using(using).filter(pk__in=ids).values_list('id', 'title', 'description')}
+        parts = [
+            (2, Step.objects.using(using).filter(recipe_id__in=ids).order_by('order')
+             .values_list('recipe_id', 'description')),
+            (3, RecipeIngredient.objects.using(using).filter(recipe_id__in=ids)
+             .values_list('recipe_id', 'ingredient__name')),
+            (4, Recipe.categories.through.objects.using(using).filter(recipe_id__in=ids)
+             .values_list('recipe_id', 'category__name')),
+        ]
+        for column, rows in parts:
+            for recipe_id, text in rows:
+                documents[recipe_id][column].append(text)
+
+        with connections[using].cursor() as cursor:
+            cursor.executemany('DELETE FROM {} WHERE rowid = %s'.format(FTS_TABLE), [(i,) for i in ids])
+            cursor.executemany(
+                'INSERT INTO {} (rowid, {}) VALUES (%s, {})'.format(FTS_TABLE, ', '.join(FTS_COLUMNS),
+                                                                   ', '.join(['%s'] * len(FTS_COLUMNS))),
+                [(recipe_id, title, description, '\n'.join(steps), '\n'.join(ingredients), '\n'.join(categories))
+                 for recipe_id, (title, description, steps, ingredients, categories) in documents.items()])
+
+
+def unindex_recipes(recipe_ids, using='default'):
+    if not is_supported(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.executemany('DELETE FROM {} WHERE rowid = %s'.format(FTS_TABLE), [(i,) for i in set(recipe_ids)])
+
+
+def rebuild_index(using='default'):
+    if not is_supported(using):
+        return 0
+    create_index(using)
+    with connections[using].cursor() as cursor:
+        cursor.execute('DELETE FROM {}'.format(FTS_TABLE))
+    count = 0
+    for ids in _chunks(Recipe.objects.using(using).order_by('id').values_list('id', flat=True).iterator()):
+        index_recipes(ids, using)
+        count += len(ids)
+    with connections[using].cursor() as cursor:
+        cursor.execute("INSERT INTO {0} ({0}) VALUES ('optimize')".format(FTS_TABLE))
+    return count
+
+
+def match_expression(text):
+    # Free text to an FTS5 query: every word has to match, as a prefix, so no user input reaches the
+    # FTS5 query syntax unquoted
+    return ' '.join('"{}"*'.format(word) for word in re.findall(r'\w+', text or ''))
+
+
+def search(queryset, text):
+    """Filters recipes to the ones matching text, annotated with search_rank (lower is better)."""
+    expression = match_expression(text)
+    if not expression:
+        return queryset
+    if not is_supported(queryset.db):
+        return queryset.filter(Q(title__icontains=text) | Q(description__icontains=text)) \
+            .annotate(search_rank=Value(0.0))
+
+    # One join to the index, bm25 is then read off the matched row
+    return queryset.filter(search_document__document__match=expression).annotate(
+        search_rank=Func(F('search_document__document'), *(Value(weight) for weight in FTS_WEIGHTS),
+                         function='bm25', output_field=FloatField())
+    )
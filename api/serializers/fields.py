@@ -0,0 +1,14 @@
+from rest_framework import serializers
+
+from api import images
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+    """URLs of the resized variants of imageUrl, null unless it is a content-addressed upload."""
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('source', 'imageUrl')
+        super(ImageVariantsField, self).__init__(**kwargs)
+
+    def to_representation(self, value):
+        return images.variant_urls(value)
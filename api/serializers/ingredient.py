@@ -1,15 +1,17 @@
 from rest_framework import serializers
 
 from api.models import Unit, Ingredient
+from api.serializers.fields import ImageVariantsField
 from api.serializers.unit import UnitPrintSerializer
 
 
 class IngredientDisplaySerializer(serializers.ModelSerializer):
     allowedUnits = UnitPrintSerializer(many=True)
+    imageVariants = ImageVariantsField()
 
     class Meta:
         model = Ingredient
-        fields = ['id', 'name', 'imageUrl', 'quantity', 'unit', 'allowedUnits', 'kcal', 'isActive']
+        fields = ['id', 'name', 'imageUrl', 'imageVariants', 'quantity', 'unit', 'allowedUnits', 'kcal', 'isActive']
         depth = 1
 
 
@@ -1,23 +1,31 @@
-from django.db import transaction, IntegrityError
 from rest_framework import serializers
 
-from api.models import Step, RecipeIngredient, Unit, User, Category, Recipe
+from api.db import retry_atomic
+from api.models import Step, RecipeIngredient, Unit, User, Category, Recipe, Ingredient
+from api.serializers.fields import ImageVariantsField
+from api.serializers.relations import DeferredPrimaryKeyRelatedField, ResolvingListSerializer, resolve_pks
 from api.serializers.serializers import CategorySerializer, CommentSerializer
 from api.serializers.unit import UnitPrintSerializer
+from api.signals import bulk_recipe_changes, bulk_recipes_changed
 
 
 class StepRecipeSerializer(serializers.ModelSerializer):
+    imageVariants = ImageVariantsField()
+
     class Meta:
         model = Step
-        fields = ['description', 'order', 'imageUrl']
+        fields = ['description', 'order', 'imageUrl', 'imageVariants']
 
 
 # Only for validation in Recipe
 class RecipeIngredientRecipeSerializer(serializers.ModelSerializer):
+    # Ingredients and units of all items are fetched with one query each by the list serializer
+    serializer_related_field = DeferredPrimaryKeyRelatedField
 
     class Meta:
         model = RecipeIngredient
         fields = ['ingredient', 'unit', 'quantity']
+        list_serializer_class = ResolvingListSerializer
 
 
 class ChoiceField(serializers.ChoiceField):
@@ -45,18 +53,91 @@ class RecipeDisplaySerializer(serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField
     level = ChoiceField(choices=Recipe.LEVEL_CHOICES)
     preparationTimeUnit = ChoiceField(choices=Recipe.PREPARATION_TIME_UNIT_CHOICES)
-    comments = CommentSerializer(many=True)
+    # The first page of active comments, the others come from /api/recipes/<pk>/comments/
+    comments = CommentSerializer(many=True, source='comment_preview')
     user_favourite = serializers.BooleanField(read_only=True)
     user_rating = serializers.IntegerField(min_value=0, max_value=5, read_only=True)
+    imageVariants = ImageVariantsField()
 
     class Meta:
         model = Recipe
         fields = ['id', 'user', 'title', 'description', 'no_of_rating', 'avg_rating',
                   'user_favourite', 'user_rating',
-                  'imageUrl', 'preparationTime', 'preparationTimeUnit',
-                  'level', 'dateAdded',
+                  'imageUrl', 'imageVariants', 'preparationTime', 'preparationTimeUnit',
+                  'level', 'dateAdded', 'kcal', 'comment_count',
                   'categories', 'steps', 'ingredients', 'comments']
 
+    # Heavy nested relations left out of list responses unless requested with ?expand= or ?fields=
+    expandable_fields = ['steps', 'ingredients', 'comments']
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super(RecipeDisplaySerializer, self).__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class RecipeImportIngredientSerializer(serializers.Serializer):
+    # Ingredient by id or name, unit by id, short or full name
+    ingredient = serializers.CharField()
+    unit = serializers.CharField()
+    quantity = serializers.FloatField(min_value=0)
+
+
+# One row of a bulk import. Relations are resolved against the ImportCatalogue in context['catalogue']
+# instead of a query per row, and title uniqueness is checked by the importer for a whole chunk.
+class RecipeImportSerializer(serializers.Serializer):
+    title = serializers.CharField(max_length=150)
+    description = serializers.CharField(max_length=1500)
+    imageUrl = serializers.CharField(max_length=400)
+    preparationTime = serializers.FloatField(min_value=0)
+    preparationTimeUnit = ChoiceField(choices=Recipe.PREPARATION_TIME_UNIT_CHOICES)
+    level = ChoiceField(choices=Recipe.LEVEL_CHOICES, default=Recipe.COMPETENT)
+    categories = serializers.ListField(child=serializers.CharField())
+    steps = StepRecipeSerializer(many=True)
+    ingredients = RecipeImportIngredientSerializer(many=True)
+
+    def validate_categories(self, value):
+        if len(value) == 0:
+            raise serializers.ValidationError("This field cannot be empty!")
+        categories = set()
+        for name in value:
+            category = self.context['catalogue'].categories.get(name)
+            if category is None:
+                raise serializers.ValidationError("Category " + name + " does not exist!")
+            categories.add(category)
+        return sorted(categories)
+
+    def validate_steps(self, value):
+        if len(value) == 0:
+            raise serializers.ValidationError("This field cannot be empty!")
+        if len({step['order'] for step in value}) != len(value):
+            raise serializers.ValidationError("Each recipe step must have a different order field number!")
+        return value
+
+    def validate_ingredients(self, value):
+        if len(value) == 0:
+            raise serializers.ValidationError("This field cannot be empty!")
+        catalogue = self.context['catalogue']
+        ingredients = []
+        for data in value:
+            ingredient = catalogue.ingredients.get(data['ingredient'])
+            if ingredient is None:
+                raise serializers.ValidationError("Ingredient " + data['ingredient'] + " does not exist!")
+            unit = catalogue.units.get(data['unit'])
+            if unit is None:
+                raise serializers.ValidationError("Unit " + data['unit'] + " does not exist!")
+            if unit not in catalogue.allowed_units.get(ingredient, ()):
+                raise serializers.ValidationError({
+                    "message": "Recipe ingredient unit = " + catalogue.unit_names[unit]['short'] +
+                               " is not allowed for ingredient with id = " + str(ingredient) + "!",
+                    "allowed units": [catalogue.unit_names[u] for u in catalogue.allowed_units.get(ingredient, ())]})
+            ingredients.append({'ingredient_id': ingredient, 'unit_id': unit, 'quantity': data['quantity']})
+        if len({data['ingredient_id'] for data in ingredients}) != len(ingredients):
+            raise serializers.ValidationError("Each recipe ingredient must be a different ingredient!")
+        return ingredients
+
 
 class RecipeSerializer(serializers.ModelSerializer):
     # categories = serializers.PrimaryKeyRelatedField(many=True, queryset=Category.objects.all())
@@ -64,84 +145,147 @@ class RecipeSerializer(serializers.ModelSerializer):
     ingredients = RecipeIngredientRecipeSerializer(many=True)
     level = ChoiceField(choices=Recipe.LEVEL_CHOICES)
     preparationTimeUnit = ChoiceField(choices=Recipe.PREPARATION_TIME_UNIT_CHOICES)
+    serializer_related_field = DeferredPrimaryKeyRelatedField
 
     class Meta:
         model = Recipe
         fields = ['id', 'user_id', 'title', 'description', 'no_of_rating', 'avg_rating',
                   'imageUrl', 'preparationTime', 'preparationTimeUnit',
-                  'level', 'dateAdded',
+                  'level', 'dateAdded', 'kcal',
                   'categories', 'steps', 'ingredients']
 
     def validate_steps(self, value):
         if len(value) == 0:
-            return serializers.ValidationError("This field cannot be empty!")
+            raise serializers.ValidationError("This field cannot be empty!")
+        self.require_item_fields(value, ['description', 'order'])
         return value
 
     def validate_ingredients(self, value):
         if len(value) == 0:
-            return serializers.ValidationError("This field cannot be empty!")
+            raise serializers.ValidationError("This field cannot be empty!")
+        self.require_item_fields(value, ['ingredient', 'unit', 'quantity'])
+        if len({data['ingredient'].pk for data in value}) != len(value):
+            raise serializers.ValidationError("Each recipe ingredient must be a different ingredient!")
         return value
 
+    def require_item_fields(self, value, names):
+        # A PATCH makes the nested fields optional too, but a step or ingredient is always given whole
+        errors = [{name: [serializers.Field.default_error_messages['required']] for name in names if name not in item}
+                  for item in value]
+        if any(errors):
+            raise serializers.ValidationError(errors)
+
     def validate_categories(self, value):
         if len(value) == 0:
-            return serializers.ValidationError("This field cannot be empty!")
-        return value
+            raise serializers.ValidationError("This field cannot be empty!")
+        categories, errors = resolve_pks(self.fields['categories'].child_relation, value)
+        for error in errors:
+            if error:
+                raise serializers.ValidationError(error)
+        return categories
+
+    def build_recipe_ingredients(self, recipe, recipe_ingredients_data):
+        # Checks the units against the allowed units of all ingredients, fetched in one query
+        allowed_units = set(Ingredient.allowedUnits.through.objects.filter(
+            ingredient_id__in={data['ingredient'].id for data in recipe_ingredients_data}
+        ).values_list('ingredient_id', 'unit_id'))
+        recipe_ingredients = []
+        for recipe_ingredient_data in recipe_ingredients_data:
+            recipe_ingredient_unit = recipe_ingredient_data['unit']
+            if (recipe_ingredient_data['ingredient'].id, recipe_ingredient_unit.id) not in allowed_units:
+                allowed_ingredient_units = recipe_ingredient_data['ingredient'].allowedUnits.all()
+                serializer = UnitPrintSerializer(allowed_ingredient_units, many=True)
+                response = {"message": "Recipe ingredient unit = " + recipe_ingredient_unit.short +
+                                       " is not allowed for ingredient with id = " +
+                                       str(recipe_ingredient_data['ingredient'].id) + "!",
+                            "allowed units": serializer.data}
+                raise serializers.ValidationError(response)
+            recipe_ingredients.append(RecipeIngredient(recipe=recipe, **recipe_ingredient_data))
+        return recipe_ingredients
 
     def create(self, validated_data):
         steps_data = validated_data.pop('steps')
         recipe_ingredients_data = validated_data.pop('ingredients')
         categories = validated_data.pop('categories')
-        with transaction.atomic():
-            recipe = Recipe.objects.create(**validated_data)
-            recipe.categories.set(categories)
-            for recipe_ingredient_data in recipe_ingredients_data:
-                allowed_ingredient_units = recipe_ingredient_data['ingredient'].allowedUnits.all()
-                recipe_ingredient_unit = recipe_ingredient_data.pop('unit')
-                if recipe_ingredient_unit not in allowed_ingredient_units:
-                    serializer = UnitPrintSerializer(allowed_ingredient_units, many=True)
-                    response = {"message": "Recipe ingredient unit = " + recipe_ingredient_unit.short +
-                                           " is not allowed for ingredient with id = " +
-                                           str(recipe_ingredient_data['ingredient'].id) + "!",
-                                "allowed units": serializer.data}
-                    raise serializers.ValidationError(response)
-                RecipeIngredient.objects.create(recipe=recipe, unit=recipe_ingredient_unit,
-                                                **recipe_ingredient_data)
-            for step_data in steps_data:
-                try:
-                    Step.objects.create(recipe=recipe, **step_data)
-                except IntegrityError as e:
-                    response = {"steps": ["Each recipe step must have a different order field number!"]}
-                    raise serializers.ValidationError(response)
+        self.check_step_orders(steps_data)
 
+        def create_recipe():
+            # The receivers of the recipe row and its categories would each reindex and touch it again
+            with bulk_recipe_changes():
+                recipe = Recipe.objects.create(**validated_data)
+                recipe.categories.set(categories)
+                RecipeIngredient.objects.bulk_create(self.build_recipe_ingredients(recipe, recipe_ingredients_data))
+                Step.objects.bulk_create([Step(recipe=recipe, **step_data) for step_data in steps_data])
+            bulk_recipes_changed([recipe.id])
+            recipe.refresh_from_db(fields=['kcal'])
             return recipe
+        return retry_atomic(create_recipe)
 
+    # steps and ingredients given to an update are the complete new lists, only the differences to the
+    # current rows are written
     def update(self, instance, validated_data):
-        steps_data = validated_data.get('steps')
-        recipe_ingredients_data = validated_data.get('ingredients')
-        categories = validated_data.get('categories')
-        with transaction.atomic():
+        steps_data = validated_data.pop('steps', None)
+        recipe_ingredients_data = validated_data.pop('ingredients', None)
+        categories = validated_data.pop('categories', None)
+
+        def update_recipe():
+            super(RecipeSerializer, self).update(instance, validated_data)
 
             if categories is not None:
-                validated_data.pop('categories')
-                instance.categories.add(*categories)
-
-            if steps_data is not None:
-                validated_data.pop('steps')
-                for step_data in steps_data:
-                    Step.objects.create(recipe=instance, **step_data)
-
-            if recipe_ingredients_data is not None:
-                validated_data.pop('ingredients')
-                for recipe_ingredient_data in recipe_ingredients_data:
-                    allowed_ingredient_units = recipe_ingredient_data['ingredient'].allowedUnits.all()
-                    recipe_ingredient_unit = recipe_ingredient_data.pop('unit')
-                    if recipe_ingredient_unit not in allowed_ingredient_units:
-                        serializer = UnitPrintSerializer(allowed_ingredient_units, many=True)
-                        response = {"message": "Recipe ingredient unit = " + recipe_ingredient_unit.short +
-                                               " is not allowed for ingredient with id = " +
-                                               str(recipe_ingredient_data['ingredient'].id) + "!",
-                                    "allowed units": serializer.data}
-                        raise serializers.ValidationError(response)
-                    RecipeIngredient.objects.create(recipe=instance, unit=recipe_ingredient_unit,
-                                                    **recipe_ingredient_data)
-            return super(RecipeSerializer, self).update(instance, validated_data)
+                instance.categories.set(categories)
+
+            if steps_data is not None or recipe_ingredients_data is not None:
+                with bulk_recipe_changes():
+                    if steps_data is not None:
+                        self.update_steps(instance, steps_data)
+                    if recipe_ingredients_data is not None:
+                        self.update_recipe_ingredients(instance, recipe_ingredients_data)
+                bulk_recipes_changed([instance.id])
+                instance.refresh_from_db(fields=['kcal'])
+            return instance
+        return retry_atomic(update_recipe)
+
+    def check_step_orders(self, steps_data):
+        if len({step_data['order'] for step_data in steps_data}) != len(steps_data):
+            response = {"steps": ["Each recipe step must have a different order field number!"]}
+            raise serializers.ValidationError(response)
+
+    def update_steps(self, recipe, steps_data):
+        # Steps are matched by order, so unique_together(recipe, order) holds after every statement
+        self.check_step_orders(steps_data)
+        current = {step.order: step for step in recipe.steps.all()}
+        created, changed = [], []
+        for step_data in steps_data:
+            step = current.pop(step_data['order'], None)
+            if step is None:
+                created.append(Step(recipe=recipe, **step_data))
+            elif any(getattr(step, name) != value for name, value in step_data.items()):
+                for name, value in step_data.items():
+                    setattr(step, name, value)
+                changed.append(step)
+        if current:
+            Step.objects.filter(pk__in=[step.pk for step in current.values()]).delete()
+        if changed:
+            Step.objects.bulk_update(changed, ['description', 'imageUrl'])
+        if created:
+            Step.objects.bulk_create(created)
+
+    def update_recipe_ingredients(self, recipe, recipe_ingredients_data):
+        # Matched by ingredient, unique_together(recipe, ingredient)
+        current = {recipe_ingredient.ingredient_id: recipe_ingredient
+                   for recipe_ingredient in recipe.ingredients.all()}
+        created, changed = [], []
+        for recipe_ingredient in self.build_recipe_ingredients(recipe, recipe_ingredients_data):
+            existing = current.pop(recipe_ingredient.ingredient_id, None)
+            if existing is None:
+                created.append(recipe_ingredient)
+            elif (existing.unit_id, existing.quantity) != (recipe_ingredient.unit_id, recipe_ingredient.quantity):
+                existing.unit_id = recipe_ingredient.unit_id
+                existing.quantity = recipe_ingredient.quantity
+                changed.append(existing)
+        if current:
+            RecipeIngredient.objects.filter(pk__in=[ri.pk for ri in current.values()]).delete()
+        if changed:
+            RecipeIngredient.objects.bulk_update(changed, ['unit', 'quantity'])
+        if created:
+            RecipeIngredient.objects.bulk_create(created)
@@ -0,0 +1,59 @@
+from collections.abc import Mapping
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from rest_framework import serializers
+
+
+class DeferredPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Validates only the type of the primary key. The instances are looked up afterwards with resolve_pks,
+    one query for all the items of a list instead of one per item.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            return self.get_queryset().model._meta.pk.to_python(data)
+        except (DjangoValidationError, TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
+def resolve_pks(field, pks):
+    """(instances in the order of pks, errors in the order of pks with None for the ones found)."""
+    instances = field.get_queryset().in_bulk(set(pks))
+    errors = [None if pk in instances else
+              [field.error_messages['does_not_exist'].format(pk_value=pk)] for pk in pks]
+    return [instances.get(pk) for pk in pks], errors
+
+
+class ResolvingListSerializer(serializers.ListSerializer):
+    """Replaces the primary keys left by the DeferredPrimaryKeyRelatedFields of its items with instances."""
+
+    def to_internal_value(self, data):
+        try:
+            items = super(ResolvingListSerializer, self).to_internal_value(data)
+            errors = [{} for _ in items]
+            valid = True
+        except serializers.ValidationError as e:
+            if not isinstance(e.detail, list):
+                raise
+            # The unknown pks are still reported next to the other errors, as with a lookup per item
+            items, errors, valid = data, e.detail, False
+
+        for name, field in self.child.fields.items():
+            if not isinstance(field, DeferredPrimaryKeyRelatedField) or field.read_only:
+                continue
+            present = [position for position, item in enumerate(items)
+                       if isinstance(item, Mapping) and name in item and name not in errors[position]]
+            pks = [field.to_internal_value(items[position][name]) for position in present]
+            instances, field_errors = resolve_pks(field, pks)
+            for position, instance, field_error in zip(present, instances, field_errors):
+                if field_error:
+                    errors[position][name] = field_error
+                elif valid:
+                    items[position][name] = instance
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
@@ -1,14 +1,16 @@
 from rest_framework import serializers
 
 from api.models import Comment, Favorite, Rating, Category, Step
+from api.serializers.fields import ImageVariantsField
 
 
 class StepSerializer(serializers.ModelSerializer):
     recipe = serializers.PrimaryKeyRelatedField(read_only=True)
+    imageVariants = ImageVariantsField()
 
     class Meta:
         model = Step
-        fields = ['id', 'recipe', 'description', 'order', 'imageUrl']
+        fields = ['id', 'recipe', 'description', 'order', 'imageUrl', 'imageVariants']
 
 
 class StepCreateSerializer(serializers.ModelSerializer):
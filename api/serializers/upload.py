@@ -0,0 +1,43 @@
+import re
+
+from django.conf import settings
+from rest_framework import exceptions, serializers
+
+from api.models import UploadSession
+from api.uploads import TARGET_MODELS
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'target', 'target_id', 'size', 'sha256', 'offset', 'imageUrl', 'created_at']
+        read_only_fields = ['offset', 'imageUrl', 'created_at']
+
+    def validate_size(self, value):
+        if value == 0 or value > settings.IMAGE_MAX_UPLOAD_SIZE:
+            raise serializers.ValidationError(
+                "Images can have at most {} bytes!".format(settings.IMAGE_MAX_UPLOAD_SIZE))
+        return value
+
+    def validate_sha256(self, value):
+        value = value.lower()
+        if not re.fullmatch('[0-9a-f]{64}', value):
+            raise serializers.ValidationError("This has to be a hex encoded SHA-256 digest!")
+        return value
+
+    def validate(self, data):
+        target = TARGET_MODELS[data['target']].objects.filter(pk=data['target_id']).first()
+        if target is None:
+            raise serializers.ValidationError(
+                {"target_id": ["There is no {} with id = {}!".format(data['target'], data['target_id'])]})
+        user = self.context['request'].user
+        if data['target'] == UploadSession.RECIPE:
+            allowed = target.user_id == user.id
+        elif data['target'] == UploadSession.STEP:
+            allowed = target.recipe.user_id == user.id
+        else:
+            allowed = user.is_staff
+        if not allowed:
+            raise exceptions.PermissionDenied("You can not change the image of this {}!".format(data['target']))
+        return data
@@ -0,0 +1,258 @@
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from api import authentication, cache as response_cache, nutrition, pantry, search
+from api.models import Category, Comment, Favorite, Ingredient, Rating, Recipe, RecipeIngredient, Step, Unit, \
+    User
+
+
+def invalidate_recipes(recipe_ids):
+    # Bumped right away so this process stops serving the old documents, and again after the commit so a
+    # read racing with the transaction cannot leave pre-commit data cached under the new version
+    response_cache.recipes_changed(recipe_ids)
+    transaction.on_commit(lambda: response_cache.recipes_changed(recipe_ids))
+
+
+_bulk = threading.local()
+
+
+@contextmanager
+def bulk_recipe_changes():
+    # Silences the per-row receivers of saved recipes, their categories, steps and recipe ingredients, e.g. for the
+    # cascade of a QuerySet.delete, the caller runs bulk_recipes_changed once afterwards
+    _bulk.depth = getattr(_bulk, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _bulk.depth -= 1
+
+
+def _in_bulk():
+    return getattr(_bulk, 'depth', 0) > 0
+
+
+def bulk_recipes_changed(recipe_ids):
+    # bulk_create / bulk_update / QuerySet.update send no signals, bulk writers call this for the recipes
+    # they touched instead
+    recipe_ids = list(recipe_ids)
+    Recipe.objects.touch(recipe_ids)
+    nutrition.update_kcal(recipe_ids)
+    search.index_recipes(recipe_ids)
+    transaction.on_commit(lambda: pantry.index.recipes_changed(recipe_ids))
+    invalidate_recipes(recipe_ids)
+
+
+def invalidate_catalogue():
+    response_cache.catalogue_changed()
+    transaction.on_commit(response_cache.catalogue_changed)
+
+
+# Rating aggregates follow every save and delete, wherever it happens (views, admin, shell). The previous
+# row is read inside the saving transaction, so concurrent updates do not apply their deltas to the same stars.
+@receiver(pre_save, sender=Rating)
+def rating_saving(sender, instance, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        instance._stored_rating = None
+    else:
+        instance._stored_rating = Rating.objects.filter(pk=instance.pk).values_list('recipe_id', 'stars').first()
+
+
+@receiver(post_save, sender=Rating)
+def rating_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    stored = getattr(instance, '_stored_rating', None)
+    if stored is None:
+        Recipe.objects.adjust_rating(instance.recipe_id, 1, instance.stars)
+    elif stored[0] == instance.recipe_id:
+        if stored[1] != instance.stars:
+            Recipe.objects.adjust_rating(instance.recipe_id, 0, instance.stars - stored[1])
+    else:
+        Recipe.objects.adjust_rating(stored[0], -1, -stored[1])
+        Recipe.objects.adjust_rating(instance.recipe_id, 1, instance.stars)
+
+
+# Covers RatingViewSet.destroy as well as ratings removed by a user or recipe cascade
+@receiver(post_delete, sender=Rating)
+def rating_deleted(sender, instance, **kwargs):
+    Recipe.objects.adjust_rating(instance.recipe_id, -1, -instance.stars)
+
+
+@receiver(post_save, sender=Comment)
+def comment_saved(sender, instance, created, **kwargs):
+    if not created:
+        # isActive may have changed
+        Recipe.objects.count_comments([instance.recipe_id])
+    elif instance.isActive:
+        Recipe.objects.adjust_comment_count(instance.recipe_id, 1)
+
+
+@receiver(post_delete, sender=Comment)
+def comment_deleted(sender, instance, **kwargs):
+    if instance.isActive:
+        Recipe.objects.adjust_comment_count(instance.recipe_id, -1)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def recipe_changed(sender, instance, signal, **kwargs):
+    if _in_bulk() and signal is post_save:
+        return
+    invalidate_recipes([instance.id])
+
+
+@receiver(post_save, sender=Step)
+@receiver(post_delete, sender=Step)
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+def recipe_part_changed(sender, instance, **kwargs):
+    if _in_bulk() and sender in (Step, RecipeIngredient):
+        return
+    Recipe.objects.touch([instance.recipe_id])
+    invalidate_recipes([instance.recipe_id])
+
+
+@receiver(m2m_changed, sender=Recipe.categories.through)
+def recipe_categories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_') or (_in_bulk() and not reverse):
+        return
+    if not reverse:
+        Recipe.objects.touch([instance.id])
+        invalidate_recipes([instance.id])
+    elif pk_set:
+        Recipe.objects.touch(pk_set)
+        invalidate_recipes(pk_set)
+    else:
+        invalidate_catalogue()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, **kwargs):
+    response_cache.model_changed(Category)
+    invalidate_catalogue()
+
+
+@receiver(post_save, sender=Favorite)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_save, sender=Rating)
+@receiver(post_delete, sender=Rating)
+def user_overlay_changed(sender, instance, **kwargs):
+    response_cache.user_changed(instance.user_id)
+
+
+# Ingredients are displayed with their units nested
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+@receiver(m2m_changed, sender=Ingredient.allowedUnits.through)
+@receiver(post_save, sender=Unit)
+@receiver(post_delete, sender=Unit)
+def reference_data_changed(sender, **kwargs):
+    if sender is Unit:
+        response_cache.model_changed(Unit)
+    response_cache.model_changed(Ingredient)
+
+
+# Full-text search index
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved_for_search(sender, instance, **kwargs):
+    if _in_bulk():
+        return
+    search.index_recipes([instance.id])
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted_for_search(sender, instance, **kwargs):
+    search.unindex_recipes([instance.id])
+
+
+@receiver(post_save, sender=Step)
+@receiver(post_delete, sender=Step)
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_text_changed(sender, instance, **kwargs):
+    if _in_bulk():
+        return
+    search.index_recipes([instance.recipe_id])
+
+
+@receiver(m2m_changed, sender=Recipe.categories.through)
+def recipe_categories_changed_for_search(sender, instance, action, reverse, pk_set, **kwargs):
+    if action.startswith('post_') and not (_in_bulk() and not reverse):
+        search.index_recipes((pk_set or []) if reverse else [instance.id])
+
+
+@receiver(post_save, sender=Category)
+def category_renamed(sender, instance, created, **kwargs):
+    if not created:
+        search.index_recipes(instance.recipe_set.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleting(sender, instance, **kwargs):
+    # The recipe links go away in a cascade that sends no m2m_changed
+    instance.search_recipe_ids = list(instance.recipe_set.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    search.index_recipes(getattr(instance, 'search_recipe_ids', []))
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_renamed(sender, instance, created, **kwargs):
+    if not created:
+        search.index_recipes(RecipeIngredient.objects.filter(ingredient=instance).values_list('recipe_id', flat=True))
+
+
+# Pantry matching index, in memory so only committed changes are applied
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredients_changed(sender, instance, **kwargs):
+    if _in_bulk():
+        return
+    transaction.on_commit(lambda: pantry.index.recipes_changed([instance.recipe_id]))
+
+
+# Materialized recipe calories
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_changed_for_nutrition(sender, instance, **kwargs):
+    if _in_bulk():
+        return
+    nutrition.update_kcal([instance.recipe_id])
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_save, sender=Unit)
+def nutrition_basis_changed(sender, instance, created, **kwargs):
+    # Only recipes whose total actually moved are written, so e.g. a rename costs a single read
+    if created:
+        return
+    if sender is Ingredient:
+        recipes = Q(ingredient=instance)
+    else:
+        recipes = Q(unit=instance) | Q(ingredient__unit=instance)
+    changed = nutrition.update_kcal(RecipeIngredient.objects.filter(recipes).values_list('recipe_id', flat=True))
+    if changed:
+        invalidate_recipes(changed)
+
+
+# Cached identities of CachedJWTAuthentication
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def user_changed(sender, instance, **kwargs):
+    authentication.identities.delete(instance.pk)
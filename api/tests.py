@@ -1,3 +1,1149 @@
-from django.test import TestCase
+import base64
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+import requests
+from PIL import Image
+from rest_framework import serializers
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from api import authentication, cache as response_cache, images, pantry, recaptcha, routers, search, uploads
+from api.db import retry_atomic
+from api.models import Category, Comment, Favorite, Ingredient, Rating, Recipe, RecipeIngredient, RecipeScore, Step, \
+    Unit, UploadSession, User
+
+
+def create_recipe(user, title, category, ingredient, unit):
+    recipe = Recipe.objects.create(user=user, title=title, description='Description of ' + title,
+                                   imageUrl='', preparationTime=30, preparationTimeUnit=Recipe.MINUTES)
+    recipe.categories.set([category])
+    RecipeIngredient.objects.create(recipe=recipe, ingredient=ingredient, unit=unit, quantity=100)
+    Step.objects.create(recipe=recipe, description='Step one', order=1)
+    Step.objects.create(recipe=recipe, description='Step two', order=2)
+    Comment.objects.create(user=user, recipe=recipe, content='Tasty!')
+    Rating.objects.create(user=user, recipe=recipe, stars=4)
+    return recipe
+
+
+# The configured file cache may be a developer's or a server's, the tests clear theirs
+TEST_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class APITestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        authentication.identities.clear()
+        self.client = APIClient()
+
+    def assertWithinQueryBudget(self, response):
+        # Budgets per ViewSet.action are in settings.QUERY_BUDGETS
+        view, queries = response.metrics.view, response.metrics.queries
+        self.assertIn(view, settings.QUERY_BUDGETS, 'No query budget for {}'.format(view))
+        self.assertLessEqual(queries, settings.QUERY_BUDGETS[view], '{} ran {} queries, its budget is {}'.format(
+            view, queries, settings.QUERY_BUDGETS[view]))
+
+
+class RecipeQueryBudgetTest(APITestCase):
+    # recipes + categories, the summary representation
+    LIST_QUERIES = 2
+    # updated_at validator + recipe + categories + ingredients + steps + comments
+    RETRIEVE_QUERIES = 6
+    # user's ratings + favourites of the recipes being returned
+    OVERLAY_QUERIES = 2
+
+    def setUp(self):
+        super(RecipeQueryBudgetTest, self).setUp()
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        self.category = Category.objects.create(name='Desserts')
+        self.unit = Unit.objects.create(full='gram', short='g')
+        self.ingredient = Ingredient.objects.create(name='Sugar', quantity=100, unit=self.unit, kcal=387)
+        self.ingredient.allowedUnits.set([self.unit])
+
+    def create_recipes(self, count):
+        start = Recipe.objects.count()
+        return [create_recipe(self.user, 'Recipe {}'.format(start + i), self.category, self.ingredient, self.unit)
+                for i in range(count)]
+
+    def test_list_query_count_does_not_grow_with_recipes(self):
+        self.create_recipes(2)
+        with self.assertNumQueries(self.LIST_QUERIES):
+            response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+
+        self.create_recipes(10)
+        with self.assertNumQueries(self.LIST_QUERIES):
+            response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 12)
+
+    def test_authenticated_list_applies_overlay_in_constant_queries(self):
+        recipes = self.create_recipes(5)
+        Favorite.objects.create(user=self.user, recipe=recipes[1])
+        self.client.force_authenticate(self.user)
+        with self.assertNumQueries(self.LIST_QUERIES + self.OVERLAY_QUERIES):
+            response = self.client.get('/api/recipes/')
+        self.assertWithinQueryBudget(response)
+        by_id = {r['id']: r for r in response.data['results']}
+        self.assertEqual(by_id[recipes[0].id]['user_rating'], 4)
+        self.assertTrue(by_id[recipes[1].id]['user_favourite'])
+        self.assertNotIn('user_favourite', by_id[recipes[0].id])
+
+    def test_list_prefetches_only_selected_relations(self):
+        self.create_recipes(3)
+        with self.assertNumQueries(self.LIST_QUERIES + 1):
+            response = self.client.get('/api/recipes/?expand=steps')
+        recipe = response.data['results'][0]
+        self.assertEqual(len(recipe['steps']), 2)
+        self.assertNotIn('ingredients', recipe)
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/recipes/?fields=id,title')
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title'})
+
+        response = self.client.get('/api/recipes/?fields=id,secret')
+        self.assertEqual(response.status_code, 400)
+
+    def test_retrieve_query_count(self):
+        recipe = self.create_recipes(1)[0]
+        with self.assertNumQueries(self.RETRIEVE_QUERIES):
+            response = self.client.get('/api/recipes/{}/'.format(recipe.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinQueryBudget(response)
+        self.assertEqual(response.data['no_of_rating'], 1)
+        self.assertEqual(response.data['avg_rating'], 4)
+        self.assertEqual([s['order'] for s in response.data['steps']], [1, 2])
+
+    def post_recipe(self, title, ingredients, steps):
+        return self.client.post('/api/recipes/', {
+            'title': title, 'description': 'Sweet', 'imageUrl': 'cake.png', 'preparationTime': 1,
+            'preparationTimeUnit': 'hours', 'level': 'expert', 'categories': [self.category.id],
+            'steps': [{'description': 'Step', 'order': i + 1} for i in range(steps)],
+            'ingredients': [{'ingredient': ingredient.id, 'unit': self.unit.id, 'quantity': 10}
+                            for ingredient in ingredients],
+        }, format='json')
+
+    def test_create_query_count_does_not_grow_with_nested_items(self):
+        self.client.force_authenticate(self.user)
+        ingredients = [self.ingredient]
+        for i in range(10):
+            ingredient = Ingredient.objects.create(name='Spice {}'.format(i), quantity=1, unit=self.unit, kcal=1)
+            ingredient.allowedUnits.set([self.unit])
+            ingredients.append(ingredient)
+
+        with CaptureQueriesContext(connection) as small:
+            self.assertEqual(self.post_recipe('Small', ingredients[:2], 2).status_code, 201)
+        with CaptureQueriesContext(connection) as large:
+            self.assertEqual(self.post_recipe('Large', ingredients, 10).status_code, 201)
+        self.assertEqual(len(small), len(large))
+        self.assertEqual(Recipe.objects.get(title='Large').ingredients.count(), 11)
+        # The search document is written and the recipe touched once, not again by every receiver
+        statements = [query['sql'] for query in large]
+        self.assertEqual(sum('INSERT INTO api_recipe_fts' in sql for sql in statements), 1)
+        self.assertEqual(sum(sql.startswith('UPDATE "api_recipe" SET "updated_at"') for sql in statements), 1)
+
+        response = self.post_recipe('Twice', [self.ingredient, self.ingredient], 1)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ingredients', response.data)
+
+        kilogram = Unit.objects.create(full='kilogram', short='kg')
+        self.ingredient.allowedUnits.set([kilogram])
+        response = self.post_recipe('Bad', [self.ingredient], 1)
+        self.assertEqual(response.data['message'], 'Recipe ingredient unit = g is not allowed for ingredient with '
+                                                   'id = {}!'.format(self.ingredient.id))
+
+
+class RatingAggregatesTest(APITestCase):
+
+    def setUp(self):
+        super(RatingAggregatesTest, self).setUp()
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        self.client.force_authenticate(self.user)
+        unit = Unit.objects.create(full='gram', short='g')
+        ingredient = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        self.recipe = create_recipe(self.user, 'Cake', Category.objects.create(name='Desserts'), ingredient, unit)
+
+    def assertAggregates(self, count, total):
+        self.recipe.refresh_from_db()
+        self.assertEqual((self.recipe.rating_count, self.recipe.rating_sum), (count, total))
+
+    def test_rate_and_delete_keep_aggregates_in_sync(self):
+        Rating.objects.filter(recipe=self.recipe).delete()
+        self.assertAggregates(0, 0)
+
+        self.client.post('/api/recipes/{}/rate/'.format(self.recipe.id), {'stars': 5})
+        self.assertAggregates(1, 5)
+        self.client.post('/api/recipes/{}/rate/'.format(self.recipe.id), {'stars': 2})
+        self.assertAggregates(1, 2)
+
+        rating = Rating.objects.get(recipe=self.recipe)
+        self.client.delete('/api/ratings/{}/'.format(rating.id))
+        self.assertAggregates(0, 0)
+
+    def test_ratings_saved_outside_the_views_keep_aggregates_in_sync(self):
+        rating = Rating.objects.get(recipe=self.recipe)
+        rating.stars = 2
+        rating.save()
+        self.assertAggregates(1, 2)
+
+        other = User.objects.create_user(username='baker', email='baker@example.com', password='Secret123!')
+        Rating.objects.create(user=other, recipe=self.recipe, stars=5)
+        self.assertAggregates(2, 7)
+
+
+class KeysetPaginationTest(APITestCase):
+
+    def setUp(self):
+        super(KeysetPaginationTest, self).setUp()
+        user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        unit = Unit.objects.create(full='gram', short='g')
+        ingredient = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        category = Category.objects.create(name='Desserts')
+        self.recipes = [create_recipe(user, 'Recipe {}'.format(i), category, ingredient, unit) for i in range(7)]
+
+    def test_pages_walk_the_whole_catalogue_once(self):
+        seen = []
+        pages = []
+        url = '/api/recipes/?page_size=3'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.data)
+            seen += [r['id'] for r in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, sorted((r.id for r in self.recipes), reverse=True))
+        self.assertEqual([len(p['results']) for p in pages], [3, 3, 1])
+
+        response = self.client.get(pages[2]['previous'])
+        self.assertEqual(response.data['results'], pages[1]['results'])
+
+    def test_edited_recipes_keep_their_place(self):
+        first = self.client.get('/api/recipes/?page_size=3').data
+        # As an edit on a later day does
+        Recipe.objects.filter(pk=self.recipes[0].pk).update(dateAdded=timezone.now().date() + timedelta(days=1))
+        second = self.client.get(first['next']).data
+        self.assertEqual([r['id'] for r in first['results'] + second['results']],
+                         sorted((r.id for r in self.recipes), reverse=True)[:6])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/recipes/?cursor=garbage')
+        self.assertEqual(response.status_code, 404)
+        for values in (['one'], [{'a': 1}], [None], [True]):
+            cursor = base64.urlsafe_b64encode(json.dumps({'v': values}).encode('utf-8')).decode('ascii')
+            self.assertEqual(self.client.get('/api/recipes/?cursor=' + cursor).status_code, 404, values)
+
+
+@override_settings(COMMENTS_PAGE_SIZE=3)
+class RecipeCommentsTest(APITestCase):
+
+    def setUp(self):
+        super(RecipeCommentsTest, self).setUp()
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        unit = Unit.objects.create(full='gram', short='g')
+        ingredient = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        category = Category.objects.create(name='Desserts')
+        self.cake, self.pie = [create_recipe(self.user, title, category, ingredient, unit) for title in ('Cake', 'Pie')]
+        # create_recipe adds one comment, the hidden one is left out of the count and the pages
+        self.hidden = Comment.objects.create(user=self.user, recipe=self.cake, content='Spam', isActive=False)
+        self.comments = [self.cake.comments.get(isActive=True)] + [
+            Comment.objects.create(user=self.user, recipe=self.cake, content='Comment {}'.format(i)) for i in range(6)]
+
+    def test_pages_of_active_comments(self):
+        seen = []
+        url = '/api/recipes/{}/comments/?page_size=4'.format(self.cake.id)
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertWithinQueryBudget(response)
+            seen += [comment['id'] for comment in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, [comment.id for comment in self.comments])
+        self.assertEqual(self.client.get('/api/recipes/0/comments/').status_code, 404)
+
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/recipes/{}/comments/'.format(self.pie.id), {'content': 'Nice'})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(self.client.get('/api/recipes/{}/comments/'.format(self.pie.id)).data['results']), 2)
+
+    def test_recipes_carry_count_and_first_page(self):
+        response = self.client.get('/api/recipes/{}/'.format(self.cake.id))
+        self.assertEqual(response.data['comment_count'], 7)
+        self.assertEqual([comment['id'] for comment in response.data['comments']],
+                         [comment.id for comment in self.comments[:3]])
+
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/recipes/?expand=comments')
+        by_id = {recipe['id']: recipe for recipe in response.data['results']}
+        self.assertEqual([len(by_id[recipe.id]['comments']) for recipe in (self.cake, self.pie)], [3, 1])
+        self.assertEqual(by_id[self.pie.id]['comment_count'], 1)
+
+    def test_count_follows_changes(self):
+        self.hidden.isActive = True
+        self.hidden.save()
+        self.comments[0].delete()
+        self.cake.refresh_from_db()
+        self.assertEqual(self.cake.comment_count, 7)
+
+        Recipe.objects.filter(pk=self.cake.pk).update(comment_count=0, updated_at=timezone.now())
+        url = '/api/recipes/{}/'.format(self.cake.id)
+        etag = self.client.get(url)['ETag']
+        call_command('rebuild_recipe_aggregates', stdout=StringIO())
+        self.cake.refresh_from_db()
+        self.assertEqual(self.cake.comment_count, 7)
+        # The repaired count is not hidden behind the cached document
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['comment_count'], 7)
+
+
+class LeaderboardTest(APITestCase):
+
+    def setUp(self):
+        super(LeaderboardTest, self).setUp()
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        unit = Unit.objects.create(full='gram', short='g')
+        ingredient = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        self.desserts, self.soups = Category.objects.create(name='Desserts'), Category.objects.create(name='Soups')
+        self.cake, self.pie = [create_recipe(self.user, title, self.desserts, ingredient, unit)
+                               for title in ('Cake', 'Pie')]
+        self.soup = create_recipe(self.user, 'Soup', self.soups, ingredient, unit)
+        # The single 5 star rating is damped below many 4.5 star ones
+        Recipe.objects.filter(pk=self.cake.pk).update(rating_count=1, rating_sum=5)
+        Recipe.objects.filter(pk=self.pie.pk).update(rating_count=40, rating_sum=180)
+        Recipe.objects.filter(pk=self.soup.pk).update(rating_count=10, rating_sum=30)
+        Rating.objects.filter(recipe=self.pie).update(created_at=timezone.now() - timedelta(days=20))
+        # Given before created_at was recorded, left out of trending
+        old = Rating.objects.create(user=User.objects.create(username='old', email='old@example.com'),
+                                    recipe=self.pie, stars=5)
+        Rating.objects.filter(pk=old.pk).update(created_at=None)
+        Favorite.objects.create(user=self.user, recipe=self.soup)
+
+    def ids(self, response):
+        self.assertEqual(response.status_code, 200)
+        return [result['recipe']['id'] for result in response.data]
+
+    def test_boards(self):
+        self.assertEqual(self.client.get('/api/recipes/top/').data, [])
+        call_command('refresh_leaderboards', stdout=StringIO())
+
+        response = self.client.get('/api/recipes/top/')
+        self.assertWithinQueryBudget(response)
+        self.assertEqual(self.ids(response), [self.pie.id, self.cake.id, self.soup.id])
+        self.assertEqual([result['rank'] for result in response.data], [1, 2, 3])
+        self.assertEqual(self.ids(self.client.get('/api/recipes/top/?category={}&limit=1'.format(
+            self.desserts.id))), [self.pie.id])
+        # Recent ratings and the favourite outweigh the old ratings
+        self.assertEqual(self.ids(self.client.get('/api/recipes/top/?board=trending')),
+                         [self.soup.id, self.cake.id, self.pie.id])
+
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/recipes/top/?board=trending&category={}'.format(self.soups.id))
+        self.assertWithinQueryBudget(response)
+        self.assertTrue(response.data[0]['recipe']['user_favourite'])
+        self.assertEqual(self.client.get('/api/recipes/top/?board=best').status_code, 400)
+
+        self.pie.delete()
+        call_command('refresh_leaderboards', stdout=StringIO())
+        self.assertFalse(RecipeScore.objects.filter(recipe_id=self.pie.id).exists())
+        self.assertEqual(RecipeScore.objects.filter(board=RecipeScore.TOP, category=None).count(), 2)
+
+
+class RecipeResponseCacheTest(APITestCase):
+
+    def setUp(self):
+        super(RecipeResponseCacheTest, self).setUp()
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        unit = Unit.objects.create(full='gram', short='g')
+        ingredient = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        self.category = Category.objects.create(name='Desserts')
+        self.recipe = create_recipe(self.user, 'Cake', self.category, ingredient, unit)
+
+    def test_anonymous_reads_are_served_from_cache_until_a_change(self):
+        url = '/api/recipes/{}/'.format(self.recipe.id)
+        self.client.get(url)
+        # Only the conditional GET validator
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual(response.data['categories'], [{'id': self.category.id, 'name': 'Desserts'}])
+
+        self.category.name = 'Cakes'
+        self.category.save()
+        response = self.client.get(url)
+        self.assertEqual(response.data['categories'][0]['name'], 'Cakes')
+
+        self.client.get('/api/recipes/')
+        Step.objects.create(recipe=self.recipe, description='Step three', order=3)
+        response = self.client.get('/api/recipes/?expand=steps')
+        self.assertEqual(len(response.data['results'][0]['steps']), 3)
+
+    def test_authenticated_reads_only_add_the_overlay(self):
+        self.client.get('/api/recipes/')
+        self.client.force_authenticate(self.user)
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/recipes/')
+        self.assertEqual(response.data['results'][0]['user_rating'], 4)
+
+        self.client.force_authenticate(None)
+        response = self.client.get('/api/recipes/')
+        self.assertNotIn('user_rating', response.data['results'][0])
+
+
+class ConditionalGetTest(APITestCase):
+
+    def setUp(self):
+        super(ConditionalGetTest, self).setUp()
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        unit = Unit.objects.create(full='gram', short='g')
+        self.ingredient = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        self.recipe = create_recipe(self.user, 'Cake', Category.objects.create(name='Desserts'), self.ingredient, unit)
+
+    def test_recipe_not_modified_until_it_changes(self):
+        url = '/api/recipes/{}/'.format(self.recipe.id)
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Comment.objects.create(user=self.user, recipe=self.recipe, content='Even better the next day.')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_edit_within_the_same_second_is_modified(self):
+        url = '/api/recipes/{}/'.format(self.recipe.id)
+        cache.set(response_cache.GLOBAL_STAMP_KEY, 1000.0, None)
+
+        def edit(stamp):
+            Recipe.objects.filter(pk=self.recipe.pk).update(
+                updated_at=datetime.fromtimestamp(stamp, tz=dt_timezone.utc))
+
+        edit(1000.25)
+        with mock.patch('api.conditional.time.time', return_value=1000.5):
+            # Truncated to whole seconds this would be 1000, the same as for the next edit
+            self.assertNotIn('Last-Modified', self.client.get(url))
+        edit(1000.75)
+        with mock.patch('api.conditional.time.time', return_value=1000.9):
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date(1000)).status_code, 200)
+        with mock.patch('api.conditional.time.time', return_value=1001.5):
+            last_modified = self.client.get(url)['Last-Modified']
+            self.assertEqual(last_modified, http_date(1001))
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def test_favourite_changes_the_authenticated_etag(self):
+        self.client.force_authenticate(self.user)
+        etag = self.client.get('/api/recipes/')['ETag']
+        self.assertEqual(self.client.get('/api/recipes/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Favorite.objects.create(user=self.user, recipe=self.recipe)
+        self.assertEqual(self.client.get('/api/recipes/', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_reference_data(self):
+        response = self.client.get('/api/ingredients/')
+        self.assertEqual(self.client.get('/api/ingredients/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.ingredient.kcal = 400
+        self.ingredient.save()
+        self.assertEqual(self.client.get('/api/ingredients/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+
+class RecipeSearchTest(APITestCase):
+
+    def setUp(self):
+        super(RecipeSearchTest, self).setUp()
+        user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        unit = Unit.objects.create(full='gram', short='g')
+        self.sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        category = Category.objects.create(name='Desserts')
+        self.pie = create_recipe(user, 'Apple pie', category, self.sugar, unit)
+        self.cake = create_recipe(user, 'Sponge cake', category, self.sugar, unit)
+        Step.objects.create(recipe=self.cake, description='Serve with apple sauce', order=3)
+
+    def search(self, text):
+        response = self.client.get('/api/recipes/', {'q': text})
+        self.assertEqual(response.status_code, 200)
+        return [recipe['id'] for recipe in response.data['results']]
+
+    def test_ranks_title_matches_first(self):
+        self.assertEqual(self.search('apple'), [self.pie.id, self.cake.id])
+        self.assertEqual(self.search('spong'), [self.cake.id])
+
+        response = self.client.get('/api/recipes/', {'q': 'apple', 'page_size': 1})
+        response = self.client.get(response.data['next'])
+        self.assertEqual([recipe['id'] for recipe in response.data['results']], [self.cake.id])
+        # FTS5 syntax in the input is not interpreted
+        self.assertEqual(set(self.search('"sugar*')), {self.pie.id, self.cake.id})
+
+    def test_index_follows_changes(self):
+        self.sugar.name = 'Honey'
+        self.sugar.save()
+        self.assertEqual(len(self.search('honey')), 2)
+        self.assertEqual(self.search('sugar'), [])
+
+        self.cake.delete()
+        self.assertEqual(self.search('apple'), [self.pie.id])
+
+    def test_joins_the_index_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.search('apple')
+        listing = [query['sql'] for query in queries if 'MATCH' in query['sql']]
+        self.assertEqual(len(listing), 1)
+        self.assertEqual(listing[0].count('MATCH'), 1)
+        self.assertIn('INNER JOIN "api_recipe_fts"', listing[0])
+
+
+class RecipeFilterTest(APITestCase):
+
+    def setUp(self):
+        super(RecipeFilterTest, self).setUp()
+        user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        unit = Unit.objects.create(full='gram', short='g')
+        sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        self.flour = Ingredient.objects.create(name='Flour', quantity=100, unit=unit, kcal=364)
+        self.desserts = Category.objects.create(name='Desserts')
+        self.quick = create_recipe(user, 'Quick', self.desserts, sugar, unit)
+        self.slow = create_recipe(user, 'Slow', self.desserts, sugar, unit)
+        self.slow.preparationTime = 2
+        self.slow.preparationTimeUnit = Recipe.HOURS
+        self.slow.level = Recipe.EXPERT
+        self.slow.save()
+        RecipeIngredient.objects.create(recipe=self.slow, ingredient=self.flour, unit=unit, quantity=200)
+
+    def ids(self, **params):
+        response = self.client.get('/api/recipes/', params)
+        self.assertEqual(response.status_code, 200)
+        return {recipe['id'] for recipe in response.data['results']}
+
+    def test_filters(self):
+        self.assertEqual(self.slow.preparation_seconds, 7200)
+        self.assertEqual(self.ids(max_time=30), {self.quick.id})
+        self.assertEqual(self.ids(level='expert'), {self.slow.id})
+        self.assertEqual(self.ids(include=self.flour.id), {self.slow.id})
+        self.assertEqual(self.ids(exclude=self.flour.id), {self.quick.id})
+        self.assertEqual(self.ids(category=self.desserts.id), {self.quick.id, self.slow.id})
+        self.assertEqual(self.client.get('/api/recipes/', {'level': 'chef'}).status_code, 400)
+
+    def test_facets(self):
+        facets = self.client.get('/api/recipes/', {'facets': 'true'}).data['facets']
+        self.assertEqual(facets['level'], [{'value': 'competent', 'count': 1}, {'value': 'expert', 'count': 1}])
+        self.assertEqual(facets['categories'], [{'id': self.desserts.id, 'name': 'Desserts', 'count': 2}])
+        self.assertEqual([f['count'] for f in facets['max_time']], [0, 1, 1, 2])
+
+        facets = self.client.get('/api/recipes/', {'facets': 'true', 'q': 'slow'}).data['facets']
+        self.assertEqual(facets['level'], [{'value': 'expert', 'count': 1}])
+
+
+class PantryTest(APITestCase):
+
+    def setUp(self):
+        super(PantryTest, self).setUp()
+        user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        self.unit = Unit.objects.create(full='gram', short='g')
+        self.sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=self.unit, kcal=387)
+        self.flour = Ingredient.objects.create(name='Flour', quantity=100, unit=self.unit, kcal=364)
+        desserts = Category.objects.create(name='Desserts')
+        self.candy = create_recipe(user, 'Candy', desserts, self.sugar, self.unit)
+        self.cake = create_recipe(user, 'Cake', desserts, self.sugar, self.unit)
+        RecipeIngredient.objects.create(recipe=self.cake, ingredient=self.flour, unit=self.unit, quantity=200)
+        pantry.index.built = False
+
+    def matches(self, ingredients, **params):
+        response = self.client.get('/api/recipes/pantry/', dict(params, ingredients=ingredients))
+        self.assertEqual(response.status_code, 200)
+        return [(m['recipe']['id'], m['coverage'], m['missing']) for m in response.data]
+
+    def test_ranking(self):
+        self.assertEqual(self.matches(str(self.sugar.id)),
+                         [(self.candy.id, 1.0, []), (self.cake.id, 0.5, [self.flour.id])])
+        self.assertEqual(self.matches(str(self.sugar.id), min_coverage=0.75), [(self.candy.id, 1.0, [])])
+        self.assertEqual(self.matches(str(self.sugar.id), limit=-1), [(self.candy.id, 1.0, [])])
+        self.assertEqual(self.client.get('/api/recipes/pantry/', {'ingredients': 'x'}).status_code, 400)
+
+    def test_incremental_update(self):
+        self.matches(str(self.flour.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeIngredient.objects.create(recipe=self.candy, ingredient=self.flour, unit=self.unit, quantity=5)
+            self.cake.delete()
+        self.assertTrue(pantry.index.built)
+        self.assertEqual(self.matches('{},{}'.format(self.sugar.id, self.flour.id)), [(self.candy.id, 1.0, [])])
+
+    def test_changes_of_other_processes_are_not_adopted(self):
+        self.matches(str(self.sugar.id))
+        set_stamp = cache.set
+
+        def racing_set(key, value, timeout):
+            set_stamp(key, value, timeout)
+            # Another process changes its index right after this one
+            set_stamp(key, 'other', timeout)
+        with mock.patch.object(pantry.cache, 'set', side_effect=racing_set):
+            pantry.index.recipes_changed([self.candy.id])
+        self.assertNotEqual(pantry.index.stamp, pantry.index._current_stamp())
+
+
+class NutritionTest(APITestCase):
+
+    def setUp(self):
+        super(NutritionTest, self).setUp()
+        user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        self.gram = Unit.objects.create(full='gram', short='g')
+        self.spoon = Unit.objects.create(full='tablespoon', short='tbsp')
+        self.piece = Unit.objects.create(full='piece', short='pc')
+        # 387 kcal per 100 g
+        self.sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=self.gram, kcal=387)
+        self.egg = Ingredient.objects.create(name='Egg', quantity=1, unit=self.piece, kcal=70)
+        self.cake = create_recipe(user, 'Cake', Category.objects.create(name='Desserts'), self.sugar, self.gram)
+
+    def kcal(self):
+        self.cake.refresh_from_db()
+        return self.cake.kcal
+
+    def test_totals_follow_changes(self):
+        self.assertEqual(self.kcal(), 387)
+        RecipeIngredient.objects.filter(recipe=self.cake).update(quantity=200)
+        self.assertEqual(self.kcal(), 387)
+        call_command('rebuild_recipe_aggregates', stdout=StringIO())
+        self.assertEqual(self.kcal(), 774)
+
+        RecipeIngredient.objects.create(recipe=self.cake, ingredient=self.egg, unit=self.piece, quantity=2)
+        self.assertEqual(self.kcal(), 914)
+        self.sugar.kcal = 400
+        self.sugar.save()
+        self.assertEqual(self.kcal(), 940)
+        RecipeIngredient.objects.filter(recipe=self.cake, ingredient=self.sugar).update(unit=self.spoon, quantity=2)
+        call_command('rebuild_recipe_aggregates', stdout=StringIO())
+        self.assertEqual(self.kcal(), 260)
+        self.assertEqual(self.client.get('/api/recipes/{}/'.format(self.cake.id)).data['kcal'], 260)
+
+    def test_unconvertible_units_count_as_zero(self):
+        RecipeIngredient.objects.create(recipe=self.cake, ingredient=self.egg, unit=self.gram, quantity=50)
+        self.assertEqual(self.kcal(), 387)
+
+
+class ImportRecipesTest(APITestCase):
+
+    def setUp(self):
+        super(ImportRecipesTest, self).setUp()
+        self.gram = Unit.objects.create(full='gram', short='g')
+        self.sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=self.gram, kcal=387)
+        self.sugar.allowedUnits.add(self.gram)
+        Unit.objects.create(full='kilogram', short='kg')
+        Category.objects.create(name='Desserts')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def row(self, title, **overrides):
+        row = {'title': title, 'description': 'Sweet', 'imageUrl': 'cake.png', 'preparationTime': 1,
+               'preparationTimeUnit': 'hours', 'categories': ['Desserts'],
+               'steps': [{'description': 'Mix', 'order': 1}, {'description': 'Bake', 'order': 2}],
+               'ingredients': [{'ingredient': 'Sugar', 'unit': 'g', 'quantity': 200}]}
+        row.update(overrides)
+        return json.dumps(row)
+
+    def run_import(self, lines, *args):
+        path = os.path.join(self.directory, 'recipes.ndjson')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines))
+        out, err = StringIO(), StringIO()
+        call_command('import_recipes', path, '--chunk-size', '2', *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import(self):
+        out, err = self.run_import([
+            self.row('Cake'),
+            self.row('Pie', ingredients=[{'ingredient': str(self.sugar.id), 'unit': 'kilogram', 'quantity': 1}]),
+            '{broken',
+            self.row('Cake'),
+            self.row('Tart', steps=[{'description': 'Mix', 'order': 1}, {'description': 'Bake', 'order': 1}]),
+            self.row('Candy'),
+        ])
+        self.assertIn('Imported 2 recipe(s)', out)
+        self.assertEqual([line.split(':')[0] for line in err.splitlines()], ['Line 2', 'Line 3', 'Line 4', 'Line 5'])
+        self.assertIn('is not allowed for ingredient', err)
+
+        cake = Recipe.objects.get(title='Cake')
+        self.assertEqual((cake.preparation_seconds, cake.kcal), (3600, 774))
+        self.assertEqual(list(cake.steps.order_by('order').values_list('description', flat=True)), ['Mix', 'Bake'])
+        self.assertEqual(list(cake.categories.values_list('name', flat=True)), ['Desserts'])
+        self.assertEqual(self.client.get('/api/recipes/', {'q': 'candy'}).data['results'][0]['title'], 'Candy')
+
+    def test_resume_from_checkpoint(self):
+        checkpoint = os.path.join(self.directory, 'checkpoint.json')
+        with open(checkpoint, 'w') as f:
+            json.dump({'line': 2}, f)
+        out, err = self.run_import([self.row('Cake'), self.row('Pie'), self.row('Tart')], '--checkpoint', checkpoint)
+        self.assertEqual(list(Recipe.objects.values_list('title', flat=True)), ['Tart'])
+        with open(checkpoint) as f:
+            self.assertEqual(json.load(f), {'line': 3})
+
+    def test_admin_endpoint(self):
+        admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='Secret123!')
+        self.client.force_login(admin)
+        body = '\n'.join([self.row('Cake'), '{broken', self.row('Pie', categories=['Drinks']), self.row('Tart')])
+        response = self.client.post('/admin/recipes/import/', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual((result['imported'], result['failed']), (2, 2))
+        self.assertEqual([error['line'] for error in result['errors']], [2, 3])
+        self.assertIn('Category Drinks does not exist!', json.dumps(result['errors'][1]))
+        self.assertEqual(set(Recipe.objects.values_list('title', flat=True)), {'Cake', 'Tart'})
+        self.assertEqual(self.client.get('/admin/recipes/import/').status_code, 405)
+
+    def test_admin_endpoint_requires_a_superuser(self):
+        cook = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!',
+                                        is_staff=True)
+        self.client.force_login(cook)
+        response = self.client.post('/admin/recipes/import/', self.row('Cake'), content_type='application/x-ndjson')
+        self.assertRedirects(response, '/admin/login/', fetch_redirect_response=False)
+        self.assertFalse(Recipe.objects.exists())
+
+
+
+class RecipeNestedUpdateTest(APITestCase):
+
+    def setUp(self):
+        super(RecipeNestedUpdateTest, self).setUp()
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        self.client.force_authenticate(self.user)
+        self.gram = Unit.objects.create(full='gram', short='g')
+        self.sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=self.gram, kcal=387)
+        self.flour = Ingredient.objects.create(name='Flour', quantity=100, unit=self.gram, kcal=364)
+        self.sugar.allowedUnits.add(self.gram)
+        self.flour.allowedUnits.add(self.gram)
+        self.recipe = create_recipe(self.user, 'Cake', Category.objects.create(name='Desserts'), self.sugar, self.gram)
+
+    def steps(self):
+        return list(self.recipe.steps.order_by('order').values_list('order', 'description'))
+
+    def test_patch_replaces_steps_and_ingredients(self):
+        first = self.recipe.steps.get(order=1)
+        response = self.client.patch('/api/recipes/{}/'.format(self.recipe.id), {
+            'steps': [{'description': 'Mix well', 'order': 1}, {'description': 'Bake', 'order': 3}],
+            'ingredients': [{'ingredient': self.flour.id, 'unit': self.gram.id, 'quantity': 50}],
+        }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.steps(), [(1, 'Mix well'), (3, 'Bake')])
+        self.assertEqual(self.recipe.steps.get(order=1).id, first.id)
+        self.assertEqual(list(self.recipe.ingredients.values_list('ingredient', 'quantity')), [(self.flour.id, 50)])
+        self.assertEqual(response.data['kcal'], 182)
+
+        response = self.client.patch('/api/recipes/{}/'.format(self.recipe.id), {'steps': [{'order': 2}]},
+                                     format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_patch_rejects_empty_lists_and_repeated_ingredients(self):
+        url = '/api/recipes/{}/'.format(self.recipe.id)
+        for field in ('steps', 'ingredients', 'categories'):
+            response = self.client.patch(url, {field: []}, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn(field, response.data)
+
+        response = self.client.patch(url, {'ingredients': [
+            {'ingredient': self.flour.id, 'unit': self.gram.id, 'quantity': 50},
+            {'ingredient': self.flour.id, 'unit': self.gram.id, 'quantity': 20},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ingredients', response.data)
+        self.assertEqual(list(self.recipe.ingredients.values_list('ingredient', flat=True)), [self.sugar.id])
+        self.assertEqual(len(self.steps()), 2)
+
+    def test_reorder_steps(self):
+        Step.objects.create(recipe=self.recipe, description='Serve', order=3)
+        ids = list(self.recipe.steps.order_by('order').values_list('id', flat=True))
+        url = '/api/recipes/{}/reorder-steps/'.format(self.recipe.id)
+        response = self.client.post(url, {'steps': [ids[2], ids[0], ids[1]]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([step['description'] for step in response.data], ['Serve', 'Step one', 'Step two'])
+        self.assertEqual(self.client.post(url, {'steps': ids[:2]}, format='json').status_code, 400)
+        self.assertEqual(self.client.post(url, ids, format='json').status_code, 400)
+
+        other = User.objects.create_user(username='other', email='other@example.com', password='Secret123!')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.post(url, {'steps': ids}, format='json').status_code, 403)
+
+
+class ExportRecipesTest(APITestCase):
+
+    def setUp(self):
+        super(ExportRecipesTest, self).setUp()
+        user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        self.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='Secret123!')
+        unit = Unit.objects.create(full='gram', short='g')
+        sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        desserts = Category.objects.create(name='Desserts')
+        self.recipes = [create_recipe(user, 'Recipe {}'.format(i), desserts, sugar, unit) for i in range(5)]
+
+    def export(self, **params):
+        self.client.force_authenticate(self.admin)
+        response = self.client.get('/api/recipes/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_ndjson_export_in_chunks(self):
+        with mock.patch('api.export.CHUNK_SIZE', 2):
+            lines = self.export().splitlines()
+        documents = [json.loads(line) for line in lines]
+        self.assertEqual([d['id'] for d in documents], [recipe.id for recipe in self.recipes])
+        self.assertEqual(len(documents[0]['steps']), 2)
+        self.assertNotIn('comments', documents[0])
+
+        Recipe.objects.filter(pk=self.recipes[0].pk).update(updated_at=timezone.now() - timedelta(days=2))
+        since = (timezone.now() - timedelta(days=1)).date().isoformat()
+        self.assertEqual(len(self.export(updated_since=since).splitlines()), 4)
+
+    def test_csv_export_and_permissions(self):
+        rows = list(csv.DictReader(StringIO(self.export(type='csv'))))
+        self.assertEqual(len(rows), 5)
+        self.assertEqual(json.loads(rows[0]['categories'])[0]['name'], 'Desserts')
+
+        out = StringIO()
+        call_command('export_recipes', '--type', 'csv', '--chunk-size', '2', stdout=out)
+        self.assertEqual(out.getvalue(), self.export(type='csv'))
+
+        self.client.force_authenticate(None)
+        self.assertEqual(self.client.get('/api/recipes/export/').status_code, 401)
+
+
+class ImageStorageTest(APITestCase):
+
+    def setUp(self):
+        super(ImageStorageTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        override = self.settings(IMAGES_ROOT=self.root, IMAGE_WORKERS=0)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+
+    def jpeg(self):
+        f = BytesIO()
+        Image.new('RGB', (800, 400), (200, 80, 20)).save(f, 'JPEG')
+        return f.getvalue()
+
+    def test_upload_is_stored_once_with_variants(self):
+        self.client.force_authenticate(self.user)
+        responses = [self.client.post('/api/images/', {'image': SimpleUploadedFile(name, self.jpeg())},
+                                      format='multipart') for name in ('a.jpg', 'b.jpg')]
+        self.assertEqual([r.status_code for r in responses], [201, 201])
+        self.assertEqual(responses[0].data['url'], responses[1].data['url'])
+        digest = responses[0].data['hash']
+        self.assertEqual(os.listdir(os.path.join(self.root, images.ORIGINALS_DIR, digest[:2])), [digest + '.jpg'])
+
+        card = responses[0].data['variants']['card']['webp']
+        with Image.open(os.path.join(self.root, card[len(settings.IMAGES_URL):])) as variant:
+            self.assertEqual(variant.size, (640, 320))
+
+        response = self.client.post('/api/images/', {'image': SimpleUploadedFile('x.jpg', b'not an image')},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+    def test_dedupe_existing_directory(self):
+        for name in ('forest.jpg', 'forest_71nCpzY.jpg'):
+            with open(os.path.join(self.root, name), 'wb') as f:
+                f.write(self.jpeg())
+        unit = Unit.objects.create(full='gram', short='g')
+        sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        recipe = create_recipe(self.user, 'Cake', Category.objects.create(name='Desserts'), sugar, unit)
+        Recipe.objects.filter(pk=recipe.pk).update(imageUrl='http://localhost:8000/images/forest_71nCpzY.jpg')
+        # Another site's image of the same name is left alone
+        Step.objects.filter(recipe=recipe, order=1).update(imageUrl='https://example.com/forest.jpg')
+
+        # A failed rewrite leaves the old files and urls in place
+        with mock.patch('api.management.commands.dedupe_images.bulk_recipes_changed', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                call_command('dedupe_images', stdout=StringIO())
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'forest_71nCpzY.jpg')))
+        recipe.refresh_from_db()
+        self.assertTrue(recipe.imageUrl.endswith('/images/forest_71nCpzY.jpg'))
+
+        call_command('dedupe_images', stdout=StringIO())
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'forest.jpg')))
+        self.assertEqual(Step.objects.get(recipe=recipe, order=1).imageUrl, 'https://example.com/forest.jpg')
+        recipe.refresh_from_db()
+        self.assertTrue(recipe.imageUrl.startswith('/images/originals/'))
+        self.assertTrue(os.path.exists(os.path.join(self.root, recipe.imageUrl[len('/images/'):])))
+        self.assertIsNotNone(self.client.get('/api/recipes/{}/'.format(recipe.id)).data['imageVariants'])
+
+
+class UploadSessionTest(APITestCase):
+
+    def setUp(self):
+        super(UploadSessionTest, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        override = self.settings(IMAGES_ROOT=self.root, IMAGE_WORKERS=0, UPLOAD_MAX_SESSIONS=1)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        self.client.force_authenticate(self.user)
+        unit = Unit.objects.create(full='gram', short='g')
+        sugar = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        self.recipe = create_recipe(self.user, 'Cake', Category.objects.create(name='Desserts'), sugar, unit)
+        f = BytesIO()
+        Image.new('RGB', (300, 200), (20, 80, 200)).save(f, 'PNG')
+        self.image = f.getvalue()
+
+    def start(self, **overrides):
+        data = dict({'target': 'recipe', 'target_id': self.recipe.id, 'size': len(self.image),
+                     'sha256': hashlib.sha256(self.image).hexdigest()}, **overrides)
+        return self.client.post('/api/uploads/', data, format='json')
+
+    def put_chunk(self, session, offset, data):
+        return self.client.generic('PUT', '/api/uploads/{}/'.format(session), data,
+                                   content_type='application/octet-stream', HTTP_UPLOAD_OFFSET=str(offset))
+
+    def test_resumable_upload(self):
+        session = self.start().data['id']
+        self.assertEqual(self.start().status_code, 429)
+        half = len(self.image) // 2
+
+        self.assertEqual(self.put_chunk(session, 0, self.image[:half]).data['offset'], half)
+        response = self.put_chunk(session, 0, self.image[:half])
+        self.assertEqual((response.status_code, response.data['offset']), (409, half))
+        self.assertEqual(self.client.post('/api/uploads/{}/complete/'.format(session)).status_code, 409)
+
+        self.assertEqual(self.client.get('/api/uploads/{}/'.format(session)).data['offset'], half)
+        self.assertEqual(self.put_chunk(session, half, self.image[half:]).data['offset'], len(self.image))
+        response = self.client.post('/api/uploads/{}/complete/'.format(session))
+        self.assertEqual(response.status_code, 200)
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.imageUrl, response.data['imageUrl'])
+        self.assertIsNotNone(response.data['variants'])
+
+    def test_concurrent_completion(self):
+        session = self.start().data['id']
+        self.put_chunk(session, 0, self.image)
+        # Another request claimed the upload and has not finished yet
+        UploadSession.objects.filter(pk=session).update(completing=True)
+        self.assertEqual(self.client.post('/api/uploads/{}/complete/'.format(session)).status_code, 409)
+
+        UploadSession.objects.filter(pk=session).update(completing=False)
+        os.remove(uploads.part_path(UploadSession.objects.get(pk=session)))
+        self.assertEqual(self.client.post('/api/uploads/{}/complete/'.format(session)).status_code, 409)
+        self.assertFalse(UploadSession.objects.filter(pk=session).exists())
+
+    def test_checksum_and_ownership(self):
+        session = self.start(sha256='0' * 64).data['id']
+        self.put_chunk(session, 0, self.image)
+        self.assertEqual(self.client.post('/api/uploads/{}/complete/'.format(session)).status_code, 400)
+        self.assertFalse(UploadSession.objects.filter(pk=session).exists())
+
+        other = User.objects.create_user(username='other', email='other@example.com', password='Secret123!')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.start().status_code, 403)
+
+
+@override_settings(RECAPTCHA_BACKEND='api.recaptcha.StubBackend')
+class RecaptchaTest(APITestCase):
+
+    def verify(self, token):
+        return self.client.post('/api/auth/recaptcha/', {'recaptchaToken': token}, format='json')
+
+    def test_stub_verdicts_are_cached_per_token(self):
+        self.assertEqual(self.verify('valid').data['status'], True)
+        response = self.verify('invalid')
+        self.assertEqual((response.data['status'], response.data['message']), (False, ['invalid-input-response']))
+
+        with mock.patch.object(recaptcha.StubBackend, 'verify') as verify:
+            self.assertEqual(self.verify('valid').data['status'], True)
+            verify.assert_not_called()
+
+    def test_breaker_opens_after_failures(self):
+        with mock.patch('api.recaptcha.requests.Session.post', side_effect=requests.Timeout) as post:
+            backend = recaptcha.GoogleBackend()
+            for _ in range(settings.RECAPTCHA_BREAKER_THRESHOLD + 2):
+                verdict = backend.verify('token')
+            self.assertEqual((verdict.success, verdict.available), (False, False))
+            self.assertEqual(post.call_count, settings.RECAPTCHA_BREAKER_THRESHOLD)
+
+
+class CachedJWTAuthenticationTest(APITestCase):
+
+    def setUp(self):
+        super(CachedJWTAuthenticationTest, self).setUp()
+        self.user = User.objects.create_user(username='user', email='user@example.com', password='Secret123!')
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer {}'.format(AccessToken.for_user(self.user)))
+
+    def user_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        return [query for query in queries.captured_queries if 'FROM "api_user"' in query['sql']]
+
+    def test_identity_is_cached_until_the_user_changes(self):
+        self.assertEqual(len(self.user_queries()), 1)
+        self.assertEqual(self.user_queries(), [])
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/recipes/').status_code, 401)
+
+    def test_deferred_fields_load_together(self):
+        user = authentication.CachedJWTAuthentication().get_user(AccessToken.for_user(self.user))
+        with self.assertNumQueries(1):
+            self.assertEqual((user.email, user.username), ('user@example.com', 'user'))
+
+
+class MetricsTest(APITestCase):
+
+    def test_timings_are_exposed_to_staff(self):
+        user = User.objects.create_user(username='user', email='user@example.com', password='Secret123!')
+        self.client.force_authenticate(user)
+        response = self.client.get('/api/recipes/')
+        self.assertEqual(response.metrics.view, 'RecipeViewSet.list')
+        self.assertGreater(response.metrics.serializer, 0)
+        # Only the serializers of the views are timed, DRF's own classes are left alone
+        self.assertEqual(serializers.Serializer.data.fget.__qualname__, 'Serializer.data')
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        admin = User.objects.create_user(username='admin', email='admin@example.com', password='Secret123!',
+                                         is_staff=True)
+        self.client.force_authenticate(admin)
+        with self.settings(METRICS_SERVER_TIMING=False):
+            response = self.client.get('/api/recipes/')
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[\d.]+;desc="\d+ queries", serializer;dur=')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('# TYPE api_request_queries histogram', body)
+        self.assertRegex(body, r'api_request_duration_seconds_count\{view="RecipeViewSet.list"\} \d+')
+
+
+class BenchmarkTest(APITestCase):
+
+    def seed(self, *args):
+        call_command('seed_bench', '--users', '5', '--ingredients', '10', '--categories', '3', '--recipes', '20',
+                     '--ratings', '60', '--favourites', '30', '--comments', '30', '--seed', '7', *args,
+                     stdout=StringIO())
+        return list(Recipe.objects.order_by('id').values_list('title', 'rating_count', 'rating_sum', 'kcal'))
+
+    def test_seed_is_deterministic_and_benchmarked(self):
+        recipes = self.seed()
+        self.assertEqual(len(recipes), 20)
+        self.assertEqual(sum(count for _, count, _, _ in recipes), Rating.objects.count())
+        with self.assertRaises(CommandError):
+            self.seed()
+        self.assertEqual([title for title, *_ in self.seed('--flush')], [title for title, *_ in recipes])
+        self.assertEqual(Recipe.objects.count(), 20)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        output = os.path.join(directory, 'bench.json')
+        call_command('bench_endpoints', '--requests', '5', '--warmup', '1', '--endpoint', 'recipes.retrieve',
+                     '--endpoint', 'recipes.pantry', '--output', output, stdout=StringIO())
+        with open(output) as f:
+            endpoints = json.load(f)['endpoints']
+        self.assertEqual(set(endpoints), {'recipes.retrieve', 'recipes.pantry'})
+        self.assertEqual(endpoints['recipes.retrieve']['errors'], 0)
+        self.assertGreater(endpoints['recipes.retrieve']['queries_p50'], 0)
+
+
+@override_settings(READ_REPLICAS={'default': {'HEALTH_CHECK_INTERVAL': 0}})
+class ReadReplicaTest(APITestCase):
+
+    def setUp(self):
+        super(ReadReplicaTest, self).setUp()
+        user = User.objects.create_user(username='cook', email='cook@example.com', password='Secret123!')
+        category = Category.objects.create(name='Desserts')
+        unit = Unit.objects.create(full='gram', short='g')
+        ingredient = Ingredient.objects.create(name='Sugar', quantity=100, unit=unit, kcal=387)
+        self.recipe = create_recipe(user, 'Cake', category, ingredient, unit)
+        self.authorization = 'Bearer {}'.format(AccessToken.for_user(user))
+        self.client.credentials(HTTP_AUTHORIZATION=self.authorization)
+
+    def test_clients_read_from_the_primary_after_a_write(self):
+        with mock.patch.object(routers.replicas, 'choose', return_value='default') as choose:
+            self.client.get('/api/recipes/')
+            self.assertEqual(choose.call_count, 1)
+
+            response = self.client.post('/api/recipes/{}/favourite/'.format(self.recipe.id))
+            self.assertEqual(response.status_code, 201)
+            self.assertIn(settings.PRIMARY_PIN_COOKIE, response.cookies)
+            self.client.get('/api/recipes/')
+            # Another device of the same user, without the cookie
+            other = APIClient()
+            other.credentials(HTTP_AUTHORIZATION=self.authorization)
+            other.get('/api/recipes/')
+            self.assertEqual(choose.call_count, 1)
+
+            APIClient().get('/api/recipes/')
+            self.assertEqual(choose.call_count, 2)
+
+    def test_unpinned_reads_go_to_a_replica_without_filling_the_shared_cache(self):
+        reads = []
+        db_for_read = routers.ReadReplicaRouter.db_for_read
+
+        def recording(router, model, **hints):
+            reads.append((model, db_for_read(router, model, **hints)))
+            return reads[-1][1]
+
+        # The test case transaction would keep every read on the primary
+        with mock.patch.object(routers.replicas, 'choose', return_value='default'), \
+                mock.patch.object(routers.ReadReplicaRouter, 'db_for_read', recording), \
+                mock.patch.object(connection, 'in_atomic_block', False):
+            response = APIClient().get('/api/recipes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn((Recipe, 'default'), reads)
+        key = response_cache.list_key(response.wsgi_request)
+        self.assertIsNone(cache.get(key))
+        self.assertIsNotNone(cache.get(key + ':default'))
+
+        with mock.patch.object(routers.replicas, 'choose', return_value=None):
+            APIClient().get('/api/recipes/')
+        self.assertIsNotNone(cache.get(key))
+
+    def test_router_keeps_transactions_on_the_primary(self):
+        router = routers.ReadReplicaRouter()
+        routers._state.alias = 'replica'
+        self.addCleanup(setattr, routers._state, 'alias', None)
+        self.assertIsNone(router.db_for_read(Recipe))
+        with mock.patch.object(connection, 'in_atomic_block', False):
+            self.assertEqual(router.db_for_read(Recipe), 'replica')
+            # Reads that end up in the shared response cache
+            with routers.use_primary():
+                self.assertIsNone(router.db_for_read(Recipe))
+            self.assertEqual(router.db_for_read(Recipe), 'replica')
+        self.assertEqual(router.db_for_write(Recipe), 'default')
+
+
+@override_settings(CACHES=TEST_CACHES)
+class RetryAtomicTest(TransactionTestCase):
+
+    def test_locked_write_units_are_retried(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS['busy_timeout'])
+
+        attempts = []
+
+        def create_category():
+            Category.objects.create(name='Soups')
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise OperationalError('database is locked')
+            return 'created'
+        with self.settings(WRITE_RETRY_DELAY=0):
+            self.assertEqual(retry_atomic(create_category), 'created')
+        self.assertEqual((len(attempts), Category.objects.count()), (3, 1))
+
+        def fail():
+            attempts.append(1)
+            raise OperationalError('no such table: api_missing')
+        with self.assertRaises(OperationalError):
+            retry_atomic(fail)
+        self.assertEqual(len(attempts), 4)
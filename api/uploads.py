@@ -0,0 +1,130 @@
+import os
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+from api import images
+from api.models import Ingredient, Recipe, Step, UploadSession
+
+UPLOADS_DIR = 'uploads'
+TARGET_MODELS = {
+    UploadSession.RECIPE: Recipe,
+    UploadSession.STEP: Step,
+    UploadSession.INGREDIENT: Ingredient,
+}
+
+# Chunks being written by this process, each holds at most one read buffer in memory
+_writers = threading.BoundedSemaphore(settings.UPLOAD_MAX_CONCURRENT_CHUNKS)
+
+
+class UploadError(Exception):
+    def __init__(self, message, status):
+        super(UploadError, self).__init__(message)
+        self.status = status
+
+
+def part_path(session):
+    return os.path.join(settings.IMAGES_ROOT, UPLOADS_DIR, '{}.part'.format(session.id))
+
+
+def expired_before():
+    return timezone.now() - settings.UPLOAD_SESSION_TTL
+
+
+def open_sessions(user):
+    return UploadSession.objects.filter(user=user, imageUrl__isnull=True, created_at__gte=expired_before())
+
+
+def discard(sessions):
+    for session in sessions:
+        if os.path.exists(part_path(session)):
+            os.remove(part_path(session))
+        session.delete()
+
+
+def write_chunk(session, offset, stream, length):
+    """
+    Appends length bytes of stream at offset, which has to be where the previous chunk ended.
+    Returns the new offset.
+    """
+    if offset != session.offset:
+        raise UploadError('The upload continues at offset {}!'.format(session.offset), 409)
+    if length <= 0 or length > settings.UPLOAD_MAX_CHUNK_SIZE:
+        raise UploadError('Chunks have to have between 1 and {} bytes!'.format(settings.UPLOAD_MAX_CHUNK_SIZE), 400)
+    if offset + length > session.size:
+        raise UploadError('The chunk ends after the declared size of {} bytes!'.format(session.size), 400)
+    if not _writers.acquire(blocking=False):
+        raise UploadError('Too many uploads in progress, retry later!', 503)
+    try:
+        path = part_path(session)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+            f.seek(offset)
+            received = 0
+            while received < length:
+                data = stream.read(min(images.CHUNK_SIZE, length - received))
+                if not data:
+                    break
+                f.write(data)
+                received += len(data)
+            # Drops whatever an interrupted earlier attempt left after this chunk
+            f.truncate(offset + received)
+    finally:
+        _writers.release()
+
+    # Only the request that wrote from the expected offset moves it
+    if not UploadSession.objects.filter(pk=session.pk, offset=offset).update(offset=offset + received):
+        raise UploadError('The upload was continued by another request!', 409)
+    session.offset = offset + received
+    if received < length:
+        raise UploadError('The chunk ended after {} of {} bytes, continue at offset {}!'.format(
+            received, length, session.offset), 400)
+    return session.offset
+
+
+def complete(session):
+    """Checks the checksum, stores the image and sets it as the imageUrl of the target."""
+    if session.offset != session.size:
+        raise UploadError('Only {} of {} bytes were uploaded!'.format(session.offset, session.size), 409)
+    # Concurrent requests to complete the same upload: only the one claiming the session reads the part file
+    if not UploadSession.objects.filter(pk=session.pk, imageUrl__isnull=True, completing=False) \
+            .update(completing=True):
+        raise UploadError('This upload is already being completed!', 409)
+    try:
+        return _complete(session)
+    except Exception:
+        UploadSession.objects.filter(pk=session.pk).update(completing=False)
+        raise
+
+
+def _complete(session):
+    path = part_path(session)
+    try:
+        digest = images.file_digest(path)
+    except FileNotFoundError:
+        discard([session])
+        raise UploadError('The uploaded bytes are gone, the upload has to start over!', 409)
+    if digest != session.sha256:
+        discard([session])
+        raise UploadError('The checksum does not match, the upload has to start over!', 400)
+
+    def chunks():
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(images.CHUNK_SIZE), b''):
+                yield chunk
+
+    try:
+        _, stored = images.store(chunks())
+    except images.InvalidImage as e:
+        discard([session])
+        raise UploadError(str(e), 400)
+    os.remove(path)
+
+    session.imageUrl = images.url(stored)
+    session.save(update_fields=['imageUrl'])
+    target = TARGET_MODELS[session.target].objects.filter(pk=session.target_id).first()
+    if target is not None:
+        target.imageUrl = session.imageUrl
+        target.save()
+    return session.imageUrl
@@ -5,7 +5,7 @@ from rest_framework_simplejwt.views import TokenRefreshView
 
 from api.views import CategoryViewSet, CommentViewSet, IngredientViewSet, \
     RecipeIngredientViewSet, RecipeViewSet, StepViewSet, UserViewSet, AuthenticationView, \
-    FavouriteViewSet, UserMe, RatingViewSet
+    FavouriteViewSet, UserMe, RatingViewSet, ImageViewSet, UploadSessionViewSet
 
 router = routers.DefaultRouter()
 router.register('recipes', RecipeViewSet)
@@ -14,8 +14,10 @@ router.register('ingredients', IngredientViewSet)
 router.register('users', UserViewSet)
 router.register('favourites', FavouriteViewSet)
 router.register('ratings', RatingViewSet)
+router.register('uploads', UploadSessionViewSet)
 
-create_comment = CommentViewSet.as_view({
+recipe_comments = CommentViewSet.as_view({
+    'get': 'list',
     'post': 'create',
 })
 
@@ -55,11 +57,13 @@ urlpatterns = [
     path('', include(router.urls)),
 
     path('comments/<int:pk>/', comments_view),
-    path('recipes/<int:pk>/comments/', create_comment),
+    path('recipes/<int:pk>/comments/', recipe_comments),
 
     path('recipe-ingredients/<int:pk>/', recipe_ingredient_view),
     path('recipes/<int:pk>/recipe-ingredients/', create_recipe_ingredient),
 
+    path('images/', ImageViewSet.as_view({'post': 'create'}), name='upload_image'),
+
     path('steps/<int:pk>/', step_view),
     path('recipes/<int:pk>/steps/', create_step),
 
@@ -1,27 +1,37 @@
 from django.contrib.auth import login, logout as django_logout
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError
 from rest_framework import viewsets, status, mixins, serializers
 from rest_framework.authentication import BasicAuthentication
 from rest_framework.decorators import action, authentication_classes, api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 from rest_framework.viewsets import ViewSet, GenericViewSet
 from rest_framework_simplejwt.tokens import RefreshToken
-import requests
 from django.conf import settings
-
-from api.models import Category, Comment, Favorite, Ingredient, Rating, Recipe, RecipeIngredient, Step, \
-    User, Unit
+from django.http import HttpResponse, StreamingHttpResponse
+
+from api import cache as response_cache, export as recipe_export, images, metrics, pantry, recaptcha, uploads
+from api.routers import read_alias, use_primary
+from api.conditional import ConditionalGetMixin
+from api.db import retry_atomic
+from api.filters import RecipeFilter, RecipeSearchFilter, facet_counts
+from api.models import Category, Comment, Favorite, Ingredient, Rating, Recipe, RecipeIngredient, RecipeScore, \
+    Step, UploadSession, User, Unit
+from api.overlay import apply_user_overlay
+from api.pagination import CommentPagination, KeysetPagination
 from api.permissions import IsAdminOrIsOwnerOrSingup, IsAdminOrReadOnly, IsOwnerOrCreateOrReadOnly, \
-    IsAdminOrCreateOrReadOnly, IsOwnerRecipeOrCreateOrReadOnly
+    IsAdminOrCreateOrReadOnly, IsOwnerRecipeOrCreateOrReadOnly, IsOwner
 from api.serializers.ingredient import IngredientSerializer, IngredientDisplaySerializer
-from api.serializers.recipe import RecipeSerializer, RecipeDisplaySerializer
+from api.serializers.recipe import RecipeSerializer, RecipeDisplaySerializer, StepRecipeSerializer
 from api.serializers.recipe_ingredient import RecipeIngredientSerializer, RecipeIngredientUpdateSerializer
 from api.serializers.serializers import FavoriteSerializer, RatingSerializer, CategorySerializer, StepSerializer, \
     CommentSerializer, StepCreateSerializer
 from api.serializers.unit import UnitSerializer
+from api.serializers.upload import UploadSessionSerializer
 from api.serializers.user import UserSerializer
+from api.signals import bulk_recipes_changed
 from django.contrib.auth.password_validation import validate_password
 from django.core.exceptions import ValidationError
 import json
@@ -48,23 +58,20 @@ class AuthenticationView(ViewSet):
 
     def recaptcha(self, request):
         body = json.loads(request.body)
-        token = body['recaptchaToken']
-        res = {}
-        url = "https://www.google.com/recaptcha/api/siteverify"
-        params = {
-            'secret': '6LcN5NodAAAAAEbV6c3mcWlCjelPQcFQUbWry0er',
-            'response': token,
-        }
+        token = body.get('recaptchaToken')
         if token is None:
             res = {
                 'message': 'Wrong reCaptcha token!',
             }
             return Response(res, status=status.HTTP_201_CREATED)
 
-        reacaptcha_response = requests.get(url, params=params, verify=True)
-        reacaptcha_response = reacaptcha_response.json()
-        res["status"] = reacaptcha_response.get("success", False)
-        res['message'] = reacaptcha_response.get('error-codes', None) or "Unspecified error."
+        verdict = recaptcha.verify(token, request.META.get('REMOTE_ADDR'))
+        res = {
+            'status': verdict.success,
+            'message': verdict.error_codes or "Unspecified error.",
+        }
+        if not verdict.available:
+            return Response(res, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         return Response(res)
 
 
@@ -74,14 +81,18 @@ class UserMe(ViewSet):
     def get_favourites(self, request, *args, **kwargs):
         user = request.user
         favourites = Favorite.objects.filter(user_id=user.id)
-        serialized = FavoriteSerializer(favourites, many=True)
-        return Response(serialized.data)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(favourites, request, view=self)
+        serialized = metrics.timed(FavoriteSerializer(page, many=True))
+        return paginator.get_paginated_response(serialized.data)
 
     def get_ratings(self, request, *args, **kwargs):
         user = request.user
         ratings = Rating.objects.filter(user_id=user.id)
-        serialized = RatingSerializer(ratings, many=True)
-        return Response(serialized.data)
+        paginator = KeysetPagination()
+        page = paginator.paginate_queryset(ratings, request, view=self)
+        serialized = metrics.timed(RatingSerializer(page, many=True))
+        return paginator.get_paginated_response(serialized.data)
 
     def update(self, request, *args, **kwargs):
         user = request.user
@@ -98,7 +109,7 @@ class UserMe(ViewSet):
         return Response(serializer.data, status=status.HTTP_200_OK)
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(metrics.SerializerMetricsMixin, viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = (IsAdminOrIsOwnerOrSingup,)
@@ -120,54 +131,116 @@ class UserViewSet(viewsets.ModelViewSet):
             return Response(res, status=status.HTTP_400_BAD_REQUEST)
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(metrics.SerializerMetricsMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     permission_classes = (IsOwnerOrCreateOrReadOnly, )
+    filter_backends = (RecipeSearchFilter, RecipeFilter)
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.filter_queryset(self.get_queryset())
+    @property
+    def keyset_ordering(self):
+        if RecipeSearchFilter.is_searching(self.request):
+            return ('search_rank', 'id')
+        # Newest first. dateAdded changes with every edit, a recipe edited while a client pages would move
+        # across its cursor.
+        return ('-id',)
 
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
-
-        if request.user is not None and request.user.is_anonymous is False:
-            user_favourites = list(map(lambda f: f.recipe, request.user.favourites.all()))
-
-            user_rates = {'stars': [], 'recipes': []}
-            for r in request.user.rates.all():
-                user_rates['stars'].append(r.stars)
-                user_rates['recipes'].append(r.recipe)
+    def get_queryset(self):
+        if self.action == 'retrieve' or self.action == 'list':
+            return Recipe.objects.for_display(self.get_display_fields())
+        return super(RecipeViewSet, self).get_queryset()
 
-            for q in queryset:
-                if q in user_favourites:
-                    q.user_favourite = True
-                if q in user_rates['recipes']:
-                    index = user_rates['recipes'].index(q)
-                    q.user_rating = user_rates['stars'][index]
+    def get_serializer(self, *args, **kwargs):
+        if self.action == 'retrieve' or self.action == 'list':
+            kwargs['fields'] = self.get_display_fields()
+        return super(RecipeViewSet, self).get_serializer(*args, **kwargs)
+
+    def get_display_fields(self):
+        # ?fields= picks the representation, ?expand= adds heavy relations to the default one.
+        # Lists default to a summary without the expandable relations, retrieve to the full recipe.
+        if hasattr(self, '_display_fields'):
+            return self._display_fields
+
+        all_fields = RecipeDisplaySerializer.Meta.fields
+        expandable = RecipeDisplaySerializer.expandable_fields
+        requested = set(filter(None, self.request.query_params.get('fields', '').split(',')))
+        expand = set(filter(None, self.request.query_params.get('expand', '').split(',')))
+        if requested - set(all_fields):
+            raise serializers.ValidationError({'fields': ['Unknown field(s): ' +
+                                                          ', '.join(sorted(requested - set(all_fields)))]})
+        if expand - set(expandable):
+            raise serializers.ValidationError({'expand': ['Only ' + ', '.join(expandable) +
+                                                          ' can be expanded!']})
+
+        if requested:
+            selected = requested | expand
+            if selected & {'user_favourite', 'user_rating'}:
+                # The per-user overlay is matched on the recipe id
+                selected.add('id')
+        elif self.action == 'list':
+            selected = (set(all_fields) - set(expandable)) | expand
+        else:
+            selected = set(all_fields)
+        self._display_fields = [field for field in all_fields if field in selected]
+        return self._display_fields
+
+    def apply_user_overlay(self, representations):
+        fields = [field for field in ('user_favourite', 'user_rating') if field in self.get_display_fields()]
+        if fields:
+            apply_user_overlay(self.request.user, representations, fields)
+        return representations
+
+    def get_validator(self):
+        user = self.request.user
+        keys = [response_cache.GLOBAL_STAMP_KEY]
+        if self.action == 'list':
+            keys.append(response_cache.LIST_STAMP_KEY)
+        if user.is_authenticated:
+            keys.append(response_cache.USER_STAMP_KEY.format(user.id))
+        stamps = response_cache.get_stamps(*keys)
+
+        if self.action == 'retrieve':
+            try:
+                # Part of the ETag clients and the response cache keep, so not from a lagging replica
+                with use_primary():
+                    updated_at = Recipe.objects.filter(pk=self.kwargs['pk']).values_list('updated_at',
+                                                                                         flat=True).first()
+            except (TypeError, ValueError):
+                return None
+            if updated_at is None:
+                return None
+            stamps.append(updated_at.timestamp())
+        return max(stamps), (user.id, stamps)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+    def list(self, request, *args, **kwargs):
+        return self.conditional_get(self.cached_list, request, *args, **kwargs)
 
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        
-        if request.user is not None and request.user.is_anonymous is False:
-            for r in request.user.rates.all():
-                if r.recipe == instance:
-                    instance.user_rating = r.stars
-                    break
-
-            for f in request.user.favourites.all():
-
-                if f.recipe == instance:
-                    instance.user_favourite = True
-                    break
-
-        serializer = self.get_serializer(instance)
-        return Response(serializer.data)
+        return self.conditional_get(self.cached_retrieve, request, *args, **kwargs)
+
+    # Both serialize the anonymous representation once per cache version and put the
+    # requesting user's favourite/rating on top of it
+    def cached_list(self, request, *args, **kwargs):
+        def compute():
+            queryset = self.filter_queryset(self.get_queryset())
+            page = self.paginate_queryset(queryset)
+            if page is None:
+                return self.get_serializer(queryset, many=True).data
+            data = self.get_paginated_response(self.get_serializer(page, many=True).data).data
+            # ?facets=true adds counts of the filtered recipes per level, category and preparation time
+            if request.query_params.get('facets') in ('1', 'true'):
+                data['facets'] = facet_counts(queryset)
+            return data
+
+        data = response_cache.fetch(response_cache.list_key(request), compute, read_alias())
+        self.apply_user_overlay(data['results'] if isinstance(data, dict) else data)
+        return Response(data)
+
+    def cached_retrieve(self, request, *args, **kwargs):
+        data = response_cache.fetch(response_cache.recipe_key(request, self.kwargs['pk']),
+                                    lambda: self.get_serializer(self.get_object()).data, read_alias())
+        self.apply_user_overlay([data])
+        return Response(data)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -177,6 +250,64 @@ class RecipeViewSet(viewsets.ModelViewSet):
             return RecipeDisplaySerializer
         return RecipeSerializer
 
+    @action(detail=False, methods=['GET'])
+    def pantry(self, request):
+        # ?ingredients=1,2,3 ranks recipes by the fraction of their ingredients in the list
+        try:
+            ingredient_ids = [int(i) for i in request.query_params.get('ingredients', '').split(',') if i]
+            limit = max(1, min(int(request.query_params.get('limit', 20)), 100))
+            min_coverage = float(request.query_params.get('min_coverage', 0))
+        except ValueError:
+            return Response({'error': 'ingredients has to be a comma separated list of ids, limit a number '
+                                      'and min_coverage a fraction!'}, status=status.HTTP_400_BAD_REQUEST)
+        if not ingredient_ids:
+            return Response({'error': 'You need to provide ingredients!'}, status=status.HTTP_400_BAD_REQUEST)
+
+        matches = pantry.index.match(ingredient_ids, limit=limit, min_coverage=min_coverage)
+        fields = [field for field in RecipeDisplaySerializer.Meta.fields
+                  if field not in RecipeDisplaySerializer.expandable_fields]
+        recipes = Recipe.objects.for_display(fields).in_bulk([match[0] for match in matches])
+        results = []
+        for recipe_id, coverage, have, total, missing in matches:
+            if recipe_id in recipes:
+                results.append({
+                    'recipe': metrics.timed(RecipeDisplaySerializer(recipes[recipe_id], fields=fields)).data,
+                    'coverage': coverage,
+                    'have': have,
+                    'total': total,
+                    'missing': missing,
+                })
+        return Response(results)
+
+    # ?board=top (Bayesian average rating, default) or trending, ?category= an id, ?limit=, from the boards
+    # refresh_leaderboards precomputes
+    @action(detail=False, methods=['GET'])
+    def top(self, request):
+        board = request.query_params.get('board', RecipeScore.TOP)
+        if board not in dict(RecipeScore.BOARD_CHOICES):
+            response = {'error': 'board has to be one of {}!'.format(', '.join(dict(RecipeScore.BOARD_CHOICES)))}
+            return Response(response, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            category = request.query_params.get('category')
+            category = int(category) if category else None
+            limit = max(1, min(int(request.query_params.get('limit', 20)), settings.LEADERBOARD_SIZE))
+        except ValueError:
+            return Response({'error': 'category has to be an id and limit a number!'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        entries = list(RecipeScore.objects.filter(board=board, category_id=category).order_by('rank')[:limit])
+        fields = [field for field in RecipeDisplaySerializer.Meta.fields
+                  if field not in RecipeDisplaySerializer.expandable_fields]
+        recipes = Recipe.objects.for_display(fields).in_bulk([entry.recipe_id for entry in entries])
+        results = [{
+            'rank': entry.rank,
+            'score': entry.score,
+            'refreshed_at': entry.refreshed_at,
+            'recipe': metrics.timed(RecipeDisplaySerializer(recipes[entry.recipe_id], fields=fields)).data,
+        } for entry in entries if entry.recipe_id in recipes]
+        apply_user_overlay(request.user, [result['recipe'] for result in results])
+        return Response(results)
+
     @action(detail=True, methods=['POST'])
     def rate(self, request, pk=None):
         if 'stars' not in request.data:
@@ -192,15 +323,57 @@ class RecipeViewSet(viewsets.ModelViewSet):
             data_to_change = {'stars': stars}
             serializer = RatingSerializer(rating, data=data_to_change, partial=True)
             serializer.is_valid(raise_exception=True)
-            serializer.save()
+            # The aggregates are adjusted by api.signals, against the stars stored when the transaction runs
+            retry_atomic(serializer.save)
             return Response(serializer.data, status=status.HTTP_200_OK)
         except Rating.DoesNotExist:
             data = {'stars': stars}
             serializer = RatingSerializer(data=data)
             serializer.is_valid(raise_exception=True)
-            serializer.save(user=user, recipe=recipe)
+
+            serializer.instance = retry_atomic(lambda: Rating.objects.create(user=user, recipe=recipe,
+                                                                             **serializer.validated_data))
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    # Whole catalogue as ?type=ndjson (default) or csv, ?updated_since= an ISO date or datetime
+    @action(detail=False, methods=['GET'], permission_classes=(IsAdminUser, ))
+    def export(self, request):
+        export_type = request.query_params.get('type', 'ndjson')
+        if export_type not in recipe_export.EXPORT_TYPES:
+            response = {'error': 'type has to be one of {}!'.format(', '.join(recipe_export.EXPORT_TYPES))}
+            return Response(response, status=status.HTTP_400_BAD_REQUEST)
+        updated_since = request.query_params.get('updated_since')
+        if updated_since is not None:
+            try:
+                updated_since = recipe_export.parse_updated_since(updated_since)
+            except ValueError:
+                response = {'error': 'updated_since has to be an ISO date or datetime!'}
+                return Response(response, status=status.HTTP_400_BAD_REQUEST)
+
+        lines = recipe_export.export_lines(export_type, recipe_export.iter_documents(updated_since=updated_since))
+        response = StreamingHttpResponse(lines, content_type='application/x-ndjson' if export_type == 'ndjson'
+                                         else 'text/csv')
+        response['Content-Disposition'] = 'attachment; filename="recipes.{}"'.format(export_type)
+        return response
+
+    # {"steps": [step ids in the new order]}, all steps of the recipe
+    @action(detail=True, methods=['POST'], url_path='reorder-steps', permission_classes=(IsAuthenticated, IsOwner))
+    def reorder_steps(self, request, pk=None):
+        recipe = self.get_object()
+        step_ids = request.data.get('steps') if isinstance(request.data, dict) else None
+        current = set(recipe.steps.values_list('id', flat=True))
+        if not isinstance(step_ids, list) or any(not isinstance(i, int) or isinstance(i, bool) for i in step_ids) \
+                or len(step_ids) != len(current) or set(step_ids) != current:
+            response = {'error': 'You need to provide the ids of all steps of this recipe, in their new order!'}
+            return Response(response, status=status.HTTP_400_BAD_REQUEST)
+
+        def reorder():
+            Step.objects.reorder(recipe.id, step_ids)
+            bulk_recipes_changed([recipe.id])
+        retry_atomic(reorder)
+        serializer = metrics.timed(StepRecipeSerializer(recipe.steps.order_by('order'), many=True))
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['POST'])
     def favourite(self, request, pk=None):
         recipe = self.get_object()
@@ -208,26 +381,29 @@ class RecipeViewSet(viewsets.ModelViewSet):
         data = {'recipe': recipe.id, 'user': user.id}
         serializer = FavoriteSerializer(data=data)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
+        retry_atomic(serializer.save)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(metrics.SerializerMetricsMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = (IsAdminOrReadOnly, )
+    pagination_class = None
 
 
-class UnitViewSet(viewsets.ModelViewSet):
+class UnitViewSet(metrics.SerializerMetricsMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Unit.objects.all()
     serializer_class = UnitSerializer
     permission_classes = (IsAdminOrReadOnly, )
+    pagination_class = None
 
 
-class IngredientViewSet(viewsets.ModelViewSet):
+class IngredientViewSet(metrics.SerializerMetricsMixin, ConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (IsAdminOrCreateOrReadOnly, )
+    keyset_ordering = ('name',)
 
     def get_serializer_class(self):
         if self.action == 'retrieve' or self.action == 'list':
@@ -235,7 +411,8 @@ class IngredientViewSet(viewsets.ModelViewSet):
         return IngredientSerializer
 
 
-class RecipeIngredientViewSet(mixins.CreateModelMixin,
+class RecipeIngredientViewSet(metrics.SerializerMetricsMixin,
+                              mixins.CreateModelMixin,
                               mixins.UpdateModelMixin,
                               mixins.RetrieveModelMixin,
                               mixins.DestroyModelMixin,
@@ -258,26 +435,26 @@ class RecipeIngredientViewSet(mixins.CreateModelMixin,
 
         data = request.data
         is_many = isinstance(data, list)
-        with transaction.atomic():
-            try:
-                if not is_many:
-                    data['recipe'] = recipe.id
-                    serializer = self.get_serializer(data=data)
-                else:
-                    for rci in data:
-                        rci['recipe'] = recipe.id
-                    serializer = self.get_serializer(data=data, many=True)
-                serializer.is_valid(raise_exception=True)
-                self.perform_create(serializer)
-                headers = self.get_success_headers(serializer.data)
-                return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-            except IntegrityError as e:
-                return Response({"error": "In the recipe there cannot be any recipe_ingredient with the same "
-                                          "ingredient.id!"},
-                                status=status.HTTP_400_BAD_REQUEST)
-
-
-class StepViewSet(mixins.CreateModelMixin,
+        if not is_many:
+            data['recipe'] = recipe.id
+            serializer = self.get_serializer(data=data)
+        else:
+            for rci in data:
+                rci['recipe'] = recipe.id
+            serializer = self.get_serializer(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        try:
+            retry_atomic(lambda: self.perform_create(serializer))
+        except IntegrityError as e:
+            return Response({"error": "In the recipe there cannot be any recipe_ingredient with the same "
+                                      "ingredient.id!"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+
+class StepViewSet(metrics.SerializerMetricsMixin,
+                  mixins.CreateModelMixin,
                   mixins.UpdateModelMixin,
                   mixins.RetrieveModelMixin,
                   mixins.DestroyModelMixin,
@@ -300,25 +477,26 @@ class StepViewSet(mixins.CreateModelMixin,
 
         data = request.data
         is_many = isinstance(data, list)
-        with transaction.atomic():
-            try:
-                if not is_many:
-                    data['recipe'] = recipe.id
-                    serializer = self.get_serializer(data=data)
-                else:
-                    for step in data:
-                        step['recipe'] = recipe.id
-                    serializer = self.get_serializer(data=data, many=True)
-                serializer.is_valid(raise_exception=True)
-                self.perform_create(serializer)
-                headers = self.get_success_headers(serializer.data)
-                return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
-            except IntegrityError as e:
-                return Response({"error": "In the recipe there cannot be any step with the same step.order number!"},
-                                status=status.HTTP_400_BAD_REQUEST)
-
-
-class CommentViewSet(mixins.CreateModelMixin,
+        if not is_many:
+            data['recipe'] = recipe.id
+            serializer = self.get_serializer(data=data)
+        else:
+            for step in data:
+                step['recipe'] = recipe.id
+            serializer = self.get_serializer(data=data, many=True)
+        serializer.is_valid(raise_exception=True)
+        try:
+            retry_atomic(lambda: self.perform_create(serializer))
+        except IntegrityError as e:
+            return Response({"error": "In the recipe there cannot be any step with the same step.order number!"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+
+class CommentViewSet(metrics.SerializerMetricsMixin,
+                     mixins.CreateModelMixin,
+                     mixins.ListModelMixin,
                      mixins.UpdateModelMixin,
                      mixins.RetrieveModelMixin,
                      mixins.DestroyModelMixin,
@@ -326,26 +504,131 @@ class CommentViewSet(mixins.CreateModelMixin,
     queryset = Comment.objects.all()
     serializer_class = CommentSerializer
     permission_classes = (IsOwnerOrCreateOrReadOnly, )
+    pagination_class = CommentPagination
+
+    # Active comments of the recipe, oldest first
+    def get_queryset(self):
+        if self.action == 'list':
+            return Comment.objects.filter(recipe_id=self.kwargs.get('pk'), isActive=True)
+        return super(CommentViewSet, self).get_queryset()
+
+    def list(self, request, *args, **kwargs):
+        if not Recipe.objects.filter(id=self.kwargs.get('pk')).exists():
+            return Response({'error': 'Recipe with id = ' + str(self.kwargs.get('pk')) + ' does not exist.'},
+                            status=status.HTTP_404_NOT_FOUND)
+        return super(CommentViewSet, self).list(request, *args, **kwargs)
 
     def perform_create(self, serializer):
         rci_id = self.kwargs.get('pk')
         try:
             recipe = Recipe.objects.get(id=rci_id)
             if recipe:
-                serializer.save(user=self.request.user, recipe=recipe)
+                retry_atomic(lambda: serializer.save(user=self.request.user, recipe=recipe))
         except ObjectDoesNotExist:
             raise serializers.ValidationError('Recipe with id = ' + str(rci_id) + ' dose not exists.')
 
 
-class FavouriteViewSet(mixins.DestroyModelMixin,
+class FavouriteViewSet(metrics.SerializerMetricsMixin,
+                       mixins.DestroyModelMixin,
                        GenericViewSet):
     queryset = Favorite.objects.all()
     serializer_class = FavoriteSerializer
     permission_classes = (IsOwnerRecipeOrCreateOrReadOnly, )
 
 
-class RatingViewSet(mixins.DestroyModelMixin,
+class RatingViewSet(metrics.SerializerMetricsMixin,
+                    mixins.DestroyModelMixin,
                     GenericViewSet):
     queryset = Rating.objects.all()
     serializer_class = RatingSerializer
     permission_classes = (IsOwnerRecipeOrCreateOrReadOnly, )
+
+
+class ImageViewSet(ViewSet):
+    permission_classes = (IsAuthenticated, )
+    parser_classes = (MultiPartParser, )
+
+    # Multipart "image" file, stored once per content. The returned url goes into an imageUrl field,
+    # its variants are generated in the background.
+    def create(self, request):
+        upload = request.FILES.get('image')
+        if upload is None:
+            return Response({'error': 'You need to provide an image!'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            digest, path = images.store(upload.chunks())
+        except images.InvalidImage as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        url = images.url(path)
+        return Response({'hash': digest, 'url': url, 'variants': images.variant_urls(url)},
+                        status=status.HTTP_201_CREATED)
+
+
+class UploadSessionViewSet(metrics.SerializerMetricsMixin,
+                           mixins.CreateModelMixin,
+                           mixins.RetrieveModelMixin,
+                           mixins.DestroyModelMixin,
+                           GenericViewSet):
+    """
+    Resumable image upload: POST the size, sha256 and target, PUT the chunks in order with an Upload-Offset
+    header (GET tells where to continue after a disconnect), then POST complete/ to attach the image.
+    """
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+    permission_classes = (IsAuthenticated, )
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(user=self.request.user)
+
+    def create(self, request, *args, **kwargs):
+        uploads.discard(UploadSession.objects.filter(user=request.user, imageUrl__isnull=True,
+                                                     created_at__lt=uploads.expired_before()))
+        if uploads.open_sessions(request.user).count() >= settings.UPLOAD_MAX_SESSIONS:
+            response = {'error': 'You can have at most {} uploads in progress!'.format(settings.UPLOAD_MAX_SESSIONS)}
+            return Response(response, status=status.HTTP_429_TOO_MANY_REQUESTS)
+        return super(UploadSessionViewSet, self).create(request, *args, **kwargs)
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+    def perform_destroy(self, instance):
+        uploads.discard([instance])
+
+    def update(self, request, pk=None):
+        session = self.get_object()
+        if session.imageUrl is not None:
+            return Response({'error': 'This upload is already complete!'}, status=status.HTTP_409_CONFLICT)
+        try:
+            offset = int(request.META.get('HTTP_UPLOAD_OFFSET', request.query_params.get('offset', '')))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return Response({'error': 'You need to provide the Upload-Offset of the chunk!'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        # The body is read from the request stream in small pieces, never parsed or buffered whole
+        try:
+            uploads.write_chunk(session, offset, request.stream, length)
+        except uploads.UploadError as e:
+            return Response({'error': str(e), 'offset': session.offset}, status=e.status)
+        return Response(UploadSessionSerializer(session).data, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['POST'])
+    def complete(self, request, pk=None):
+        session = self.get_object()
+        if session.imageUrl is None:
+            try:
+                uploads.complete(session)
+            except uploads.UploadError as e:
+                session = UploadSession.objects.filter(pk=session.pk).first() or session
+                # The request that claimed the upload may have finished it meanwhile
+                if session.imageUrl is None:
+                    return Response({'error': str(e), 'offset': session.offset}, status=e.status)
+        data = UploadSessionSerializer(session).data
+        data['variants'] = images.variant_urls(session.imageUrl)
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class MetricsView(ViewSet):
+    permission_classes = (IsAdminUser, )
+
+    # Request histograms of this process in the Prometheus text format
+    def list(self, request):
+        return HttpResponse(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
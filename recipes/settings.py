@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 import os
+import tempfile
 from datetime import timedelta
 from pathlib import Path
 
@@ -59,13 +60,16 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.BasicAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
-    )
-
+        'api.authentication.CachedJWTAuthentication',
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.KeysetPagination',
+    'PAGE_SIZE': 20,
 
 }
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
+    'api.routers.ReadReplicaMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -116,9 +120,64 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 0)),
+    }
+}
+
+# Applied to every new SQLite connection (api/db.py): readers do not block the writer with WAL, and a writer
+# waits up to busy_timeout milliseconds for the lock instead of failing
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+}
+# api.db.retry_atomic: attempts of a write unit that found the database locked, pauses in seconds between them
+WRITE_RETRY_ATTEMPTS = 5
+WRITE_RETRY_DELAY = 0.05
+WRITE_RETRY_MAX_DELAY = 1
+
+# Read replicas (api/routers.py), e.g. DATABASE_REPLICAS=/tmp/replica1.sqlite3,/tmp/replica2.sqlite3 where
+# copies of db.sqlite3 are enough to try it locally. Per alias, HEALTH_CHECK_INTERVAL is the seconds between
+# health checks, HEALTH_CHECK_QUERY the check itself, and a LAG_QUERY returning the replication lag in seconds
+# marks the replica unhealthy while the lag is above MAX_LAG.
+READ_REPLICAS = {}
+for number, name in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), 1):
+    DATABASES['replica{}'.format(number)] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_REPLICA_CONN_MAX_AGE', 60)),
+        'TEST': {'MIRROR': 'default'},
+    }
+    READ_REPLICAS['replica{}'.format(number)] = {
+        'HEALTH_CHECK_INTERVAL': 10,
+        'LAG_QUERY': None,
+        'MAX_LAG': 5,
+    }
+DATABASE_ROUTERS = ['api.routers.ReadReplicaRouter']
+# Seconds a client keeps reading from the primary after a write
+PRIMARY_PIN_SECONDS = 10
+PRIMARY_PIN_COOKIE = 'primary_pin'
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# File based, so the version counters bumped by one worker are seen by all of them
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'recipes_cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
     }
 }
 
+# Seconds a serialized recipe list page or recipe document stays in the cache
+RECIPE_CACHE_TIMEOUT = 60 * 15
+# Seconds the same, read from a replica, stays in the cache, kept apart per replica
+REPLICA_CACHE_TIMEOUT = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -171,6 +230,58 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Uploaded images, stored once per content hash with resized variants, see api/images.py
+IMAGES_ROOT = os.path.join(BASE_DIR, 'images')
+IMAGES_URL = '/images/'
+IMAGE_MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# Threads generating the variants, 0 generates them during the upload request
+IMAGE_WORKERS = 2
+# Resumable uploads (api/uploads.py): chunk size, open sessions per user, chunks written at once per process
+UPLOAD_MAX_CHUNK_SIZE = 2 * 1024 * 1024
+UPLOAD_MAX_SESSIONS = 3
+UPLOAD_MAX_CONCURRENT_CHUNKS = 8
+UPLOAD_SESSION_TTL = timedelta(days=1)
+
+# reCAPTCHA verification (api/recaptcha.py), api.recaptcha.StubBackend answers offline
+RECAPTCHA_BACKEND = os.environ.get('RECAPTCHA_BACKEND', 'api.recaptcha.GoogleBackend')
+RECAPTCHA_SECRET = os.environ.get('RECAPTCHA_SECRET', '6LcN5NodAAAAAEbV6c3mcWlCjelPQcFQUbWry0er')
+# (connect, read) seconds
+RECAPTCHA_TIMEOUT = (1.0, 2.0)
+RECAPTCHA_POOL_SIZE = 10
+# Consecutive failures that stop the calls for RECAPTCHA_BREAKER_COOLDOWN seconds
+RECAPTCHA_BREAKER_THRESHOLD = 5
+RECAPTCHA_BREAKER_COOLDOWN = 30
+# Seconds a verdict is kept per token, tokens expire after two minutes upstream
+RECAPTCHA_CACHE_TIMEOUT = 120
+RECAPTCHA_STUB_FAILING_TOKENS = ('invalid',)
+RECAPTCHA_STUB_LATENCY = 0
+
+# Identities (id, is_staff, is_active) CachedJWTAuthentication keeps per process. Saving or deleting a user
+# drops its entry in the process doing it, the other processes see the change after the timeout.
+AUTH_USER_CACHE_SIZE = 10000
+AUTH_USER_CACHE_TIMEOUT = 60
+
+# Page size of /api/recipes/<pk>/comments/, a recipe detail carries its first page
+COMMENTS_PAGE_SIZE = 10
+
+# Leaderboards (api/leaderboards.py, rebuilt by the refresh_leaderboards command): recipes kept per board, the
+# number of ratings of the overall mean the top rated scores are damped with, and how fast trending activity fades
+LEADERBOARD_SIZE = 100
+LEADERBOARD_PRIOR_RATINGS = 10
+LEADERBOARD_TRENDING_HALF_LIFE = timedelta(days=3)
+LEADERBOARD_TRENDING_WINDOW = timedelta(days=30)
+LEADERBOARD_FAVOURITE_WEIGHT = 1.0
+
+# Server-Timing headers for every response instead of only staff ones, and the queries an endpoint
+# (ViewSet.action, see api/metrics.py) may run, checked by the tests
+METRICS_SERVER_TIMING = DEBUG
+QUERY_BUDGETS = {
+    'RecipeViewSet.list': 4,
+    'RecipeViewSet.retrieve': 8,
+    'RecipeViewSet.top': 5,
+    'CommentViewSet.list': 2,
+}
+
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=2),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
@@ -1,10 +1,14 @@
+from django.conf import settings
+from django.conf.urls.static import static
 from django.urls import path
 from django.conf.urls import include
 from rest_framework.authtoken.views import obtain_auth_token
 from api.admin import custom_admin
+from api.views import MetricsView
 
 urlpatterns = [
     path('admin/', custom_admin.urls),
     path('api/', include('api.urls')),
     path('auth/', obtain_auth_token),
-]
+    path('metrics', MetricsView.as_view({'get': 'list'}), name='metrics'),
+] + static(settings.IMAGES_URL, document_root=settings.IMAGES_ROOT)